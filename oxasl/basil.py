@@ -33,16 +33,26 @@ Copyright (c) 2008-2018 University of Oxford
 
 import sys
 import math
+import time
 
 import numpy as np
+import pandas as pd
+
+try:
+    import resource
+except ImportError:
+    resource = None
 
 from fsl.wrappers import LOAD
 from fsl.data.image import Image
 
 from oxasl import __version__, __timestamp__, AslImage, Workspace, image
 from oxasl.options import AslOptionParser, OptionCategory, IgnorableOptionGroup, GenericOptions
+from oxasl.cache import get_cache
+from oxasl.progress import get_progress
+from oxasl import crop, reg
 
-def basil(wsp, output_wsp=None, prefit=True):
+def basil(wsp, output_wsp=None, prefit=True, stage="basil"):
     """
     Run BASIL modelling on ASL data in a workspace
 
@@ -50,6 +60,8 @@ def basil(wsp, output_wsp=None, prefit=True):
     :param output_wsp: Optional Workspace object for storing output. If not specified
                        will use ``wsp``
     :param prefit: If True, run a pre-fitting step using the mean over repeats of the ASL data
+    :param stage: Name of processing stage used in progress events. The pre-fitting step
+                  uses this name with the suffix ``_init``
 
     Required workspace attributes
     -----------------------------
@@ -74,9 +86,41 @@ def basil(wsp, output_wsp=None, prefit=True):
      - ``pgm`` :  Grey matter partial volume map as Image
      - ``pwm`` : White matter partial volume map as Image
      - ``initmvn`` : MVN structure to use as initialization as Image
+     - ``pop_ftiss`` : Population mean perfusion map used as an image prior. May be in standard or native space
+     - ``pop_ftiss_var`` : Population variance of perfusion used to set the precision of the ``pop_ftiss`` prior
+     - ``pop_delttiss`` : Population mean arrival time map used as an image prior. May be in standard or native space
+     - ``pop_delttiss_var`` : Population variance of arrival time used to set the precision of the ``pop_delttiss`` prior
      - ``spatial`` : If True, include final spatial VB step (default: False)
      - ``onestep`` : If True, do all inference in a single step (default: False)
+     - ``mean_repeats`` : If True, fit the model to the mean over repeats at each TI/PLD and TE.
+                          This is always done for multi-TE data with variable repeats
      - ``basil_options`` : Optional dictionary of additional options for underlying model
+     - ``crop`` : If True, crop data to the bounding box of the mask for model fitting. Output in
+                  ``output_wsp`` is then cropped and the bounding box is stored in ``output_wsp.bbox``
+     - ``crop_margin`` : Number of voxels to add around the mask bounding box when cropping (default: 1)
+     - ``refit_bad_voxels`` : If True, refit voxels which fail to converge using more iterations (default: False)
+     - ``refit_max_iterations`` : Maximum number of iterations when refitting voxels
+     - ``adaptive`` : If True, run fixed iteration steps in blocks of iterations and stop when most voxels
+                      have converged, and skip intermediate steps which are likely to be redundant
+     - ``adaptive_tol`` : Free energy change below which a voxel is considered converged (default: 0.1)
+     - ``adaptive_frac`` : Fraction of voxels which must converge to finish a step (default: 0.95)
+     - ``adaptive_block`` : Number of iterations between convergence checks (default: 5)
+     - ``adaptive_skip_tol`` : In adaptive mode, skip an intermediate step if the parameter means changed
+                               by less than this fraction in the previous step (default: 0.01)
+     - ``adaptive_validate`` : If True, re-run all steps without adaptive convergence to measure the
+                               speedup and the difference in the final parameter means
+     - ``fabber_cache`` : If True, re-use cached Fabber results for identical options and data (default: False)
+     - ``fabber_cache_dir`` : Directory for cached Fabber results (default: ~/.oxasl/fabber_cache)
+     - ``fabber_cache_size`` : Maximum size of Fabber cache in Mb
+     - ``bootstrap`` : Number of bootstrap resamples over repeats used to estimate empirical
+                       parameter uncertainty. Output is stored in ``output_wsp.resample``
+     - ``jackknife`` : If True, estimate empirical parameter uncertainty by jackknife resampling
+                       over repeats
+     - ``resample_workers`` : Number of processes used to fit resamples (default: 1)
+     - ``resample_seed`` : Random seed for bootstrap resamples
+     - ``progress`` : ``oxasl.progress.Progress`` object to receive progress events
+     - ``progress_file`` : File to write progress events to as JSON lines, if ``progress`` not given
+     - ``progress_metrics_file`` : File to write latest progress metrics to, if ``progress`` not given
     """
     wsp.log.write("\nRunning BASIL Bayesian modelling on ASL data\n")
     if output_wsp is None:
@@ -131,12 +175,16 @@ def basil(wsp, output_wsp=None, prefit=True):
         wsp.log.write(" - Restricting noise prior as only one ASL volume\n")
         extra_options["prior-noise-stddev"] = 1.0
     
-    if prefit and max(wsp.asldata.rpts) > 1:
+    if prefit and get_pop_priors(wsp):
+        wsp.log.write(" - Population priors supplied - skipping initial fit on mean data\n")
+        prefit = False
+
+    if prefit and max(wsp.asldata.rpts) > 1 and not wsp.mean_repeats:
         # Initial BASIL run on mean data
         wsp.log.write(" - Doing initial fit on mean at each TI\n\n")
         init_wsp = output_wsp.sub("init")
         main_wsp = output_wsp.sub("main")
-        basil_fit(wsp, wsp.asldata.mean_across_repeats(), mask=wsp.rois.mask, output_wsp=init_wsp, **extra_options)
+        basil_fit(wsp, wsp.asldata.mean_across_repeats(), mask=wsp.rois.mask, output_wsp=init_wsp, stage=stage + "_init", **extra_options)
         extra_options["continue-from-mvn"] = output_wsp.init.finalstep.finalMVN
         main_wsp.initmvn = extra_options["continue-from-mvn"]
     else:
@@ -144,10 +192,15 @@ def basil(wsp, output_wsp=None, prefit=True):
 
     # Main run on full ASL data
     wsp.log.write("\n - Doing fit on full ASL data\n\n")
-    basil_fit(wsp, wsp.asldata, mask=wsp.rois.mask, output_wsp=main_wsp, **extra_options)
+    basil_fit(wsp, wsp.asldata, mask=wsp.rois.mask, output_wsp=main_wsp, stage=stage, **extra_options)
     output_wsp.finalstep = main_wsp.finalstep
 
-def basil_fit(wsp, asldata, mask=None, output_wsp=None, **kwargs):
+    if wsp.bootstrap or wsp.jackknife:
+        # Imported here as the resampling module uses the BASIL steps
+        from oxasl.bootstrap import resample_fit
+        resample_fit(wsp, output_wsp=output_wsp.sub("resample"))
+
+def basil_fit(wsp, asldata, mask=None, output_wsp=None, stage="basil", **kwargs):
     """
     Run Bayesian model fitting on ASL data
 
@@ -157,37 +210,441 @@ def basil_fit(wsp, asldata, mask=None, output_wsp=None, **kwargs):
     :param asldata: AslImage object to use as input data
     :param output_wsp: Optional Workspace object for storing output files. If not specified
                        ``wsp`` is used instead
+    :param stage: Name of processing stage used in progress events
+
+    Workspace attributes updated
+    ----------------------------
+
+     - ``output_wsp.step<n>`` : Output of each step, including ``voxel_status`` and a
+                                ``metrics`` DataFrame for Fabber steps. Intermediate steps
+                                contain the parameter means and standard deviations, free
+                                energy and the outputs needed by the next step. The model
+                                fit is only saved for the final step
+     - ``output_wsp.metrics`` : DataFrame of timing and convergence metrics for all Fabber steps
+     - ``output_wsp.adaptive_validation`` : DataFrame comparing final parameter means with a full run,
+                                            if ``adaptive_validate`` was set
+     - ``output_wsp.adaptive_speedup`` : Measured speedup of the adaptive run, if ``adaptive_validate`` was set
+     - ``output_wsp.finalstep`` : Output of the final step
     """
-    if len(asldata.tes) > 1:
-        steps = basil_steps_multite(wsp, asldata, mask, **kwargs)
-    else:
-        steps = basil_steps(wsp, asldata, mask, **kwargs)
+    from .wrappers.fabber import requested_items
+    steps = basil_steps(wsp, asldata, mask, **kwargs)
 
     if output_wsp is None:
         output_wsp = wsp
 
     prev_result = None
     output_wsp.asldata_diff = asldata.diff().reorder("rt")
-
+    cache = get_cache(wsp)
+
+    if wsp.crop and mask is not None:
+        # Crop all step inputs to the bounding box of the mask. Output remains
+        # cropped, with the bounding box recorded in the output workspace
+        bbox = crop.get_bbox(mask, wsp.ifnone("crop_margin", 1))
+        if bbox is not None:
+            wsp.log.write(" - Cropping to mask bounding box: %s (%.1f%% of voxels)\n\n" % (
+                " ".join(["%i:%i" % tuple(dim) for dim in bbox]),
+                100.0 * np.prod(crop.bbox_shape(bbox)) / np.prod(mask.shape[:3])))
+            # Images shared between steps are cropped once so the Fabber worker
+            # only converts them once
+            cropped = {}
+            for step in steps:
+                step.options = crop.crop_options(step.options, bbox, mask.shape, cropped)
+            output_wsp.bbox = bbox
+
+    fabber_kwargs = {
+        "fabber_corelib" : wsp.fabber_corelib, "fabber_libs" : wsp.fabber_libs,
+        "fabber_coreexe" : wsp.fabber_coreexe, "fabber_exes" : wsp.fabber_exes,
+    }
+    metrics = []
+    prev_fe = None
+    adaptive, skip_tol, skipped, run_time = None, None, [], 0.0
+    if wsp.adaptive:
+        adaptive = {
+            "tol" : wsp.ifnone("adaptive_tol", 0.1),
+            "frac" : wsp.ifnone("adaptive_frac", 0.95),
+            "block" : wsp.ifnone("adaptive_block", 5),
+        }
+        skip_tol = wsp.ifnone("adaptive_skip_tol", 0.01)
+        wsp.log.write(" - Adaptive convergence: F tolerance %.3g, converged fraction %.3g, %i iterations per block, step skip tolerance %.3g\n\n" % (
+            adaptive["tol"], adaptive["frac"], adaptive["block"], skip_tol))
+
+    # Index and output of the last two Fabber steps, used to detect redundant steps
+    fabber_results = []
+    prev_idx = None
+    stage_progress = get_progress(wsp).stage(stage, nsteps=len(steps))
+    stage_progress.start()
     for idx, step in enumerate(steps):
+        if adaptive and _can_skip(steps, idx) and [fitted_idx for fitted_idx, _ in fabber_results] == [idx-2, idx-1]:
+            change = _mean_change(fabber_results[0][1], fabber_results[1][1])
+            if change < skip_tol:
+                wsp.log.write("Step %i of %i: %s - Skipped as parameter means changed by %.3g%% in step %i\n" % (
+                    idx+1, len(steps), step.desc, 100 * change, idx))
+                skipped.append((idx+1, step.desc, change))
+                continue
+
         step_wsp = output_wsp.sub("step%i" % (idx+1))
+        outputs = _step_outputs(steps, idx)
         desc = "Step %i of %i: %s" % (idx+1, len(steps), step.desc)
         if prev_result is not None:
-            desc += " - Initialise with step %i" % idx
+            desc += " - Initialise with step %i" % (prev_idx+1)
         step_wsp.log.write(desc + "     ")
+        stage_progress.step(idx+1, step.desc)
+        start_wall, start_cpu, start_rss = time.time(), _cpu_time(), _peak_rss_mb()
         result = step.run(prev_result, log=wsp.log, fsllog=wsp.fsllog,
-                          fabber_corelib=wsp.fabber_corelib, fabber_libs=wsp.fabber_libs,
-                          fabber_coreexe=wsp.fabber_coreexe, fabber_exes=wsp.fabber_exes)
-        for key, value in result.items():
-            setattr(step_wsp, key, value)
+                          cache=cache, outputs=outputs, adaptive=adaptive,
+                          progress_cb=stage_progress.callback(), **fabber_kwargs)
+        run_time += time.time() - start_wall
+
+        if isinstance(step, FabberStep):
+            status, fe_thresh = voxel_status(result, step.options.get("mask", None))
+            nbad = np.count_nonzero(status.data > VOXEL_OK)
+            if nbad > 0:
+                wsp.log.write(" - %i voxels failed to converge or have outlying free energy\n" % nbad)
+                if wsp.refit_bad_voxels and step.spatial:
+                    # The spatial prior depends on neighbouring voxels which would be
+                    # excluded by the reduced refit mask
+                    wsp.log.write(" - Not refitting voxels in spatial step\n")
+                elif wsp.refit_bad_voxels:
+                    result = step.refit(result, status, fe_thresh, log=wsp.log, fsllog=wsp.fsllog,
+                                        max_iterations=wsp.refit_max_iterations, outputs=outputs,
+                                        progress_cb=stage_progress.callback(), **fabber_kwargs)
+                    status, _ = voxel_status(result, step.options.get("mask", None), fe_thresh)
+                    wsp.log.write(" - %i voxels remaining after refit\n" % np.count_nonzero(status.data > VOXEL_OK))
+            step_wsp.voxel_status = status
+
+            step_metrics = _step_metrics(idx+1, step, result, status, prev_fe,
+                                         time.time() - start_wall, _cpu_time() - start_cpu, start_rss)
+            if adaptive:
+                step_metrics[METRICS_COLUMNS.index("iterations")] = step.adaptive_info["iterations"]
+                step_metrics += [step.adaptive_info[key] for key in ADAPTIVE_INFO]
+            step_wsp.metrics = pd.DataFrame([step_metrics], columns=_metrics_columns(adaptive))
+            metrics.append(step_metrics)
+            if "freeEnergy" in result:
+                prev_fe = result["freeEnergy"].data[status.data == VOXEL_OK]
+            fabber_results = fabber_results[-1:] + [(idx, result)]
+
+        # Only outputs which were requested are stored, as storing an output
+        # in the workspace converts it to an image and saves it
+        for key in requested_items(result, outputs):
+            setattr(step_wsp, key, result[key])
 
         if step_wsp.logfile is not None and step_wsp.savedir is not None:
             step_wsp.set_item("logfile", step_wsp.logfile, save_fn=str)
 
-        prev_result = result
+        prev_result, prev_idx = result, idx
     output_wsp.finalstep = step_wsp
+    stage_progress.finish()
+
+    validation = None
+    if adaptive and wsp.adaptive_validate:
+        validation, full_time = _validate_adaptive(wsp, steps, prev_result, **fabber_kwargs)
+        output_wsp.adaptive_validation = validation
+        output_wsp.adaptive_speedup = full_time / run_time
+        wsp.log.write(" - Full run took %.1fs, adaptive run %.1fs (speedup %.2f)\n" % (
+            full_time, run_time, output_wsp.adaptive_speedup))
+
+    if metrics:
+        output_wsp.metrics = pd.DataFrame(metrics, columns=_metrics_columns(adaptive))
+        _report_metrics(wsp, output_wsp.metrics)
+        if adaptive:
+            _report_adaptive(wsp, output_wsp.metrics, skipped, validation, output_wsp.adaptive_speedup)
     wsp.log.write("\nEnd\n")
 
+def _step_outputs(steps, idx):
+    """
+    :return: Outputs to generate for a step, or None for all outputs
+    """
+    if idx < len(steps) - 1:
+        # Intermediate steps only need to generate the output required to
+        # initialize the next step, plus the free energy for checking
+        # convergence. The parameter means and standard deviations are
+        # small and are kept so each step's output can be inspected. In
+        # particular this avoids holding the 4D model fit in memory for
+        # every step
+        return list(steps[idx+1].requires) + ["freeEnergy", "mean_*", "std_*"]
+    else:
+        return None
+
+def _can_skip(steps, idx):
+    """
+    :return: True if a step could be skipped in adaptive mode. The final step is never
+             skipped, and neither is a step whose successor is not a Fabber step or
+             needs more than the posterior of the skipped step, as this would
+             be replaced by the output of the step before
+    """
+    return (0 < idx < len(steps) - 1 and isinstance(steps[idx], FabberStep)
+            and isinstance(steps[idx+1], FabberStep) and tuple(steps[idx+1].requires) == ("finalMVN",))
+
+def _mean_change(prev_result, result):
+    """
+    :return: Largest relative change in the median of any parameter mean between two
+             steps, or infinity if the steps have no parameter means in common. Changes
+             are relative to the median absolute value in the first step
+    """
+    changes = []
+    for key in result.keys():
+        if not key.startswith("mean_") or key not in prev_result:
+            continue
+        prev_data, data = prev_result[key].data, result[key].data
+        roi = np.isfinite(prev_data) & np.isfinite(data) & (prev_data != 0)
+        if np.count_nonzero(roi) > 0:
+            scale = np.median(np.abs(prev_data[roi]))
+            changes.append(np.median(np.abs(data[roi] - prev_data[roi])) / scale)
+    if changes:
+        return max(changes)
+    else:
+        return float("inf")
+
+def _validate_adaptive(wsp, steps, result, **kwargs):
+    """
+    Re-run all steps without adaptive convergence and compare the final parameter means
+
+    :param result: Output of the final step of the adaptive run
+    :return: Tuple of (DataFrame of the difference in each final parameter mean between
+             the adaptive and full runs, wall time of the full run in seconds)
+    """
+    wsp.log.write("\nValidating adaptive convergence against a full run\n")
+    start = time.time()
+    full = None
+    for idx, step in enumerate(steps):
+        wsp.log.write("Step %i of %i: %s     " % (idx+1, len(steps), step.desc))
+        full = step.run(full, log=wsp.log, fsllog=wsp.fsllog, outputs=_step_outputs(steps, idx), **kwargs)
+    full_time = time.time() - start
+
+    mask = steps[-1].options.get("mask", None)
+    rows = []
+    for key in sorted(result.keys()):
+        if not key.startswith("mean_") or key not in full:
+            continue
+        data, full_data = result[key].data, full[key].data
+        roi = np.isfinite(data) & np.isfinite(full_data)
+        if mask is not None:
+            roi &= mask.data > 0
+        diff = np.abs(data[roi] - full_data[roi])
+        if diff.size > 0:
+            scale = np.median(np.abs(full_data[roi]))
+            rows.append([key[5:], np.median(diff), np.median(diff) / scale if scale > 0 else float("nan"), np.max(diff)])
+    return pd.DataFrame(rows, columns=["param", "median_abs_diff", "median_rel_diff", "max_abs_diff"]), full_time
+
+METRICS_COLUMNS = [
+    "step", "desc", "method", "voxels", "max_iterations", "max_trials", "iterations",
+    "wall_time", "cpu_time", "process_peak_rss_mb", "peak_rss_increase_mb",
+    "startup_time", "transfer_time", "cached_mb",
+    "fe_median", "fe_iqr", "fe_change", "bad_voxels",
+]
+
+ADAPTIVE_COLUMNS = ["budget", "blocks", "converged_frac", "fe_residual_change", "run_time", "overhead_time", "est_full_time"]
+
+# Keys of ``FabberStep.adaptive_info`` corresponding to ``ADAPTIVE_COLUMNS``
+ADAPTIVE_INFO = ["budget", "blocks", "converged_frac", "fe_change", "run_time", "overhead_time", "est_full_time"]
+
+def _metrics_columns(adaptive):
+    if adaptive:
+        return METRICS_COLUMNS + ADAPTIVE_COLUMNS
+    else:
+        return METRICS_COLUMNS
+
+def _cpu_time():
+    """
+    :return: CPU time used by this process and its children in seconds, or NaN if not available
+    """
+    if resource is None:
+        return float("nan")
+    usage_self = resource.getrusage(resource.RUSAGE_SELF)
+    usage_children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return usage_self.ru_utime + usage_self.ru_stime + usage_children.ru_utime + usage_children.ru_stime
+
+def _peak_rss_mb():
+    """
+    :return: Peak resident set size of this process in Mb, or NaN if not available.
+             This is a high-water mark over the lifetime of the process, not
+             the current memory usage
+    """
+    if resource is None:
+        return float("nan")
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == "darwin":
+        # Reported in bytes on Mac, kb elsewhere
+        maxrss /= 1024
+    return float(maxrss) / 1024
+
+def _step_metrics(step_num, step, result, status, prev_fe, wall_time, cpu_time, start_rss):
+    """
+    Get performance and convergence metrics for a Fabber step
+
+    The number of iterations actually used is not reported by Fabber, so it
+    is left as NaN here and only filled in when it is known, e.g. from
+    adaptive convergence.
+
+    :param prev_fe: Free energy of converged voxels from the previous Fabber step, if available
+    :param start_rss: Process peak resident set size in Mb at the start of the step
+    :return: List of metric values corresponding to ``METRICS_COLUMNS``
+    """
+    roi = status.data == VOXEL_OK
+    fe_median, fe_iqr, fe_change = float("nan"), float("nan"), float("nan")
+    if "freeEnergy" in result:
+        fe = result["freeEnergy"].data[roi]
+        if fe.size > 0:
+            fe_median = np.median(fe)
+            fe_iqr = np.percentile(fe, 75) - np.percentile(fe, 25)
+            if prev_fe is not None and prev_fe.size > 0:
+                fe_change = fe_median - np.median(prev_fe)
+
+    peak_rss = _peak_rss_mb()
+    stats = getattr(result, "stats", {})
+    return [
+        step_num, step.desc, step.options.get("method", ""),
+        int(np.count_nonzero(status.data)),
+        step.options.get("max-iterations", float("nan")),
+        step.options.get("max-trials", float("nan")),
+        float("nan"),
+        wall_time, cpu_time, peak_rss, peak_rss - start_rss,
+        stats.get("startup_time", float("nan")), stats.get("transfer_time", float("nan")),
+        float(stats.get("cached_bytes", float("nan"))) / (1024 * 1024),
+        fe_median, fe_iqr, fe_change,
+        int(np.count_nonzero(status.data > VOXEL_OK)),
+    ]
+
+def _report_metrics(wsp, metrics):
+    """
+    Add a report page summarising the performance of each Fabber step
+    """
+    page = wsp.report.page("basil_metrics")
+    page.heading("Model fitting step metrics")
+    page.text("Wall and CPU time for each model fitting step, with convergence information. "
+              "CPU time includes all threads and child processes. Process peak memory is the "
+              "maximum resident set size of the whole process up to the end of the step, and "
+              "the increase is the amount by which the step raised it - zero if the step used "
+              "no more memory than an earlier stage of processing. Iterations used are only "
+              "shown where known, otherwise only the limit is given. "
+              "Startup and transfer time are the time taken to create the Fabber API and "
+              "to convert input data, which is re-used from previous steps where possible. "
+              "Free energy is summarised over voxels which converged successfully.")
+    table = []
+    for _, row in metrics.iterrows():
+        table.append([
+            "%i" % row["step"], row["desc"], "%i" % row["voxels"],
+            "%s / %s" % (_fmt_count(row["iterations"]), _fmt_count(row["max_iterations"])),
+            _fmt_count(row["max_trials"]),
+            "%.1f" % row["wall_time"], "%.1f" % row["cpu_time"],
+            "%.0f" % row["process_peak_rss_mb"], "%.0f" % row["peak_rss_increase_mb"],
+            "%.2f" % row["startup_time"], "%.2f" % row["transfer_time"],
+            "%.4g" % row["fe_median"], "%.4g" % row["fe_change"], "%i" % row["bad_voxels"],
+        ])
+    page.table(table, headers=["Step", "Description", "Voxels", "Iterations", "Max trials", "Wall time (s)",
+                               "CPU time (s)", "Process peak memory (Mb)", "Increase (Mb)", "Startup (s)",
+                               "Transfer (s)", "Median F", "Change in F", "Bad voxels"])
+    total = metrics["wall_time"].sum()
+    if total > 0:
+        slowest = metrics.loc[metrics["wall_time"].idxmax()]
+        page.text("Total wall time %.1fs. Slowest step: %i (%.0f%% of total)" % (
+            total, slowest["step"], 100 * slowest["wall_time"] / total))
+
+def _report_adaptive(wsp, metrics, skipped, validation=None, speedup=None):
+    """
+    Add a report page summarising the adaptive convergence of each Fabber step
+
+    :param skipped: Sequence of (step number, description, parameter change) for skipped steps
+    :param validation: Optional DataFrame comparing final parameter means with a full run
+    :param speedup: Measured speedup relative to a full run, if validated
+    """
+    est_speedup = metrics["est_full_time"].sum() / metrics["run_time"].sum()
+    wsp.log.write(" - Adaptive convergence: estimated speedup %.2f, %i steps skipped\n" % (est_speedup, len(skipped)))
+
+    page = wsp.report.page("basil_adaptive")
+    page.heading("Adaptive convergence")
+    page.text("Steps with a fixed number of iterations were run in blocks of iterations and stopped "
+              "when the required fraction of voxels had a free energy change between blocks below "
+              "the tolerance. Other steps stop each voxel at convergence and were run unchanged. "
+              "The residual change is the median free energy change over the final block.")
+    table = []
+    for _, row in metrics.iterrows():
+        table.append(["%i" % row["step"], row["desc"], "%s / %i" % (_fmt_count(row["iterations"]), row["budget"]),
+                      "%i" % row["blocks"], "%.1f%%" % (100 * row["converged_frac"]), "%.3g" % row["fe_residual_change"],
+                      "%.1f" % row["run_time"], "%.1f" % row["overhead_time"], "%.1f" % row["est_full_time"]])
+    page.table(table, headers=["Step", "Description", "Iterations", "Blocks", "Converged voxels", "Residual F change",
+                               "Time (s)", "Block overhead (s)", "Estimated full time (s)"])
+    page.text("Estimated speedup %.2f. The estimated time for a full run of each step includes the "
+              "overhead of restarting Fabber for each block. Time saved by skipping steps is not "
+              "included in the estimate." % est_speedup)
+
+    if skipped:
+        page.heading("Skipped steps", level=1)
+        page.text("Intermediate steps are skipped when the parameter means changed by less than the "
+                  "skip tolerance in the step before, relative to their typical value.")
+        page.table([["%i" % num, desc, "%.3g%%" % (100 * change)] for num, desc, change in skipped],
+                   headers=["Step", "Description", "Change in previous step"])
+
+    if validation is not None:
+        page.heading("Validation against full run", level=1)
+        page.text("All steps were re-run without adaptive convergence. Measured speedup: %.2f" % speedup)
+        page.table([[row["param"], "%.3g" % row["median_abs_diff"], "%.3g%%" % (100 * row["median_rel_diff"]), "%.3g" % row["max_abs_diff"]]
+                    for _, row in validation.iterrows()],
+                   headers=["Parameter", "Median difference", "Median relative difference", "Maximum difference"])
+
+def _fmt_count(val):
+    try:
+        return "%i" % int(val)
+    except (ValueError, TypeError):
+        return "-"
+
+# Voxel status codes returned by ``voxel_status``
+VOXEL_OUTSIDE_MASK = 0
+VOXEL_OK = 1
+VOXEL_NONFINITE = 2
+VOXEL_FE_OUTLIER = 3
+
+def voxel_status(result, mask=None, fe_thresh=None, fe_nmad=5):
+    """
+    Get the convergence status of each voxel from the output of a Fabber step
+
+    Voxels are flagged if any of the parameter means (or the MVN if these
+    are not available) are not finite, or if the free energy is an outlier
+    i.e. much lower than the typical value within the mask.
+
+    :param result: Output dictionary from a Fabber step
+    :param mask: Mask Image used in the Fabber step. If None all voxels are included
+    :param fe_thresh: Free energy threshold below which voxels are flagged. If not
+                      specified, this is determined robustly from the median and
+                      median absolute deviation within the mask
+    :param fe_nmad: Number of median absolute deviations below the median for the
+                    free energy threshold
+    :return: Tuple of (integer Image containing voxel status codes, free energy threshold)
+    """
+    params = [key for key in result.keys() if key.startswith("mean_")]
+    if not params:
+        params = ["finalMVN"]
+    ref = result[params[0]]
+    if mask is not None:
+        roi = mask.data > 0
+    else:
+        roi = np.ones(ref.shape[:3], dtype=bool)
+
+    status = np.zeros(ref.shape[:3], dtype=np.int8)
+    status[roi] = VOXEL_OK
+
+    if "freeEnergy" in result:
+        fe = result["freeEnergy"].data
+        if fe_thresh is None:
+            fe_roi = fe[roi & np.isfinite(fe)]
+            if fe_roi.size > 0:
+                fe_median = np.median(fe_roi)
+                fe_mad = 1.4826 * np.median(np.abs(fe_roi - fe_median))
+                fe_thresh = fe_median - fe_nmad * fe_mad
+        if fe_thresh is not None:
+            status[roi & (fe < fe_thresh)] = VOXEL_FE_OUTLIER
+        status[roi & ~np.isfinite(fe)] = VOXEL_NONFINITE
+
+    for param in params:
+        data = result[param].data
+        if data.ndim > 3:
+            finite = np.all(np.isfinite(data), axis=3)
+        else:
+            finite = np.isfinite(data)
+        status[roi & ~finite] = VOXEL_NONFINITE
+
+    return Image(status, header=ref.header), fe_thresh
+
 def basil_steps(wsp, asldata, mask=None, **kwargs):
     """
     Get the steps required for a BASIL run
@@ -196,6 +653,9 @@ def basil_steps(wsp, asldata, mask=None, **kwargs):
     the actual modelling, or so that the steps can be checked prior to doing
     an actual run.
 
+    Multi-TE data is modelled using the ``asl_multite`` model, otherwise the
+    ``aslrest`` model is used.
+
     Arguments are the same as the ``basil`` function. No workspace is required.
     """
     if asldata is None:
@@ -203,15 +663,20 @@ def basil_steps(wsp, asldata, mask=None, **kwargs):
 
     wsp.log.write("BASIL v%s\n" % __version__)
     asldata.summary(log=wsp.log)
+    multite = asldata.ntes > 1
     asldata = asldata.diff().reorder("rt")
 
+    mean_repeats = wsp.mean_repeats
+    if multite and asldata.is_var_repeats() and not mean_repeats:
+        wsp.log.write(" - Multi-TE model does not support variable repeats - fitting to mean over repeats\n")
+        mean_repeats = True
+    if mean_repeats:
+        asldata = asldata.mean_across_repeats()
+
     # Default Fabber options for VB runs and spatial steps. Note that attributes
     # which are None (e.g. sliceband) are not passed to Fabber
     options = {
         "data" : asldata,
-        "model" : "aslrest",
-        "disp" : "none",
-        "exch" : "mix",
         "method" : "vb",
         "noise" : "white",
         "allow-bad-voxels" : True,
@@ -222,7 +687,12 @@ def basil_steps(wsp, asldata, mask=None, **kwargs):
         "save-mvn" : True,
         "save-std" : True,
         "save-model-fit" : True,
+        "save-free-energy" : True,
     }
+    if multite:
+        options["model"] = "asl_multite"
+    else:
+        options.update({"model" : "aslrest", "disp" : "none", "exch" : "mix"})
 
     if mask is not None:
         options["mask"] = mask
@@ -230,17 +700,28 @@ def basil_steps(wsp, asldata, mask=None, **kwargs):
     # We choose to pass TIs (not PLDs). The asldata object ensures that
     # TIs are correctly derived from PLDs, when these are specified, by adding
     # the bolus duration.
-    for idx, ti in enumerate(asldata.tis):
-        options["ti%i" % (idx+1)] = ti
-        options["rpt%i" % (idx+1)] = asldata.rpts[idx]
+    _list_option(options, asldata.tis, "ti")
 
-    # Bolus duration - use a single value where possible as cannot infer otherwise
     taus = getattr(asldata, "taus", [1.8,])
-    if min(taus) == max(taus):
+    if multite:
+        # Pass multiple TEs
+        _list_option(options, asldata.tes, "te")
+
+        # Bolus duration must be constant for multi-TE model
+        if min(taus) != max(taus):
+            raise ValueError("Multi-TE model does not support variable bolus durations")
         options["tau"] = taus[0]
+
+        # Repeats are constant for multi-TE model - variable repeats are averaged above
+        options["repeats"] = asldata.rpts[0]
     else:
-        for idx, tau in enumerate(taus):
-            options["tau%i" % (idx+1)] = tau
+        _list_option(options, asldata.rpts, "rpt")
+
+        # Bolus duration - use a single value where possible as cannot infer otherwise
+        if min(taus) == max(taus):
+            options["tau"] = taus[0]
+        else:
+            _list_option(options, taus, "tau")
 
     # Other asl data parameters
     for attr in ("casl", "slicedt", "sliceband"):
@@ -270,10 +751,18 @@ def basil_steps(wsp, asldata, mask=None, **kwargs):
     options.update(kwargs)
 
     # Additional optional workspace arguments
-    for attr in ("t1", "t1b", "bat", "FA", "mask", "pwm", "pgm", "batsd"):
+    if multite:
+        attrs = ("t1", "t1b", "t2", "t2b", "mask")
+    else:
+        attrs = ("t1", "t1b", "bat", "FA", "mask", "pwm", "pgm", "batsd")
+    for attr in attrs:
         value = getattr(wsp, attr)
         if value is not None:
-            options[attr] = value
+            if attr.startswith("t2"):
+                # Model expects T2 in seconds not ms
+                options[attr] = float(value) / 1000
+            else:
+                options[attr] = value
 
     # Options for final spatial step
     prior_type_spatial = "M"
@@ -286,10 +775,11 @@ def basil_steps(wsp, asldata, mask=None, **kwargs):
     }
 
     wsp.log.write("Model (in fabber) is : %s\n" % options["model"])
-    wsp.log.write("Dispersion model option is %s\n" % options["disp"])
-    wsp.log.write("Compartment exchange model option is %s\n" % options["exch"])
-    inferdisp = options["disp"] != "none"
-    inferexch = options["exch"] != "mix"
+    if not multite:
+        wsp.log.write("Dispersion model option is %s\n" % options["disp"])
+        wsp.log.write("Compartment exchange model option is %s\n" % options["exch"])
+    inferdisp = options.get("disp", "none") != "none"
+    inferexch = options.get("exch", "mix") != "mix"
 
     # Partial volume correction
     pvcorr = "pgm" in options or "pwm" in options
@@ -315,21 +805,35 @@ def basil_steps(wsp, asldata, mask=None, **kwargs):
         raise ValueError("ERROR: PV correction is not compatible with --artonly option (there is no tissue component)")
 
     # Set general parameter inference and inclusion
-    if wsp.infertiss:
-        options["inctiss"] = True
-    if wsp.inferbat:
-        options["incbat"] = True
-        options["inferbat"] = True # Infer in first step
-    if wsp.inferart:
-        options["incart"] = True
-    if wsp.inferpc:
-        options["incpc"] = True
-    if wsp.infertau:
-        options["inctau"] = True
-    if wsp.infert1:
-        options["inct1"] = True
-    if pvcorr:
-        options["incpve"] = True
+    if multite:
+        if not wsp.infertiss:
+            wsp.log.write("WARNING: infertiss=False but ftiss is always inferred in multi-TE model\n")
+        if not wsp.inferbat:
+            wsp.log.write("WARNING: inferbat=False but BAT is always inferred in multi-TE model\n")
+        if wsp.inferart:
+            wsp.log.write("WARNING: inferart=True but multi-TE model does not support arterial component\n")
+        if wsp.infertau:
+            options["infertau"] = True
+        if wsp.infert1:
+            options["infert1"] = True
+        if wsp.infert2:
+            options["infert2"] = True
+    else:
+        if wsp.infertiss:
+            options["inctiss"] = True
+        if wsp.inferbat:
+            options["incbat"] = True
+            options["inferbat"] = True # Infer in first step
+        if wsp.inferart:
+            options["incart"] = True
+        if wsp.inferpc:
+            options["incpc"] = True
+        if wsp.infertau:
+            options["inctau"] = True
+        if wsp.infert1:
+            options["inct1"] = True
+        if pvcorr:
+            options["incpve"] = True
 
     # Keep track of the number of spatial priors specified by name
     spriors = 1
@@ -343,22 +847,56 @@ def basil_steps(wsp, asldata, mask=None, **kwargs):
     if wsp.t1im:
         spriors = _add_prior(options, spriors, "T_1", type="I", image=wsp.t1im)
 
+    # Population image priors
+    pop_priors = {}
+    for param, (mean, prec) in get_pop_priors(wsp, mask).items():
+        pop_priors[param] = spriors
+        if prec is not None:
+            spriors = _add_prior(options, spriors, param, type="I", image=mean, prec=prec)
+        else:
+            spriors = _add_prior(options, spriors, param, type="I", image=mean)
+
     steps = []
     components = ""
 
+    ### --- MULTI-TE TISSUE MODULE ---
+    if multite:
+        # ftiss is always inferred in the multi-TE model
+        components += " Tissue"
+        if wsp.infertau:
+            components += " Bolus duration"
+        if wsp.infert1:
+            components += " T1"
+        if wsp.infertexch:
+            components += " Exchange time"
+            options["infertexch"] = True
+
+        step_desc = "VB - %s" % components
+        if not wsp.onestep:
+            steps.append(FabberStep(options, step_desc))
+
+        # Setup spatial priors ready. This replaces any population prior on ftiss
+        if "ftiss" in pop_priors:
+            _add_prior(options_svb, pop_priors["ftiss"], "ftiss", type=prior_type_spatial)
+        else:
+            spriors = _add_prior(options_svb, spriors, "ftiss", type=prior_type_spatial)
+
     ### --- TISSUE MODULE ---
-    if wsp.infertiss:
+    if wsp.infertiss and not multite:
         components += " Tissue "
         options["infertiss"] = True
         step_desc = "VB - %s" % components
         if not wsp.onestep:
             steps.append(FabberStep(options, step_desc))
 
-        # setup spatial priors ready
-        spriors = _add_prior(options_svb, spriors, "ftiss", type=prior_type_spatial)
+        # setup spatial priors ready. This replaces any population prior on ftiss
+        if "ftiss" in pop_priors:
+            _add_prior(options_svb, pop_priors["ftiss"], "ftiss", type=prior_type_spatial)
+        else:
+            spriors = _add_prior(options_svb, spriors, "ftiss", type=prior_type_spatial)
 
     ### --- ARTERIAL MODULE ---
-    if wsp.inferart:
+    if wsp.inferart and not multite:
         components += " Arterial "
         options["inferart"] = True
         step_desc = "VB - %s" % components
@@ -369,7 +907,7 @@ def basil_steps(wsp, asldata, mask=None, **kwargs):
         spriors = _add_prior(options_svb, spriors, "fblood", type=prior_type_mvs)
 
     ### --- BOLUS DURATION MODULE ---
-    if wsp.infertau:
+    if wsp.infertau and not multite:
         components += " Bolus duration "
         options["infertau"] = True
         step_desc = "VB - %s" % components
@@ -378,7 +916,7 @@ def basil_steps(wsp, asldata, mask=None, **kwargs):
 
     ### --- MODEL EXTENSIONS MODULE ---
     # Add variable dispersion and/or exchange parameters and/or pre-capiliary
-    if inferdisp or inferexch or wsp.inferpc:
+    if not multite and (inferdisp or inferexch or wsp.inferpc):
         if inferdisp:
             components += " dispersion"
             options["inferdisp"] = True
@@ -394,7 +932,7 @@ def basil_steps(wsp, asldata, mask=None, **kwargs):
             steps.append(FabberStep(options, step_desc))
 
     ### --- T1 MODULE ---
-    if wsp.infert1:
+    if wsp.infert1 and not multite:
         components += " T1 "
         options["infert1"] = True
         step_desc = "VB - %s" % components
@@ -419,6 +957,8 @@ def basil_steps(wsp, asldata, mask=None, **kwargs):
     ### --- SPATIAL MODULE ---
     if wsp.spatial:
         step_desc = "Spatial VB - %s" % components
+        if "ftiss" in pop_priors:
+            _remove_prior_options(options, pop_priors["ftiss"])
         options.update(options_svb)
         del options["max-trials"]
 
@@ -438,158 +978,10 @@ def basil_steps_multite(wsp, asldata, mask=None, **kwargs):
     """
     Get the steps required for a BASIL run on multi-TE data
 
-    This is separated for the case where an alternative process wants to run
-    the actual modelling, or so that the steps can be checked prior to doing
-    an actual run.
-
-    Arguments are the same as the ``basil`` function.
+    Multi-TE data is now handled by ``basil_steps`` - this is retained for
+    compatibility.
     """
-    if asldata is None:
-        raise ValueError("Input ASL data is None")
-
-    wsp.log.write("BASIL v%s\n" % __version__)
-    asldata.summary(log=wsp.log)
-    asldata = asldata.diff().reorder("rt")
-
-    # Default Fabber options for VB runs and spatial steps. Note that attributes
-    # which are None (e.g. sliceband) are not passed to Fabber
-    options = {
-        "data" : asldata,
-        "model" : "asl_multite",
-        "method" : "vb",
-        "noise" : "white",
-        "allow-bad-voxels" : True,
-        "max-iterations" : 20,
-        "convergence" : "trialmode",
-        "max-trials" : 10,
-        "save-mean" : True,
-        "save-mvn" : True,
-        "save-std" : True,
-        "save-model-fit" : True,
-    }
-
-    if mask is not None:
-        options["mask"] = mask
-
-    # We choose to pass TIs (not PLDs). The asldata object ensures that
-    # TIs are correctly derived from PLDs, when these are specified, by adding
-    # the bolus duration.
-    _list_option(options, asldata.tis, "ti")
-
-    # Pass multiple TEs
-    _list_option(options, asldata.tes, "te")
-
-    # Bolus duration must be constant for multi-TE model
-    if min(asldata.taus) != max(asldata.taus):
-        raise ValueError("Multi-TE model does not support variable bolus durations")
-    else:
-        options["tau"] = asldata.taus[0]
-
-    # Repeats must be constant for multi-TE model
-    if min(asldata.rpts) != max(asldata.rpts):
-        raise ValueError("Multi-TE model does not support variable repeats")
-    else:
-        options["repeats"] = asldata.rpts[0]
-
-    # Other asl data parameters
-    for attr in ("casl", "slicedt", "sliceband"):
-        if getattr(asldata, attr, None) is not None:
-            options[attr] = getattr(asldata, attr)
-
-    # Keyword arguments override options
-    options.update(kwargs)
-
-    # Additional optional workspace arguments
-    for attr in ("t1", "t1b", "t2", "t2b", "mask"):
-        value = getattr(wsp, attr)
-        if value is not None:
-            if attr.startswith("t2"):
-                # Model expects T2 in seconds not ms
-                options[attr] = float(value) / 1000
-            else:
-                options[attr] = value
-
-    # Options for final spatial step
-    prior_type_spatial = "M"
-    prior_type_mvs = "A"
-    options_svb = {
-        "method" : "spatialvb",
-        "param-spatial-priors" : "N+",
-        "convergence" : "maxits",
-        "max-iterations": 20,
-    }
-
-    wsp.log.write("Model (in fabber) is : %s\n" % options["model"])
-    
-    # Set general parameter inference and inclusion
-    if not wsp.infertiss:
-        wsp.log.write("WARNING: infertiss=False but ftiss is always inferred in multi-TE model\n")
-    if not wsp.inferbat:
-        wsp.log.write("WARNING: inferbat=False but BAT is always inferred in multi-TE model\n")
-    if wsp.inferart:
-        wsp.log.write("WARNING: inferart=True but multi-TE model does not support arterial component\n")
-    if wsp.infertau:
-        options["infertau"] = True
-    if wsp.infert1:
-        options["infert1"] = True
-    if wsp.infert2:
-        options["infert2"] = True
-
-    # Keep track of the number of spatial priors specified by name
-    spriors = 1
-
-    if wsp.initmvn:
-        # we are being supplied with an initial MVN
-        wsp.log.write("Initial MVN being loaded %s\n" % wsp.initmvn.name)
-        options["continue-from-mvn"] = wsp.initmvn
-
-    # T1 image prior
-    if wsp.t1im:
-        spriors = _add_prior(options, spriors, "T_1", type="I", image=wsp.t1im)
-
-    steps = []
-    components = ""
-
-    ### --- TISSUE MODULE ---
-    #if wsp.infertiss:
-    if True:
-        components += " Tissue"
-
-        ### Inference options
-        if wsp.infertau:
-            components += " Bolus duration"
-            options["infertau"] = True
-        if wsp.infert1:
-            components += " T1"
-            options["infert1"] = True
-        if wsp.infertexch:
-            components += " Exchange time"
-            options["infertexch"] = True
-
-        step_desc = "VB - %s" % components
-        if not wsp.onestep:
-            steps.append(FabberStep(options, step_desc))
-
-        # Setup spatial priors ready
-        spriors = _add_prior(options_svb, spriors, "ftiss", type=prior_type_spatial)
-
-    ### --- SPATIAL MODULE ---
-    if wsp.spatial:
-        step_desc = "Spatial VB - %s" % components
-        options.update(options_svb)
-        del options["max-trials"]
-
-        if not wsp.onestep:
-            steps.append(FabberStep(options, step_desc))
-
-    ### --- SINGLE-STEP OPTION ---
-    if wsp.onestep:
-        steps.append(FabberStep(options, step_desc))
-
-    if not steps:
-        raise ValueError("No steps were generated - no parameters were set to be inferred")
-
-    return steps
+    return basil_steps(wsp, asldata, mask, **kwargs)
 
 def _list_option(options, values, name):
     for idx, value in enumerate(values):
@@ -601,10 +993,79 @@ def _add_prior(options, prior_idx, param, **kwargs):
         options["PSP_byname%i_%s" % (prior_idx, key)] = value
     return prior_idx + 1
 
+def _remove_prior_options(options, prior_idx):
+    prefix = "PSP_byname%i_" % prior_idx
+    for key in [key for key in options if key.startswith(prefix)]:
+        del options[key]
+
+# Population prior workspace attributes and the model parameters they apply to
+POP_PRIORS = {
+    "pop_ftiss" : "ftiss",
+    "pop_delttiss" : "delttiss",
+}
+
+def _pop_prior_native(wsp, img):
+    """
+    Get a population prior map in native ASL space
+
+    Maps which are not already on the ASL data grid are assumed to be in
+    standard space and are transformed via the structural image
+    """
+    if img.sameSpace(wsp.asldata):
+        return img
+    reg.reg_struc2std(wsp)
+    return reg.struc2asl(wsp, reg.std2struc(wsp, img))
+
+def get_pop_priors(wsp, mask=None):
+    """
+    Get population image priors in native ASL space
+
+    Native space maps are stored in the ``pop_priors`` sub-workspace so
+    the registration is only done once.
+
+    :param mask: Optional mask used to summarize the population variance map
+    :return: Dictionary mapping model parameter name to tuple of (mean Image, precision).
+             The precision is None if no variance map was given
+    """
+    ret = {}
+    for attr, param in sorted(POP_PRIORS.items()):
+        if getattr(wsp, attr) is None:
+            continue
+
+        if wsp.pop_priors is None:
+            wsp.sub("pop_priors")
+        if getattr(wsp.pop_priors, param) is None:
+            wsp.log.write(" - Population prior for %s: %s\n" % (param, getattr(wsp, attr).name))
+            setattr(wsp.pop_priors, param, _pop_prior_native(wsp, getattr(wsp, attr)))
+            var = getattr(wsp, attr + "_var")
+            if var is not None:
+                setattr(wsp.pop_priors, param + "_var", _pop_prior_native(wsp, var))
+
+        mean = getattr(wsp.pop_priors, param)
+        var = getattr(wsp.pop_priors, param + "_var")
+        prec = None
+        if var is not None:
+            # Fabber image priors take a single precision so use the median variance
+            if mask is None:
+                mask = wsp.rois.mask if wsp.rois is not None else None
+            if mask is not None:
+                var_data = var.data[mask.data > 0]
+            else:
+                var_data = var.data.flatten()
+            var_data = var_data[np.isfinite(var_data) & (var_data > 0)]
+            if len(var_data) > 0:
+                prec = 1.0 / float(np.median(var_data))
+        ret[param] = (mean, prec)
+    return ret
+
 class Step(object):
     """
     A step in the Basil modelling process
     """
+
+    # Outputs of the previous step which are needed to run this step
+    requires = ("finalMVN",)
+
     def __init__(self, options, desc):
         self.options = dict(options)
         self.desc = desc
@@ -613,21 +1074,200 @@ class FabberStep(Step):
     """
     A Basil step which involves running Fabber
     """
-    def run(self, prev_output, log=sys.stdout, fsllog=None, **kwargs):
+    # Information about the last adaptive run of this step
+    adaptive_info = None
+
+    @property
+    def spatial(self):
+        """
+        True if this step uses spatial VB, in which case voxels are not fitted independently
+        """
+        return self.options.get("method", "vb") == "spatialvb"
+
+    def run(self, prev_output, log=sys.stdout, fsllog=None, cache=None, outputs=None, adaptive=None, **kwargs):
         """
         Run Fabber, initialising it from the output of a previous step
+
+        :param cache: Optional ``oxasl.cache.FabberCache`` instance. If provided, a
+                      previously cached result for identical options and input
+                      data will be returned instead of re-running Fabber
+        :param outputs: Optional sequence of output names to generate. If not specified
+                        all outputs enabled by the step options are returned
+        :param adaptive: Optional dictionary of adaptive convergence settings containing
+                         ``tol``, ``frac`` and ``block``. See ``run_adaptive``
         """
         if prev_output is not None:
             self.options["continue-from-mvn"] = prev_output["finalMVN"]
-        from .wrappers import fabber
-        ret = fabber(self.options, output=LOAD, progress_log=log, log=fsllog, **kwargs)
+
+        if adaptive:
+            return self.run_adaptive(prev_output, log=log, fsllog=fsllog, cache=cache, outputs=outputs, **dict(adaptive, **kwargs))
+
+        from .wrappers.fabber import select_outputs
+        ret = self._fabber(select_outputs(self.options, outputs), log, fsllog, cache, **kwargs)
         log.write("\n")
         return ret
 
+    def run_adaptive(self, prev_output, tol=0.1, frac=0.95, block=5, log=sys.stdout, fsllog=None, cache=None, outputs=None, **kwargs):
+        """
+        Run Fabber with adaptive convergence control
+
+        Steps which use Fabber's own voxelwise convergence (e.g. trial mode) already
+        stop each voxel when it has converged, and are run unchanged.
+
+        Steps which run a fixed number of iterations (``maxits`` convergence) are run
+        in blocks of a small number of iterations, each block being initialised from
+        the posterior of the previous block. After each block the change in free energy
+        in each voxel since the previous block is calculated, and the step stops when a
+        sufficient fraction of voxels have converged, or when the iteration limit of
+        the step is reached. Convergence is only judged between blocks of the same step
+        so at least two blocks are run unless the iteration limit is reached first.
+
+        Note that the posterior is passed between blocks but other internal state of the
+        inference (e.g. the spatial prior precision) is re-estimated at the start of each
+        block, so the result may differ slightly from a single run to the same number of
+        iterations. The ``adaptive_validate`` option of ``basil_fit`` measures this.
+
+        :param tol: Free energy change (nats) below which a voxel is considered converged
+        :param frac: Fraction of voxels which must be converged to finish the step
+        :param block: Number of iterations in each block
+        :return: Output of the final block. ``adaptive_info`` attribute is set to a
+                 dictionary describing the run
+        """
+        from .wrappers.fabber import select_outputs
+        budget = int(self.options.get("max-iterations", 10))
+        if self.options.get("convergence", "maxits") != "maxits":
+            start = time.time()
+            ret = self._fabber(select_outputs(self.options, outputs), log, fsllog, cache, **kwargs)
+            run_time = time.time() - start
+            log.write("\n - Adaptive: step uses %s convergence, run unchanged\n" % self.options["convergence"])
+            self.adaptive_info = {"iterations" : float("nan"), "budget" : budget, "blocks" : 1,
+                                  "converged_frac" : float("nan"), "fe_change" : float("nan"),
+                                  "run_time" : run_time, "overhead_time" : float("nan"), "est_full_time" : run_time}
+            return ret
+
+        options = dict(self.options)
+        options["max-iterations"] = min(block, budget)
+        options["save-mvn"] = True
+        options["save-free-energy"] = True
+        if outputs is not None:
+            outputs = list(outputs) + ["finalMVN", "freeEnergy"]
+        options = select_outputs(options, outputs)
+
+        mask = options.get("mask", None)
+        ret, prev_fe, used, nblocks = None, None, 0, 0
+        conv_frac, fe_change, run_time, overhead = float("nan"), float("nan"), 0.0, 0.0
+        while True:
+            if ret is not None:
+                options["continue-from-mvn"] = ret["finalMVN"]
+            start = time.time()
+            ret = self._fabber(options, log, fsllog, cache, **kwargs)
+            block_time = time.time() - start
+            run_time += block_time
+            # Time outside the Fabber run itself, e.g. starting the API and transferring data,
+            # is repeated for every block. Results from the cache have no run time
+            overhead += block_time - getattr(ret, "stats", {}).get("run_time", block_time)
+            used += options["max-iterations"]
+            nblocks += 1
+
+            fe = ret["freeEnergy"].data
+            if prev_fe is not None:
+                roi = np.isfinite(fe) & np.isfinite(prev_fe)
+                if mask is not None:
+                    roi &= mask.data > 0
+                change = np.abs(fe[roi] - prev_fe[roi])
+                if change.size > 0:
+                    conv_frac = float(np.count_nonzero(change < tol)) / change.size
+                    fe_change = np.median(change)
+                    if conv_frac >= frac:
+                        break
+            if used >= budget:
+                break
+            prev_fe = fe
+            options["max-iterations"] = min(block, budget - used)
+
+        # Estimate the time for a single run to the iteration limit, which would only
+        # incur the overhead once. Any initialisation inside the Fabber run is included in
+        # the time per iteration so this tends to overestimate the time saved
+        est_full_time = (run_time - overhead) * budget / used + overhead / nblocks
+        log.write("\n - Adaptive: %i iterations of %i in %i blocks, %.1f%% of voxels converged, median F change %.3g\n" % (
+            used, budget, nblocks, 100 * conv_frac, fe_change))
+        self.adaptive_info = {"iterations" : used, "budget" : budget, "blocks" : nblocks,
+                              "converged_frac" : conv_frac, "fe_change" : fe_change,
+                              "run_time" : run_time, "overhead_time" : overhead, "est_full_time" : est_full_time}
+        return ret
+
+    def _fabber(self, options, log, fsllog, cache, **kwargs):
+        """
+        Run Fabber using the results cache if available
+        """
+        from .wrappers.fabber import fabber
+        if cache is not None:
+            ret = cache.get(options)
+            if ret is not None:
+                return ret
+
+        ret = fabber(options, output=LOAD, progress_log=log, log=fsllog, **kwargs)
+        if cache is not None:
+            cache.put(options, ret)
+        return ret
+
+    def refit(self, result, status, fe_thresh=None, log=sys.stdout, fsllog=None, max_iterations=None, outputs=None, **kwargs):
+        """
+        Refit voxels which were flagged as not converged in a previous run of this step
+
+        Fabber is re-run using a mask containing only the flagged voxels with an
+        increased number of iterations (and trials, when using trial mode
+        convergence). Voxels which converge successfully in the refit replace
+        the corresponding voxels in the original output.
+
+        Refit is not supported for spatial steps as the spatial prior depends on
+        neighbouring voxels which would be excluded by the reduced mask.
+
+        :param result: Output of the original run of this step
+        :param status: Voxel status Image as returned by ``voxel_status``
+        :param fe_thresh: Free energy threshold used to flag voxels in the original run
+        :param max_iterations: Maximum number of iterations for refit. Default is
+                               twice the number used in the original run
+        :param outputs: Optional sequence of output names to generate
+        :return: Output dictionary with refitted voxels merged in
+        """
+        if self.spatial:
+            raise ValueError("Cannot refit voxels in a spatial step")
+
+        bad = status.data > VOXEL_OK
+        log.write(" - Refitting %i voxels     " % np.count_nonzero(bad))
+        options = dict(self.options)
+        options["mask"] = Image(bad.astype(np.int8), header=status.header)
+        if max_iterations is None:
+            max_iterations = 2 * int(options.get("max-iterations", 10))
+        options["max-iterations"] = max_iterations
+        if "max-trials" in options:
+            options["max-trials"] = 2 * int(options["max-trials"])
+
+        from .wrappers.fabber import fabber, select_outputs
+        options = select_outputs(options, outputs)
+        refit = fabber(options, output=LOAD, progress_log=log, log=fsllog, **kwargs)
+        log.write("\n")
+
+        refit_status, _ = voxel_status(refit, options["mask"], fe_thresh)
+        improved = bad & (refit_status.data == VOXEL_OK)
+        log.write(" - %i voxels successfully refitted\n" % np.count_nonzero(improved))
+        for key in list(result.keys()):
+            orig = result[key]
+            if isinstance(orig, Image) and key in refit:
+                data = np.copy(orig.data)
+                data[improved] = refit[key].data[improved]
+                result[key] = Image(data, header=orig.header)
+        result["logfile"] = "%s\n\nRefit of non-converged voxels\n\n%s" % (result.get("logfile", ""), refit.get("logfile", ""))
+        return result
+
 class PvcInitStep(Step):
     """
     A Basil step which initialises partial volume correction
     """
+
+    requires = ("finalMVN", "mean_ftiss")
+
     def run(self, prev_output, log=sys.stdout, fsllog=None, **kwargs):
         """
         Update the MVN from a previous step to include initial estimates
@@ -654,11 +1294,11 @@ class PvcInitStep(Step):
         wmcbf_init = Image(wmcbf_init, header=mvn.header)
 
         # load these into the MVN
-        mvn = prev_output["finalMVN"]
-        from .wrappers import mvntool
-        params = prev_output["paramnames"]
-        mvn = mvntool(mvn, params.index("ftiss")+1, output=LOAD, mask=mask, write=True, valim=gmcbf_init, var=0.1, log=fsllog)["output"]
-        mvn = mvntool(mvn, params.index("fwm")+1, output=LOAD, mask=mask, write=True, valim=wmcbf_init, var=0.1, log=fsllog)["output"]
+        from .wrappers import MVN
+        mvn = MVN(mvn, paramnames=prev_output["paramnames"])
+        mvn.update("ftiss", mean=gmcbf_init, var=0.1, mask=mask)
+        mvn.update("fwm", mean=wmcbf_init, var=0.1, mask=mask)
+        mvn = mvn.image()
         log.write("DONE\n")
         return {"finalMVN" : mvn, "gmcbf_init" : gmcbf_init, "wmcbf_init" : wmcbf_init}
 
@@ -684,6 +1324,7 @@ class BasilOptions(OptionCategory):
         group.add_option("--batsd", help="Bolus arrival time standard deviation (s) - default 1.0 for multi-PLD, 0.1 otherwise", type=float)
         group.add_option("--spatial", help="Add step that implements adaptive spatial smoothing on CBF", action="store_true", default=False)
         group.add_option("--fast", help="Faster analysis (1=faster, 2=single step", type=int, default=0)
+        group.add_option("--mean-repeats", help="Fit model to the mean over repeats at each TI/PLD and TE", action="store_true", default=False)
         group.add_option("--noiseprior", help="Use an informative prior for the noise estimation", action="store_true", default=False)
         group.add_option("--noisesd", help="Set a custom noise std. dev. for the nosie prior", type=float)
         group.add_option("--basil-options", "--fit-options", help="File containing additional options for model fitting step", type="optfile")
@@ -703,6 +1344,47 @@ class BasilOptions(OptionCategory):
         group.add_option("--t1im", help="Voxelwise T1 tissue estimates", type="image")
         groups.append(group)
 
+        group = IgnorableOptionGroup(parser, "Population prior options", ignore=self.ignore)
+        group.add_option("--pop-ftiss", help="Population mean perfusion map (standard or native space) used as a prior", type="image")
+        group.add_option("--pop-ftiss-var", help="Population perfusion variance map used to set the precision of the perfusion prior", type="image")
+        group.add_option("--pop-delttiss", help="Population mean arrival time map (standard or native space) used as a prior", type="image")
+        group.add_option("--pop-delttiss-var", help="Population arrival time variance map used to set the precision of the arrival time prior", type="image")
+        groups.append(group)
+
+        group = IgnorableOptionGroup(parser, "Cropping options", ignore=self.ignore)
+        group.add_option("--crop", help="Crop data to bounding box of mask for model fitting", action="store_true", default=False)
+        group.add_option("--crop-margin", help="Number of voxels to add around mask bounding box when cropping", type=int, default=1)
+        groups.append(group)
+
+        group = IgnorableOptionGroup(parser, "Convergence options", ignore=self.ignore)
+        group.add_option("--adaptive", help="Stop each model fitting step when a sufficient fraction of voxels have converged", action="store_true", default=False)
+        group.add_option("--adaptive-tol", help="Free energy change below which a voxel is considered converged in adaptive mode", type=float, default=0.1)
+        group.add_option("--adaptive-frac", help="Fraction of voxels which must converge to finish a step in adaptive mode", type=float, default=0.95)
+        group.add_option("--adaptive-block", help="Number of iterations between convergence checks in adaptive mode", type=int, default=5)
+        group.add_option("--adaptive-skip-tol", help="Skip an intermediate step in adaptive mode if parameter means changed by less than this fraction in the previous step", type=float, default=0.01)
+        group.add_option("--adaptive-validate", help="Re-run model fitting without adaptive convergence to measure speedup and accuracy", action="store_true", default=False)
+        group.add_option("--refit-bad-voxels", help="Refit voxels which fail to converge in each step", action="store_true", default=False)
+        group.add_option("--refit-max-iterations", help="Maximum number of iterations when refitting voxels (default: twice the original number)", type=int)
+        groups.append(group)
+
+        group = IgnorableOptionGroup(parser, "Model fitting cache options", ignore=self.ignore)
+        group.add_option("--fabber-cache", help="Re-use cached model fitting results when data and options are unchanged", action="store_true", default=False)
+        group.add_option("--fabber-cache-dir", help="Directory for cached model fitting results (default: ~/.oxasl/fabber_cache)")
+        group.add_option("--fabber-cache-size", help="Maximum size of model fitting cache in Mb", type=float)
+        groups.append(group)
+
+        group = IgnorableOptionGroup(parser, "Resampling options", ignore=self.ignore)
+        group.add_option("--bootstrap", help="Estimate parameter uncertainty from this number of bootstrap resamples over repeats", type=int)
+        group.add_option("--jackknife", help="Estimate parameter uncertainty by jackknife resampling over repeats", action="store_true", default=False)
+        group.add_option("--resample-workers", help="Number of processes used to fit resamples", type=int, default=1)
+        group.add_option("--resample-seed", help="Random seed for bootstrap resamples", type=int)
+        groups.append(group)
+
+        group = IgnorableOptionGroup(parser, "Progress reporting options", ignore=self.ignore)
+        group.add_option("--progress-file", help="File to append progress events to as JSON lines")
+        group.add_option("--progress-metrics-file", help="File to write latest progress metrics to in Prometheus text format")
+        groups.append(group)
+
         return groups
 
 def main():
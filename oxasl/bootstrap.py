@@ -0,0 +1,230 @@
+"""
+Empirical uncertainty estimation by resampling over repeats
+
+BASIL reports the standard deviation of the variational posterior for each
+parameter. This module provides an empirical alternative: the repeats of the
+ASL data are resampled (by bootstrap or jackknife), each resample is fitted
+independently and the voxelwise mean and standard deviation of the parameter
+estimates over resamples are calculated.
+
+    wsp.bootstrap = 100
+    wsp.resample_workers = 4
+    resample_fit(wsp, output_wsp=wsp.sub("resample"))
+    wsp.resample.std_ftiss.save("std_ftiss.nii.gz")
+
+Resamples are generated as arrays of volume indices into the differenced
+data so only the data for resamples currently being fitted is held in memory.
+When more than one worker is used, resamples are fitted in a pool of processes
+which share the original data with the parent process. This requires the
+``fork`` process start method, otherwise resamples are fitted serially.
+
+Copyright (c) 2008-2018 University of Oxford
+"""
+import multiprocessing
+from multiprocessing.util import Finalize
+
+import six
+import numpy as np
+
+from fsl.data.image import Image
+
+from oxasl import basil, crop
+from oxasl.progress import get_progress
+from oxasl.wrappers.fabber import reset_workers, clear_workers
+
+def resample_indices(rpts, method="bootstrap", nsamples=100, seed=None):
+    """
+    Generate resamples of the repeats of ASL data as volume index arrays
+
+    The data is assumed to be differenced and ordered with the repeats of
+    each TI/PLD together (i.e. ``rt`` order). Bootstrap resamples draw the repeats
+    of each TI with replacement. Jackknife resamples leave out a single repeat
+    from each TI which has more than one repeat, giving one resample for each
+    repeat.
+
+    :param rpts: Sequence of the number of repeats at each TI
+    :param method: ``bootstrap`` or ``jackknife``
+    :param nsamples: Number of bootstrap resamples. Ignored for jackknife
+    :param seed: Optional random seed for bootstrap resamples
+    :return: Generator yielding tuples of (volume index array, repeats at each TI)
+    """
+    starts = np.cumsum([0,] + list(rpts))[:-1]
+    if method == "bootstrap":
+        rng = np.random.RandomState(seed)
+        for _ in range(nsamples):
+            indices = [start + rng.randint(0, nrpts, nrpts) for start, nrpts in zip(starts, rpts)]
+            yield np.concatenate(indices), list(rpts)
+    elif method == "jackknife":
+        for left_out in range(max(rpts)):
+            indices, sample_rpts = [], []
+            for start, nrpts in zip(starts, rpts):
+                keep = np.arange(nrpts)
+                if nrpts > 1 and left_out < nrpts:
+                    keep = keep[keep != left_out]
+                indices.append(start + keep)
+                sample_rpts.append(len(keep))
+            yield np.concatenate(indices), sample_rpts
+    else:
+        raise ValueError("Unknown resampling method: %s" % method)
+
+def resample_data(asldata, indices, rpts):
+    """
+    Get the ASL data for a resample
+
+    :param asldata: Differenced AslImage in ``rt`` order
+    :param indices: Volume index array as returned by ``resample_indices``
+    :param rpts: Repeats at each TI as returned by ``resample_indices``
+    :return: AslImage containing the resampled data
+    """
+    data = asldata.data
+    if data.ndim == 3:
+        data = data[..., np.newaxis]
+    return asldata.derived(data[..., indices], suffix="_resample", rpts=rpts)
+
+# Model fitting steps used by resample fitting processes. These are set before
+# the process pool is created so they are shared with the child processes
+# rather than being copied for every resample
+_STEPS = []
+
+def _init_process():
+    # Fabber workers inherited from the parent process belong to it
+    reset_workers()
+    Finalize(None, clear_workers, exitpriority=10)
+
+def _fit_resample(sample):
+    """
+    Fit a single resample
+
+    :param sample: Tuple of (volume index array, repeats at each TI)
+    :return: Dictionary of parameter name : mean parameter estimate array
+    """
+    indices, rpts = sample
+    asldata = resample_data(_STEPS[0].options["data"], indices, rpts)
+    log = six.StringIO()
+    result = None
+    for idx, step in enumerate(_STEPS):
+        options = dict(step.options)
+        options["data"] = asldata
+        for ti_idx, nrpts in enumerate(rpts):
+            if "rpt%i" % (ti_idx+1) in options:
+                options["rpt%i" % (ti_idx+1)] = nrpts
+
+        if idx < len(_STEPS) - 1:
+            outputs = list(_STEPS[idx+1].requires)
+        else:
+            outputs = ["mean_*"]
+        result = type(step)(options, step.desc).run(result, log=log, outputs=outputs)
+
+    return dict([(key[5:], np.asarray(value.data, dtype=np.float32)) for key, value in result.items()
+                 if key.startswith("mean_") and isinstance(value, Image)])
+
+def _map_resamples(samples, nworkers):
+    """
+    :return: Iterator over the fitted results of a sequence of resamples, in
+             order of completion
+    """
+    if nworkers > 1 and "fork" in multiprocessing.get_all_start_methods():
+        pool = multiprocessing.get_context("fork").Pool(nworkers, initializer=_init_process)
+        try:
+            for result in pool.imap_unordered(_fit_resample, samples):
+                yield result
+            pool.close()
+        except:
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+    else:
+        for sample in samples:
+            yield _fit_resample(sample)
+
+def resample_fit(wsp, output_wsp=None):
+    """
+    Estimate the uncertainty of model parameters by resampling over repeats
+
+    Required workspace attributes
+    -----------------------------
+
+     - ``asldata`` : AslImage object
+     - ``bootstrap`` : Number of bootstrap resamples, or
+     - ``jackknife`` : If True, use jackknife resampling (one resample per repeat)
+
+    Optional workspace attributes
+    -----------------------------
+
+     - ``resample_workers`` : Number of processes used to fit resamples (default: 1)
+     - ``resample_seed`` : Random seed for bootstrap resamples
+
+    Other workspace attributes are used as for ``basil.basil``
+
+    Workspace attributes updated
+    ----------------------------
+
+     - ``output_wsp.mean_<param>`` : Voxelwise mean of parameter estimates over resamples
+     - ``output_wsp.std_<param>`` : Voxelwise standard deviation of parameter estimates
+     - ``output_wsp.nsamples`` : Number of resamples fitted
+    """
+    if output_wsp is None:
+        output_wsp = wsp.sub("resample")
+
+    if wsp.jackknife:
+        method, nsamples = "jackknife", max(wsp.asldata.rpts)
+    elif wsp.bootstrap:
+        method, nsamples = "bootstrap", int(wsp.bootstrap)
+    else:
+        raise ValueError("No resampling method specified")
+
+    if wsp.asldata.ntes > 1:
+        raise ValueError("Resampling over repeats is not supported for multi-TE data")
+    if max(wsp.asldata.rpts) < 2:
+        raise ValueError("Resampling requires more than one repeat")
+    if wsp.mean_repeats:
+        raise ValueError("Resampling over repeats is not compatible with fitting to the mean over repeats")
+
+    nworkers = wsp.ifnone("resample_workers", 1)
+    wsp.log.write("\nEstimating parameter uncertainty using %s with %i resamples and %i workers\n" % (method, nsamples, nworkers))
+
+    mask = wsp.rois.mask
+    steps = basil.basil_steps(wsp, wsp.asldata, mask, **wsp.ifnone("basil_options", {}))
+    bbox = None
+    if wsp.crop and mask is not None:
+        bbox = crop.get_bbox(mask, wsp.ifnone("crop_margin", 1))
+        cropped = {}
+        for step in steps:
+            step.options = crop.crop_options(step.options, bbox, mask.shape, cropped)
+
+    # Running mean and sum of squared deviations (Welford) so the resample
+    # results do not need to be kept
+    count, means, sumsq = 0, {}, {}
+    stage = get_progress(wsp).stage("basil_%s" % method, nsteps=nsamples)
+    stage.start()
+    _STEPS[:] = steps
+    try:
+        samples = resample_indices(wsp.asldata.rpts, method, nsamples, wsp.resample_seed)
+        for result in _map_resamples(samples, nworkers):
+            count += 1
+            stage.step(count, "Resample %i of %i" % (count, nsamples))
+            for param, data in result.items():
+                if param not in means:
+                    means[param] = np.zeros(data.shape, dtype=np.float64)
+                    sumsq[param] = np.zeros(data.shape, dtype=np.float64)
+                delta = data - means[param]
+                means[param] += delta / count
+                sumsq[param] += delta * (data - means[param])
+    finally:
+        _STEPS[:] = []
+    stage.finish()
+
+    if method == "jackknife":
+        scale = float(count - 1) / count
+    else:
+        scale = 1.0 / max(count - 1, 1)
+
+    ref = steps[0].options["data"]
+    for param in sorted(means.keys()):
+        mean_img = Image(means[param].astype(np.float32), header=ref.header)
+        std_img = Image(np.sqrt(scale * sumsq[param]).astype(np.float32), header=ref.header)
+        setattr(output_wsp, "mean_%s" % param, crop.uncrop_image(mean_img, bbox, mask))
+        setattr(output_wsp, "std_%s" % param, crop.uncrop_image(std_img, bbox, mask))
+    output_wsp.nsamples = count
+    wsp.log.write(" - %i resamples fitted\n" % count)
@@ -0,0 +1,315 @@
+#!/usr/bin/env python
+"""
+Persistent on-disk cache of Fabber model fitting results
+
+Running Fabber is by far the most expensive part of an oxasl analysis, and it is
+common to re-run the same subject with only calibration or output options
+changed. In this case the model fitting steps are identical and their output
+can be re-used.
+
+Each cache entry is keyed by a hash of the complete Fabber options dictionary.
+Image inputs (data, mask, PV maps, initial MVN, etc) are hashed by content
+rather than identity so an entry will be found regardless of where the
+image was loaded from. The oxasl version and the Fabber core and model
+libraries in use are also included in the key so results are not re-used
+after either is upgraded.
+
+The cache is a directory (by default ``~/.oxasl/fabber_cache``, can be overridden
+by setting the ``OXASL_FABBER_CACHE`` environment variable) containing one
+subdirectory per entry. When the total size of the cache exceeds the maximum
+size, the least recently used entries are removed.
+
+    cache = FabberCache()
+    ret = cache.get(options)
+    if ret is None:
+        ret = fabber(options, output=LOAD)
+        cache.put(options, ret)
+
+The ``oxasl_fabber_cache`` command line tool can be used to inspect or clear
+the cache.
+
+Copyright (c) 2008-2018 University of Oxford
+"""
+import os
+import sys
+import glob
+import shutil
+import hashlib
+import time
+from optparse import OptionParser
+
+import six
+import numpy as np
+import nibabel as nib
+import yaml
+
+from fsl.data.image import Image
+
+from fabber import find_fabber
+
+from oxasl import __version__
+from oxasl.wrappers.fabber import _Results
+
+DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser("~"), ".oxasl", "fabber_cache")
+DEFAULT_MAX_SIZE = 2 * 1024 * 1024 * 1024
+
+def _hash_array(arr, hasher):
+    arr = np.ascontiguousarray(arr)
+    hasher.update(str(arr.dtype).encode("utf-8"))
+    hasher.update(str(arr.shape).encode("utf-8"))
+    hasher.update(arr.tobytes())
+
+def _hash_value(value, hasher):
+    """
+    Update a hash object with the content of an option value
+    """
+    if isinstance(value, Image):
+        _hash_array(value.data, hasher)
+        _hash_array(value.voxToWorldMat, hasher)
+    elif isinstance(value, nib.Nifti1Image):
+        _hash_array(np.asanyarray(value.dataobj), hasher)
+        _hash_array(value.affine, hasher)
+    elif isinstance(value, np.ndarray):
+        _hash_array(value, hasher)
+    elif isinstance(value, six.string_types) and os.path.isfile(value):
+        with open(value, "rb") as infile:
+            for chunk in iter(lambda: infile.read(1024*1024), b""):
+                hasher.update(chunk)
+    else:
+        hasher.update(repr(value).encode("utf-8"))
+
+def fabber_version(search_dirs=()):
+    """
+    Get a string identifying the Fabber installation in use
+
+    The Fabber API does not report library versions so each library and
+    executable is identified by its name, size and modification time.
+
+    :param search_dirs: Extra search directories for Fabber libraries and executables
+    :return: Version string
+    """
+    core_lib, core_exe, model_libs, model_exes = find_fabber(*search_dirs)
+    files = [core_lib, core_exe] + sorted(model_libs.values()) + sorted(model_exes.values())
+    ret = []
+    for fname in files:
+        if fname is not None and os.path.isfile(fname):
+            stat = os.stat(fname)
+            ret.append("%s:%i:%i" % (os.path.basename(fname), stat.st_size, int(stat.st_mtime)))
+    return ";".join(ret)
+
+def options_hash(options, version=None):
+    """
+    Get a hash string for a set of Fabber options
+
+    :param options: Fabber options dictionary. Image values are hashed by content
+    :param version: Fabber version string as returned by ``fabber_version``. If not
+                    specified, the Fabber installation found in the default locations is used
+    :return: Hex digest string
+    """
+    if version is None:
+        version = fabber_version()
+    hasher = hashlib.sha1()
+    hasher.update(__version__.encode("utf-8"))
+    hasher.update(version.encode("utf-8"))
+    for key in sorted(options.keys()):
+        hasher.update(key.encode("utf-8"))
+        _hash_value(options[key], hasher)
+    return hasher.hexdigest()
+
+def _dir_size(dirname):
+    return sum([os.path.getsize(fname) for fname in glob.glob(os.path.join(dirname, "*"))])
+
+class FabberCache(object):
+    """
+    Directory-based cache of Fabber run results
+    """
+
+    def __init__(self, cachedir=None, max_size=None, log=None, search_dirs=()):
+        """
+        :param cachedir: Cache directory. If not specified use ``OXASL_FABBER_CACHE``
+                         environment variable or ``~/.oxasl/fabber_cache``
+        :param max_size: Maximum size of the cache in bytes
+        :param log: Optional stream for logging cache activity
+        :param search_dirs: Extra search directories for Fabber libraries and executables
+        """
+        if cachedir is None:
+            cachedir = os.environ.get("OXASL_FABBER_CACHE", DEFAULT_CACHE_DIR)
+        self.cachedir = os.path.abspath(cachedir)
+        if max_size is None:
+            max_size = DEFAULT_MAX_SIZE
+        self.max_size = max_size
+        self.log = log
+        self.fabber_version = fabber_version(search_dirs)
+        if not os.path.exists(self.cachedir):
+            os.makedirs(self.cachedir)
+
+    def _write_log(self, text):
+        if self.log is not None:
+            self.log.write(text)
+
+    def get(self, options):
+        """
+        Look up a cached Fabber result
+
+        :param options: Fabber options dictionary
+        :return: ``_Results`` dictionary as returned by the ``fabber`` wrapper,
+                 or None if not found in the cache
+        """
+        key = options_hash(options, self.fabber_version)
+        entry_dir = os.path.join(self.cachedir, key)
+        mdfile = os.path.join(entry_dir, "_cache.yml")
+        if not os.path.isfile(mdfile):
+            return None
+
+        try:
+            with open(mdfile, "r") as infile:
+                md = yaml.safe_load(infile)
+
+            ret = _Results(md.get("output", []))
+            for name in md.get("images", []):
+                img = Image(os.path.join(entry_dir, name), loadData=True)
+                # Make sure data is in memory in case entry is evicted while in use
+                img.data
+                ret[name] = img
+            for name, value in md.get("items", {}).items():
+                ret[name] = value
+        except Exception as exc:
+            self._write_log("WARNING: Failed to load cached Fabber result %s: %s\n" % (key, exc))
+            return None
+
+        # Update access time for LRU eviction
+        os.utime(entry_dir, None)
+        self._write_log(" - Using cached Fabber result: %s\n" % key)
+        return ret
+
+    def put(self, options, results):
+        """
+        Store a Fabber result in the cache
+
+        :param options: Fabber options dictionary used to generate the result
+        :param results: ``_Results`` dictionary as returned by the ``fabber`` wrapper
+        """
+        key = options_hash(options, self.fabber_version)
+        entry_dir = os.path.join(self.cachedir, key)
+        if os.path.exists(entry_dir):
+            return
+
+        tmpdir = "%s.tmp%i" % (entry_dir, os.getpid())
+        try:
+            os.makedirs(tmpdir)
+            md = {"images" : [], "items" : {}, "output" : [],
+                  "oxasl_version" : __version__, "fabber_version" : self.fabber_version, "created" : time.strftime("%Y-%m-%d %H:%M:%S"),
+                  "model" : str(options.get("model", "")), "method" : str(options.get("method", ""))}
+            for name, value in results.items():
+                if isinstance(value, Image):
+                    value.save(os.path.join(tmpdir, name + ".nii.gz"))
+                    md["images"].append(name)
+                elif isinstance(value, (six.string_types, int, float, list)):
+                    md["items"][name] = value
+            md["output"] = [str(item) for item in results.output if isinstance(item, six.string_types)]
+
+            with open(os.path.join(tmpdir, "_cache.yml"), "w") as outfile:
+                yaml.safe_dump(md, outfile, default_flow_style=False)
+            os.rename(tmpdir, entry_dir)
+        except (IOError, OSError) as exc:
+            self._write_log("WARNING: Failed to cache Fabber result: %s\n" % exc)
+        finally:
+            if os.path.exists(tmpdir):
+                shutil.rmtree(tmpdir)
+
+        self.evict()
+
+    def entries(self):
+        """
+        :return: List of tuples of key, size in bytes, last access time and metadata
+                 dictionary for each cache entry, most recently used first
+        """
+        ret = []
+        for entry_dir in glob.glob(os.path.join(self.cachedir, "*")):
+            mdfile = os.path.join(entry_dir, "_cache.yml")
+            if not os.path.isfile(mdfile):
+                continue
+            with open(mdfile, "r") as infile:
+                md = yaml.safe_load(infile)
+            ret.append((os.path.basename(entry_dir), _dir_size(entry_dir), os.path.getmtime(entry_dir), md))
+        return sorted(ret, key=lambda entry: entry[2], reverse=True)
+
+    def size(self):
+        """
+        :return: Total size of cache entries in bytes
+        """
+        return sum([entry[1] for entry in self.entries()])
+
+    def evict(self, max_size=None):
+        """
+        Remove least recently used entries until the cache is within its maximum size
+
+        :param max_size: Size limit in bytes. If not specified, the cache's configured maximum is used
+        :return: Number of entries removed
+        """
+        if max_size is None:
+            max_size = self.max_size
+
+        total, removed = 0, 0
+        for key, size, _, _ in self.entries():
+            total += size
+            if total > max_size:
+                shutil.rmtree(os.path.join(self.cachedir, key), ignore_errors=True)
+                removed += 1
+        return removed
+
+    def clear(self):
+        """
+        Remove all entries from the cache
+
+        :return: Number of entries removed
+        """
+        return self.evict(max_size=0)
+
+def get_cache(wsp):
+    """
+    Get the Fabber cache configured for a workspace
+
+    :return: ``FabberCache`` instance if caching is enabled by the ``fabber_cache``
+             workspace attribute, otherwise None
+    """
+    if not wsp.fabber_cache:
+        return None
+
+    max_size = wsp.fabber_cache_size
+    if max_size is not None:
+        max_size = int(max_size * 1024 * 1024)
+    return FabberCache(wsp.fabber_cache_dir, max_size=max_size, log=wsp.log, search_dirs=wsp.ifnone("fabber_dirs", ()))
+
+def main():
+    """
+    Entry point for oxasl_fabber_cache command line tool
+    """
+    parser = OptionParser(usage="oxasl_fabber_cache [options] <list|clear|evict>", version=__version__)
+    parser.add_option("--cache-dir", help="Cache directory (default: $OXASL_FABBER_CACHE or %s)" % DEFAULT_CACHE_DIR)
+    parser.add_option("--max-size", help="Maximum cache size in Mb for 'evict' command", type=float)
+    options, args = parser.parse_args()
+
+    if len(args) != 1 or args[0] not in ("list", "clear", "evict"):
+        parser.print_help()
+        sys.exit(1)
+
+    cache = FabberCache(options.cache_dir)
+    if args[0] == "list":
+        entries = cache.entries()
+        sys.stdout.write("Fabber cache: %s\n" % cache.cachedir)
+        for key, size, atime, md in entries:
+            sys.stdout.write("%s %8.1f Mb  last used %s  model=%s method=%s\n" % (
+                key, float(size) / (1024 * 1024), time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(atime)),
+                md.get("model", ""), md.get("method", "")))
+        sys.stdout.write("%i entries, total size %.1f Mb\n" % (len(entries), float(sum([e[1] for e in entries])) / (1024 * 1024)))
+    elif args[0] == "clear":
+        sys.stdout.write("Removed %i entries\n" % cache.clear())
+    else:
+        max_size = None
+        if options.max_size is not None:
+            max_size = int(options.max_size * 1024 * 1024)
+        sys.stdout.write("Removed %i entries\n" % cache.evict(max_size))
+
+if __name__ == "__main__":
+    main()
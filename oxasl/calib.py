@@ -8,17 +8,17 @@ Copyright (c) 2008-2013 Univerisity of Oxford
 """
 
 import sys
-import os
 import math
+import hashlib
 import traceback
 
+import six
 import numpy as np
 import scipy.ndimage
 
 from fsl.data.image import Image
-from fsl.data.atlases import AtlasRegistry
 
-from oxasl import Workspace, struc, reg
+from oxasl import Workspace, struc, reg, crop, stdcache
 from oxasl.image import summary
 from oxasl.options import AslOptionParser, OptionCategory, IgnorableOptionGroup, GenericOptions
 from oxasl.reporting import LightboxImage
@@ -38,8 +38,9 @@ def calculate_m0(wsp):
     -----------------------------
 
      - ``calib`` : Image containing voxelwise M0 map
-     - ``calib_method`` : ``voxelwise`` or ``refregion``. Voxelwise calibration calibrates each voxel separately using
-                          the corresponding voxel in the M0 map. Reference region calibration determines a single M0
+     - ``calib_method`` : ``voxelwise``, ``quantitative`` or ``refregion``. Voxelwise calibration calibrates each voxel
+                          separately using the corresponding voxel in the M0 map. Quantitative calibration is voxelwise
+                          calibration using the tissue properties of each voxel. Reference region calibration determines a single M0
                           value for the entire image by averaging over a region of the calibration image corresponding
                           to a known tissue type (e.g. CSF).
 
@@ -48,8 +49,8 @@ def calculate_m0(wsp):
 
      - ``calib_gain`` : Calibration gain (default 1.0)
 
-    Additional optional and mandatory attributes may be required for different methods - see :ref get_m0_voxelwise:
-    and :ref get_m0_refregion: functions for details.
+    Additional optional and mandatory attributes may be required for different methods - see :ref get_m0_voxelwise:,
+    :ref get_m0_quantitative: and :ref get_m0_refregion: functions for details.
 
     Workspace attributes updated
     -----------------------------
@@ -62,8 +63,10 @@ def calculate_m0(wsp):
         wsp.log.write("\nCalibration - calculating M0\n")
         if wsp.calib_method in ("voxel", "voxelwise"):
             wsp.calibration.m0 = get_m0_voxelwise(wsp)
+        elif wsp.calib_method == "quantitative":
+            wsp.calibration.m0 = get_m0_quantitative(wsp)
         elif wsp.calib_method in ("refregion", "single"):
-            wsp.calibration.m0 = get_m0_refregion(wsp)
+            wsp.calibration.m0 = get_m0_refregion(wsp, mode=wsp.ifnone("mode", "longtr"))
         elif wsp.calib_method == "wholebrain":
             wsp.calibration.m0 = get_m0_wholebrain(wsp)
         else:
@@ -94,33 +97,62 @@ def calibrate(wsp, perf_img, multiplier=1.0, alpha=1.0, var=False):
     init(wsp)
     calculate_m0(wsp)
     wsp.log.write("\nCalibrating perfusion data: %s\n" % perf_img.name)
+    factor = get_calibration_factor(wsp, multiplier=multiplier, alpha=alpha, var=var)
+    if isinstance(factor, np.ndarray) and perf_img.ndim > factor.ndim:
+        factor = factor.reshape(list(factor.shape) + [1] * (perf_img.ndim - factor.ndim))
+    calibrated = perf_img.data * factor
+
+    perf_calib = Image(calibrated, name=perf_img.name + "_calib", header=perf_img.header)
+    return perf_calib
+
+def get_calibration_factor(wsp, multiplier=1.0, alpha=1.0, var=False):
+    """
+    Get the factor which converts perfusion data into calibrated units
+
+    This allows the same calibration to be applied to multiple images without
+    repeating the M0 calculation or the voxelwise division.
+
+    :param wsp: Workspace object
+    :param multiplier: Scalar multiple to convert output to physical units
+    :param alpha: Inversion efficiency
+    :param var: If True, return the factor for calibrating variances
+
+    :return: Scalar or voxelwise array such that calibrated data = data * factor. If
+             M0 is voxelwise the factor is zero where M0 is zero
+
+    Required workspace attributes
+    -----------------------------
+
+     - ``calibration.m0`` : M0 single value or voxelwise Image
+    """
+    if not wsp.calib:
+        raise ValueError("No calibration data supplied")
+
+    init(wsp)
+    calculate_m0(wsp)
     m0 = wsp.calibration.m0
     if isinstance(m0, Image):
         m0 = m0.data
 
-    if var:
-        wsp.log.write(" - Treating data as variance - squaring M0 correction, multiplier and inversion efficiency\n")
-        m0 = m0**2
-        multiplier = multiplier**2
-        alpha = alpha**2
-
     if isinstance(m0, np.ndarray):
         # If M0 is zero, make calibrated data zero
-        calibrated = np.zeros(perf_img.shape)
-        calibrated[m0 > 0] = perf_img.data[m0 > 0] / m0[m0 > 0]
+        factor = np.zeros(m0.shape, dtype=np.float64)
+        np.divide(1.0, m0, out=factor, where=m0 > 0)
     else:
-        calibrated = perf_img.data / m0
+        factor = 1.0 / m0
 
     if alpha != 1.0:
         wsp.log.write(" - Using inversion efficiency correction: %f\n" % alpha)
-        calibrated /= alpha
+        factor /= alpha
 
     if multiplier != 1.0:
         wsp.log.write(" - Using multiplier for physical units: %f\n" % multiplier)
-        calibrated *= multiplier
+        factor *= multiplier
 
-    perf_calib = Image(calibrated, name=perf_img.name + "_calib", header=perf_img.header)
-    return perf_calib
+    if var:
+        wsp.log.write(" - Treating data as variance - squaring M0 correction, multiplier and inversion efficiency\n")
+        factor = np.square(factor)
+    return factor
 
 def get_m0_voxelwise(wsp):
     """
@@ -143,6 +175,8 @@ def get_m0_voxelwise(wsp):
      - ``pct`` : Partition coefficient used to convert M0 tissue into M0 arterial (default 0.9)
      - ``mask`` : Brain mask in calibration image space
      - ``calib_edgecorr`` : If True, and mask provided, apply edge correction
+     - ``calib_edgecorr_3d`` : If True, extrapolate M0 for edge correction using a 3D
+                               neighbourhood rather than slicewise
     """
     wsp.log.write(" - Doing voxelwise calibration\n")
     gain, pct = wsp.ifnone("calib_gain", 1), wsp.ifnone("pct", 0.9)
@@ -167,7 +201,7 @@ def get_m0_voxelwise(wsp):
     if wsp.rois is not None and wsp.rois.mask is not None:
         if wsp.ifnone("calib_edgecorr", True):
             wsp.log.write(" - Doing edge correction\n")
-            m0 = _edge_correct(m0, wsp.rois.mask)
+            m0 = _edge_correct(m0, wsp.rois.mask, kernel_3d=wsp.calib_edgecorr_3d)
         wsp.log.write(" - Masking M0 image")
         m0[wsp.rois.mask.data == 0] = 0
 
@@ -201,11 +235,207 @@ def get_m0_voxelwise(wsp):
 
     return m0img
 
-def _edge_correct(m0, brain_mask):
+def _get_pves_calib(wsp):
+    """
+    :return: Sequence of CSF, GM and WM partial volume arrays in calibration image
+             space, or None if no partial volume estimates are available
+    """
+    if wsp.pvgm is not None and wsp.pvwm is not None:
+        wsp.log.write(" - Using user-supplied GM/WM PV estimates\n")
+        pvgm, pvwm = wsp.pvgm.data, wsp.pvwm.data
+        return np.clip(1 - pvgm - pvwm, 0, 1), pvgm, pvwm
+    elif wsp.structural is not None and wsp.structural.struc is not None:
+        wsp.log.write(" - Using PV estimates from structural image segmentation\n")
+        return [pve.data for pve in struc.get_pves_asl(wsp)]
+    else:
+        return None
+
+def _m0_corr_key(values, arrays):
+    """
+    :param values: Tuple of scalar inputs
+    :param arrays: Sequence of Numpy arrays (or None) used as inputs
+    :return: Hash string identifying the inputs to the tissue correction factor map
+    """
+    hasher = hashlib.sha1()
+    hasher.update(repr(values).encode("utf-8"))
+    for arr in arrays:
+        if arr is None:
+            hasher.update(b"None")
+        else:
+            arr = np.ascontiguousarray(arr)
+            hasher.update(repr((str(arr.dtype), arr.shape)).encode("utf-8"))
+            hasher.update(arr.tobytes())
+    return hasher.hexdigest()
+
+def get_m0_quantitative(wsp):
+    """
+    Calculate M0 value using quantitative voxelwise calibration
+
+    Each voxel of the calibration image is corrected for T1 recovery and T2 decay,
+    and converted from M0 tissue to M0 arterial, using the tissue T1, T2 and
+    partition coefficient at that voxel. These are taken from T1/T2 maps where
+    provided, otherwise they are the partial volume weighted mean of the default
+    values for CSF, GM and WM.
+
+    The tissue correction factor map depends only on the tissue properties and
+    sequence timings, so it is stored in the workspace and reused until any of
+    these change. Calibration gain and sensitivity correction are applied
+    separately so they can be changed without recalculating it.
+
+    :param wsp: Workspace object
+    :return: Image containing voxelwise M0 map
+
+    Required workspace attributes
+    -----------------------------
+
+     - ``calib`` : Image containing calibration data
+
+    Optional workspace attributes
+    -----------------------------
+
+     - ``calib_gain`` : Calibration gain (default 1.0)
+     - ``tr`` : Sequence TR (s) (default 3.2)
+     - ``taq`` : Readout time (s) (default 0)
+     - ``te`` : Sequence TE (ms) (default 0)
+     - ``calib_t1map`` : Image containing tissue T1 (s) in calibration image space
+     - ``calib_t2map`` : Image containing tissue T2 or T2* (ms) in calibration image space
+     - ``t2star`` : If True, correct for T2* rather than T2 (i.e. use T2* defaults not T2 defaults)
+     - ``t2b`` : Blood T2 (ms) (default 150, or 50 for T2*)
+     - ``pvgm``, ``pvwm`` : GM and WM partial volume estimates in calibration image space. If
+                            not provided, the segmentation of the structural image is used if available
+     - ``t1`` : Tissue T1 (s) used if no partial volume estimates are available (default GM T1)
+     - ``pct`` : Partition coefficient used if no partial volume estimates are available (default 0.9)
+     - ``sens`` : Sensitivity image
+     - ``mask`` : Brain mask in calibration image space
+     - ``calib_edgecorr`` : If True, and mask provided, apply edge correction
+     - ``calib_edgecorr_3d`` : If True, extrapolate M0 for edge correction using a 3D
+                               neighbourhood rather than slicewise
+
+    Workspace attributes updated
+    ----------------------------
+
+     - ``calibration.m0_corr`` : Image containing the voxelwise T1, T2 and partition
+                                 coefficient correction factor
+     - ``calibration.m0_corr_key`` : Hash of the inputs used to calculate ``m0_corr``
+    """
+    wsp.log.write(" - Doing quantitative voxelwise calibration\n")
+    gain = wsp.ifnone("calib_gain", 1)
+    tr, taq, te = wsp.ifnone("tr", 3.2), wsp.ifnone("taq", 0), wsp.ifnone("te", 0)
+    t2star = wsp.ifnone("t2star", False)
+    if t2star:
+        t2b = wsp.ifnone("t2sb", 50)
+    else:
+        t2b = wsp.ifnone("t2b", 150)
+    wsp.log.write(" - Calibration gain: %f\n" % gain)
+    wsp.log.write(" - Using TE=%f, TR=%f, Readout time (TAQ)=%f, T2b=%f\n" % (te, tr, taq, t2b))
+
+    # Recalculate the tissue correction factor if any of its inputs have changed
+    t1r, t2r, t2sr, _ = tissue_defaults("gm")
+    t1_default, pct_default = wsp.ifnone("t1", t1r), wsp.ifnone("pct", 0.9)
+    pves = _get_pves_calib(wsp)
+    t1map, t2map = wsp.calib_t1map, wsp.calib_t2map
+    key = _m0_corr_key((te, tr, taq, t2b, t2star, t1_default, pct_default, wsp.calib.shape[:3], pves is None),
+                       [img.data if img is not None else None for img in (t1map, t2map)] + list(pves or []))
+    if wsp.calibration.m0_corr is None or wsp.calibration.m0_corr_key != key:
+        # Tissue properties for each voxel as T1, T2 and PC arrays
+        shape = list(wsp.calib.shape[:3])
+        if pves is None:
+            wsp.log.write(" - No PV estimates available - using GM tissue properties\n")
+            props = np.array([[t1_default, t2sr if t2star else t2r, pct_default]], dtype=np.float32)
+            weights = np.ones([1] + shape, dtype=np.float32)
+        else:
+            props = np.array([tissue_defaults(tiss_type) for tiss_type in struc.PVE_TISSUES], dtype=np.float32)
+            props = props[:, [0, 2 if t2star else 1, 3]]
+            weights = np.stack(pves).astype(np.float32)
+            total = np.sum(weights, axis=0)
+            # Voxels without any tissue get GM properties
+            notiss = total <= 0
+            weights[list(struc.PVE_TISSUES).index("gm"), notiss] = 1
+            total[notiss] = 1
+            weights /= total
+        t1, t2, pct = np.tensordot(props.T, weights, axes=1)
+
+        if t1map is not None:
+            wsp.log.write(" - Using tissue T1 map: %s\n" % t1map.name)
+            t1 = np.where(t1map.data > 0, t1map.data, t1).astype(np.float32)
+        if t2map is not None:
+            wsp.log.write(" - Using tissue T2 map: %s\n" % t2map.name)
+            t2 = np.where(t2map.data > 0, t2map.data, t2).astype(np.float32)
+
+        # Short TR, T2 and partition coefficient corrections in a single expression
+        corr = math.exp(-te / t2b) * np.exp(te / t2) / ((1 - np.exp(-(tr - taq) / t1)) * pct)
+        wsp.calibration.m0_corr = Image(corr.astype(np.float32), header=wsp.calib.header)
+        wsp.calibration.m0_corr_key = key
+
+    m0 = wsp.calib.data.astype(np.float32)
+    m0 *= wsp.calibration.m0_corr.data
+    m0 *= gain
+    if wsp.sens:
+        wsp.log.write(" - Using sensitivity image: %s\n" % wsp.sens.name)
+        m0 /= wsp.sens.data
+
+    if wsp.rois is not None and wsp.rois.mask is not None:
+        if wsp.ifnone("calib_edgecorr", True):
+            wsp.log.write(" - Doing edge correction\n")
+            m0 = _edge_correct(m0, wsp.rois.mask, kernel_3d=wsp.calib_edgecorr_3d)
+        wsp.log.write(" - Masking M0 image\n")
+        m0[wsp.rois.mask.data == 0] = 0
+
+    m0img = Image(m0, header=wsp.calib.header)
+    wsp.log.write(" - Mean M0: %f\n" % np.mean(m0))
+
+    # Reporting
+    page = wsp.report.page("m0")
+    page.heading("Quantitative voxelwise M0 calculation")
+    page.text("Quantitative voxelwise calibration calculates an M0 value for each voxel from the calibration image using the T1, T2 and partition coefficient of the tissue in that voxel")
+    page.heading("Correction factors", level=1)
+    table = []
+    table.append(["Calibration gain", "%.3g" % gain])
+    table.append(["Sequence TR (s)", "%.3g" % tr])
+    table.append(["Readout time (s)", "%.3g" % taq])
+    table.append(["Sequence TE (ms)", "%.3g" % te])
+    table.append(["Blood T2 (ms)", "%.3g" % t2b])
+    table.append(["Tissue T1 map", wsp.calib_t1map.name if wsp.calib_t1map is not None else "Not provided"])
+    table.append(["Tissue T2 map", wsp.calib_t2map.name if wsp.calib_t2map is not None else "Not provided"])
+    table.append(["Mean tissue correction factor", "%.3g" % np.mean(wsp.calibration.m0_corr.data)])
+    if wsp.rois is not None and wsp.rois.mask is not None:
+        table.append(["Mean M0 (within mask)", "%.3g" % np.mean(m0[wsp.rois.mask.data > 0])])
+        table.append(["Edge correction", "Enabled" if wsp.ifnone("calib_edgecorr", True) else "Disabled"])
+    else:
+        table.append(["Mean M0", "%.3g" % np.mean(m0)])
+    page.table(table)
+
+    page.heading("Correction factor map", level=1)
+    page.image("m0corr", LightboxImage(wsp.calibration.m0_corr))
+    page.heading("M0 map", level=1)
+    page.image("m0img", LightboxImage(m0img))
+
+    return m0img
+
+def _edge_correct(m0, brain_mask, kernel_3d=False):
     """
     Correct for (partial volume) edge effects
+
+    The correction is only done within the bounding box of the brain mask
+    with a margin sufficient that the result is the same as processing the
+    full image.
+
+    :param kernel_3d: If True, extrapolate using a 5x5x5 neighbourhood rather
+                      than slicewise using a 5x5 neighbourhood
     """
     brain_mask = brain_mask.data
+    bbox = crop.get_bbox(brain_mask, margin=3)
+    ret = np.zeros(m0.shape, dtype=m0.dtype)
+    if bbox is None:
+        return ret
+    slices = crop.bbox_slices(bbox)
+    ret[slices] = _edge_correct_region(m0[slices], brain_mask[slices], kernel_3d)
+    return ret
+
+def _edge_correct_region(m0, brain_mask, kernel_3d=False):
+    """
+    Do edge correction on a region of the M0 image containing the brain mask
+    """
 
     # Median smoothing
     m0 = scipy.ndimage.median_filter(m0, size=3)
@@ -216,33 +446,24 @@ def _edge_correct(m0, brain_mask):
 
     # Extrapolate remaining data to fit original mask
     # ASL_FILE works slicewise using a mean 5x5 filter on nonzero values, so we will do the same
-    for z in range(m0.shape[2]):
-        zslice = m0[..., z]
-        zslice_extrap = scipy.ndimage.filters.generic_filter(zslice, _masked_mean, footprint=np.ones([5, 5]))
-        m0[..., z] = zslice_extrap
+    # by default. Zero voxels are replaced by the mean of nonzero voxels in the kernel, calculated
+    # by convolving the data and an indicator of nonzero voxels with the kernel (normalised
+    # convolution). Direct correlation is used rather than a running sum so that the count of
+    # nonzero voxels is exact
+    if kernel_3d:
+        kernel = np.ones([5, 5, 5])
+    else:
+        kernel = np.ones([5, 5, 1])
+    nonzero = m0 != 0
+    sums = scipy.ndimage.correlate(m0, kernel, mode="reflect")
+    counts = scipy.ndimage.correlate(nonzero.astype(m0.dtype), kernel, mode="reflect")
+    extrap = np.zeros(m0.shape, dtype=m0.dtype)
+    np.divide(sums, counts, out=extrap, where=counts > 0)
+    m0 = np.where(nonzero, m0, extrap)
     m0[brain_mask == 0] = 0
 
     return m0
 
-def _masked_mean(vals):
-    """
-    Called by scipy.ndimage.filters.generic_filter
-
-    :param vals: Values in the kernel (a 5x5 square patch centered on the voxel in this case)
-
-    For nonzero voxels, returns the voxel value (i.e. the middle element of vals).
-    For zero voxels, returns the mean of non zero voxels in the kernel
-    """
-    voxel_val = vals[int((len(vals)-1) / 2)]
-    if voxel_val == 0:
-        nonzero = vals[vals != 0]
-        if np.any(nonzero):
-            return np.mean(nonzero)
-        else:
-            return 0
-    else:
-        return voxel_val
-
 def get_m0_wholebrain(wsp):
     """
     Get a whole-brain M0 value
@@ -288,10 +509,9 @@ def get_m0_wholebrain(wsp):
         calib_data /= wsp.sens.data
 
     m0 = np.zeros(calib_data.shape, dtype=np.float)
+    pves = dict(zip(struc.PVE_TISSUES, struc.get_pves_asl(wsp)))
     for tiss_type in ("wm", "gm", "csf"):
-        pve_struc = getattr(wsp.structural, "%s_pv" % tiss_type)
-        wsp.log.write(" - Transforming %s tissue PVE into ASL space\n" % tiss_type)
-        pve = reg.struc2asl(wsp, pve_struc)
+        pve = pves[tiss_type]
         t1r, t2r, t2sr, pcr = tissue_defaults(tiss_type)
         if t2star:
             t2r = t2sr
@@ -328,12 +548,231 @@ def get_m0_wholebrain(wsp):
 
     return float(m0)
 
+class SatRecovModel(object):
+    """
+    Saturation recovery model for a sequence of control images at multiple TIs
+
+    The signal at time t after saturation is::
+
+        S(t) = M0t (1 - A exp(-t / T1t))
+
+    where ``A`` is the saturation efficiency. For Look-Locker readouts with flip angle
+    FA and readout spacing dTI the apparent relaxation is faster::
+
+        1/T1t' = 1/T1t - log(cos(g FA)) / dTI
+        M0t' = M0t (1 - exp(-dTI / T1t)) / (1 - exp(-dTI / T1t'))
+
+    where ``g`` is a flip angle correction factor. ``g`` can only be estimated if some
+    phases are acquired with a lower flip angle, in which case the signal in those
+    phases is additionally scaled by sin(g LFA) / sin(g FA).
+
+    Data volumes are ordered with the TIs together, i.e. the TIs of the first phase,
+    then the TIs of the second phase, etc. If a lower flip angle is given, the first
+    ``nphases`` phases use the high flip angle and the remainder the lower flip angle.
+    """
+
+    def __init__(self, tis, nvols=None, fa=None, lfa=None, nphases=None, fixa=False):
+        """
+        :param tis: Sequence of TIs (s)
+        :param nvols: Number of data volumes. Must be a multiple of the number of TIs
+        :param fa: Flip angle for Look-Locker readouts (degrees)
+        :param lfa: Lower flip angle (degrees) for estimating the flip angle correction
+        :param nphases: Number of phases using the higher flip angle. Defaults to all
+                        but one of the phases if ``lfa`` is given
+        :param fixa: If True, fix the saturation efficiency to 1
+        """
+        self.tis = np.array(tis, dtype=np.float64)
+        if self.tis.ndim != 1 or len(self.tis) == 0:
+            raise ValueError("TIs must be specified for saturation recovery calibration")
+        if nvols is None:
+            nvols = len(self.tis)
+        if nvols % len(self.tis) != 0:
+            raise ValueError("Number of calibration volumes (%i) is not a multiple of the number of TIs (%i)" % (nvols, len(self.tis)))
+        nblocks = nvols // len(self.tis)
+        self.times = np.tile(self.tis, nblocks)
+
+        self.paramnames = ["M0t", "T1t"]
+        if not fixa:
+            self.paramnames.append("A")
+
+        self.fa, self.dti = None, None
+        if lfa is not None and fa is None:
+            raise ValueError("Lower flip angle requires a Look-Locker flip angle")
+        if fa is not None:
+            if len(self.tis) < 2:
+                raise ValueError("Look-Locker correction requires more than one TI")
+            spacing = np.diff(self.tis)
+            if np.any(np.abs(spacing - spacing[0]) > 1e-3):
+                raise ValueError("Look-Locker correction requires evenly spaced TIs")
+            self.dti = spacing[0]
+            self.fa = np.full(nvols, math.radians(fa))
+            if lfa is not None:
+                if nphases is None:
+                    nphases = nblocks - 1
+                if nphases < 1 or nphases >= nblocks:
+                    raise ValueError("Number of high flip angle phases must be between 1 and %i" % (nblocks - 1))
+                self.fa[nphases*len(self.tis):] = math.radians(lfa)
+                self.paramnames.append("g")
+
+        upper = {"M0t" : np.inf, "T1t" : 10.0, "A" : 2.0, "g" : 1.5}
+        lower = {"M0t" : 0.0, "T1t" : 0.01, "A" : 0.0, "g" : 0.5}
+        if self.fa is not None:
+            # cos(g FA) must remain positive
+            upper["g"] = min(upper["g"], 0.99 * math.pi / 2 / np.max(self.fa))
+        self.lower = np.array([lower[name] for name in self.paramnames])
+        self.upper = np.array([upper[name] for name in self.paramnames])
+
+    def _param(self, params, name, default):
+        if name in self.paramnames:
+            return params[:, self.paramnames.index(name), np.newaxis]
+        return np.full((params.shape[0], 1), default)
+
+    def evaluate(self, params):
+        """
+        :param params: Array of parameter values, shape [NV, NP]
+        :return: Model signal, shape [NV, number of volumes]
+        """
+        m0, t1 = params[:, 0, np.newaxis], params[:, 1, np.newaxis]
+        sat_eff = self._param(params, "A", 1.0)
+        if self.fa is None:
+            return m0 * (1 - sat_eff * np.exp(-self.times / t1))
+
+        facorr = self._param(params, "g", 1.0)
+        flip = facorr * self.fa
+        r1_app = 1 / t1 - np.log(np.cos(flip)) / self.dti
+        m0_app = m0 * (1 - np.exp(-self.dti / t1)) / (1 - np.exp(-self.dti * r1_app))
+        scale = np.sin(flip) / np.sin(facorr * self.fa[0])
+        return m0_app * (1 - sat_eff * np.exp(-self.times * r1_app)) * scale
+
+    def initial(self, data, t1_grid=None):
+        """
+        Initial parameter estimates by linear least squares for M0t over a grid of T1t values
+
+        :param data: Array of data, shape [NV, number of volumes]
+        :return: Array of initial parameter values, shape [NV, NP]
+        """
+        if t1_grid is None:
+            t1_grid = np.geomspace(0.1, 6.0, 60)
+        basis_params = np.zeros((len(t1_grid), len(self.paramnames)))
+        basis_params[:, 0] = 1
+        basis_params[:, 1] = t1_grid
+        for name, value in (("A", 1.0), ("g", 1.0)):
+            if name in self.paramnames:
+                basis_params[:, self.paramnames.index(name)] = value
+        basis = self.evaluate(basis_params)
+
+        # For each T1 the best M0 is a linear projection onto the basis, and the best T1
+        # is that which maximises the projected sum of squares
+        proj = np.dot(data, basis.T)
+        norms = np.sum(basis**2, axis=1)
+        best = np.argmax(proj**2 / norms, axis=1)
+
+        params = basis_params[best]
+        params[:, 0] = np.maximum(proj[np.arange(len(best)), best] / norms[best], 0)
+        return params
+
+def _levenberg_marquardt(model, data, params, max_iter=100, tol=1e-8):
+    """
+    Batched Levenberg-Marquardt least squares fit with simple bounds
+
+    Each voxel is fitted independently but all voxels are updated together
+    using a finite difference Jacobian.
+
+    :param model: Model object with ``evaluate``, ``lower`` and ``upper`` attributes
+    :param data: Array of data, shape [NV, number of volumes]
+    :param params: Array of initial parameter values, shape [NV, NP]
+    :return: Array of fitted parameter values, shape [NV, NP]
+    """
+    params = np.clip(params, model.lower, model.upper)
+    resid = data - model.evaluate(params)
+    cost = np.sum(resid**2, axis=1)
+    damping = np.full(len(params), 1e-3)
+    active = np.ones(len(params), dtype=bool)
+    nparams = params.shape[1]
+
+    for _ in range(max_iter):
+        idx = np.nonzero(active)[0]
+        if len(idx) == 0:
+            break
+        current = params[idx]
+
+        # Forward difference Jacobian, stepping away from the upper bound
+        jac = np.zeros((len(idx), data.shape[1], nparams))
+        base = model.evaluate(current)
+        for param_idx in range(nparams):
+            step = 1e-6 * np.maximum(np.abs(current[:, param_idx]), 1e-3)
+            step[current[:, param_idx] + step > model.upper[param_idx]] *= -1
+            stepped = np.copy(current)
+            stepped[:, param_idx] += step
+            jac[..., param_idx] = (model.evaluate(stepped) - base) / step[:, np.newaxis]
+
+        jtj = np.einsum("nvi,nvj->nij", jac, jac)
+        jtr = np.einsum("nvi,nv->ni", jac, resid[idx])
+        diag = np.diagonal(jtj, axis1=1, axis2=2)
+        diag = np.maximum(diag, 1e-12 * np.max(diag, axis=1, keepdims=True) + 1e-30)
+        lhs = jtj + (damping[idx, np.newaxis] * diag)[..., np.newaxis] * np.eye(nparams)
+        delta = np.linalg.solve(lhs, jtr[..., np.newaxis])[..., 0]
+
+        trial = np.clip(current + delta, model.lower, model.upper)
+        trial_resid = data[idx] - model.evaluate(trial)
+        trial_cost = np.sum(trial_resid**2, axis=1)
+        improved = trial_cost < cost[idx]
+
+        better = idx[improved]
+        converged = (cost[better] - trial_cost[improved]) <= tol * cost[better]
+        params[better] = trial[improved]
+        resid[better] = trial_resid[improved]
+        cost[better] = trial_cost[improved]
+        damping[better] = np.maximum(damping[better] / 10, 1e-10)
+        damping[idx[~improved]] *= 10
+
+        active[better[converged]] = False
+        active[idx[~improved][damping[idx[~improved]] > 1e10]] = False
+
+    return params
+
+def fit_satrecov(data, tis, mask=None, fa=None, lfa=None, nphases=None, fixa=False, chunk_size=5000):
+    """
+    Voxelwise least squares fit of the saturation recovery model
+
+    See ``SatRecovModel`` for the model and data ordering.
+
+    :param data: 4D Image or array of control images at multiple TIs
+    :param tis: Sequence of TIs (s)
+    :param mask: Optional mask Image or array. Voxels outside the mask are zero in the output
+    :param fa: Flip angle for Look-Locker readouts (degrees)
+    :param lfa: Lower flip angle (degrees) for estimating the flip angle correction
+    :param nphases: Number of phases using the higher flip angle
+    :param fixa: If True, fix the saturation efficiency to 1
+    :param chunk_size: Number of voxels fitted at a time
+    :return: Dictionary of parameter name (``M0t``, ``T1t``, ``A``, ``g``) : 3D array
+    """
+    if isinstance(data, Image):
+        data = data.data
+    if data.ndim != 4:
+        raise ValueError("Saturation recovery calibration requires 4D calibration data")
+    if mask is None:
+        voxels = np.ones(data.shape[:3], dtype=bool)
+    else:
+        voxels = np.asarray(mask.data if isinstance(mask, Image) else mask) > 0
+
+    model = SatRecovModel(tis, nvols=data.shape[3], fa=fa, lfa=lfa, nphases=nphases, fixa=fixa)
+    vox_data = data[voxels].astype(np.float64)
+    fitted = np.zeros((len(vox_data), len(model.paramnames)))
+    for start in range(0, len(vox_data), chunk_size):
+        chunk = vox_data[start:start+chunk_size]
+        fitted[start:start+chunk_size] = _levenberg_marquardt(model, chunk, model.initial(chunk))
+
+    ret = {}
+    for idx, name in enumerate(model.paramnames):
+        ret[name] = np.zeros(data.shape[:3], dtype=np.float32)
+        ret[name][voxels] = fitted[:, idx]
+    return ret
+
 def get_m0_refregion(wsp, mode="longtr"):
     """
     Do reference region calibration
 
-    FIXME saturation recovery mode is not functional
-
     Required workspace attributes
     -----------------------------
 
@@ -353,6 +792,22 @@ def get_m0_refregion(wsp, mode="longtr"):
      - ``t2r`` : Reference tissue T2/T2* (default: see ``TISSUE_DEFAULTS``)
      - ``pcr`` : Reference tissue partition coefficient (default: see ``TISSUE_DEFAULTS``)
      - ``mask`` : Brain mask in calibration image space
+
+    Additional workspace attributes for saturation recovery mode
+    ------------------------------------------------------------
+
+     - ``satrecov_tis`` : TIs of calibration images (s) (default: ``tis``)
+     - ``fa`` : Flip angle for Look-Locker readouts (degrees)
+     - ``lfa`` : Lower flip angle for estimating flip angle correction (degrees)
+     - ``calib_nphases`` : Number of phases acquired with the higher flip angle
+     - ``fixa`` : If True, fix the saturation efficiency to 1
+
+    Workspace attributes updated in saturation recovery mode
+    --------------------------------------------------------
+
+     - ``calibration.m0t`` : Voxelwise fitted M0 of tissue
+     - ``calibration.t1t`` : Voxelwise fitted T1 of tissue
+     - ``calibration.facorr`` : Voxelwise flip angle correction (if ``lfa`` given)
     """
     wsp.log.write(" - Doing reference region calibration\n")
     gain = wsp.ifnone("calib_gain", 1)
@@ -416,7 +871,7 @@ def get_m0_refregion(wsp, mode="longtr"):
     # Check the data and masks
     calib_data = np.copy(wsp.calib.data).astype(np.float)
     wsp.calibration.calib_img = wsp.calib
-    if calib_data.ndim == 4:
+    if calib_data.ndim == 4 and mode != "satrecov":
         wsp.log.write(" - Taking mean across calibration images\n")
         calib_data = np.mean(calib_data, -1)
 
@@ -480,63 +935,37 @@ def get_m0_refregion(wsp, mode="longtr"):
         wsp.log.write(" - T1 correction factor: %f\n" % t1_corr)
 
     elif mode == "satrecov":
-        # Calibration image is control images and we want to do a saturation recovery fit
-        # NB only do the fit in the CSF mask
-        # FIXME this is not functional at the moment
-        options = {
-            "data" : wsp.calib,
-            "mask" : refmask,
-            "method" : "vb",
-            "noise" : "white",
-            "model" : "satrecov",
-            "t1" : t1r,
-        }
-
-        #deal with TIs
-        tis = wsp.ifnone("satrecov_tis", [])
+        # Calibration image is control images at multiple TIs and we want to do a saturation
+        # recovery fit. This is done within the whole brain so we also get the estimated T1
+        # of tissue and flip angle correction (if Look-Locker). Note that we do not apply
+        # sensitivity correction to the data here - this is 'built-into' the M0t map
+        tis = wsp.ifnone("satrecov_tis", wsp.tis)
+        if isinstance(tis, six.string_types):
+            tis = [float(ti) for ti in tis.split(",")]
+        if not tis:
+            raise ValueError("TIs must be specified for saturation recovery calibration")
         wsp.log.write(" - TIs: %s\n" % str(tis))
-        for idx, ti in enumerate(tis):
-            options["ti%i" % (idx+1)] = ti
-
-        # Extra options for Look Locker
-        if wsp.FA:
-            options["FA"] = wsp.FA
-        if wsp.calib_nphases:
-            options["phases"] = wsp.calib_nphases
+        if wsp.fa:
+            wsp.log.write(" - Look-Locker flip angle: %f\n" % wsp.fa)
         if wsp.lfa:
-            options["LFA"] = wsp.lfa
-
-        # Extra sat recovery options
-        if wsp.fixa:
-            options["fixa"] = True
-
-        # Do fabber within the tissue reference mask with a sensible T1 prior mean
-        wsp.log.write(" - Running FABBER within reference tissue mask\n")
-        from .wrappers import fabber
-        fabber_result = fabber(options)
-        mean_m0 = fabber_result["mean_M0t"]
-
-        # Calculate M0 value - this is mean M0 of CSF at the TE of the sequence
-        m0_value = np.mean(mean_m0.data[refmask != 0])
-
-        wsp.log.write(" - M0 of reference tissue: %f\n" % m0_value)
-
-        # Save useful results
-        wsp.calibration.t1_ref = Image("%s/mean_T1t" % wsp.workdir)
-        wsp.calibration.m0_ref = Image("%s/mean_M0t" % wsp.workdir)
-
-        # Do fabber again within whole brain to get estimated T1 of tissue and FA correction (if LL)
-        # (note that we do not apply sensitivity correction to the data here - thius is 'built-into' the M0t map)
-        wsp.log.write(" - FABBER (again) within whole brain mask\n")
-        options["mask"] = brain_mask
-        fabber(options)
-        # $fabber --data=$calib --mask=$bmask --output=$temp_calib/satrecovT --data-order=singlefile --model=satrecov --noise=white --method=vb $tislist $llopts $sropts
-
-        # save useful results to specified output directory
-        #imcp $temp_calib/satrecovT/mean_T1t $outdir/T1t
-        #imcp $temp_calib/satrecovT/mean_M0t $outdir/M0t
-        #if [ ! -z $lfa ]; then
-        #imcp $temp_calib/satrecovT/mean_g $outdir/facorr
+            wsp.log.write(" - Lower flip angle: %f\n" % wsp.lfa)
+
+        wsp.log.write(" - Fitting saturation recovery model within brain mask\n")
+        fit_mask = np.logical_or(brain_mask != 0, refmask != 0)
+        fitted = fit_satrecov(wsp.calib, tis, mask=fit_mask, fa=wsp.fa, lfa=wsp.lfa,
+                              nphases=wsp.calib_nphases, fixa=wsp.fixa)
+        wsp.calibration.m0t = Image(fitted["M0t"], header=wsp.calib.header)
+        wsp.calibration.t1t = Image(fitted["T1t"], header=wsp.calib.header)
+        if "g" in fitted:
+            wsp.calibration.facorr = Image(fitted["g"], header=wsp.calib.header)
+
+        # M0t is the fully relaxed signal so no T1 correction is required
+        mean_sig = np.mean(fitted["M0t"][refmask != 0])
+        wsp.log.write(" - M0 of reference tissue: %f\n" % mean_sig)
+        t1r = np.mean(fitted["T1t"][refmask != 0])
+        wsp.log.write(" - Fitted T1 of reference tissue: %f\n" % t1r)
+        t1_corr = 1.0
+
     else:
         raise ValueError("Unknown reference region mode: %s (Should be satrecov or longtr)" % mode)
 
@@ -595,7 +1024,8 @@ def get_tissrefmask(wsp):
     wsp.calibration.refpve = getattr(wsp.structural, "%s_pv" % wsp.tissref.lower())
     page.image("refpve", LightboxImage(wsp.calibration.refpve, bgimage=wsp.structural.brain))
 
-    if wsp.tissref == "csf" and not wsp.csfmaskingoff:
+    ventricle_masking = wsp.tissref == "csf" and not wsp.csfmaskingoff
+    if ventricle_masking:
         wsp.log.write(" - Doing automatic ventricle selection using standard atlas\n")
         # By deafult now we do FNRIT transformation of ventricle mask
         # FIXME disabled as not being used in ASL_CALIB at present
@@ -604,13 +1034,8 @@ def get_tissrefmask(wsp):
         # Select ventricles based on standard space atlas
         page.heading("Automatic ventricle selection", level=1)
         page.text("Standard space ventricles mask (from Harvard-Oxford atlas) eroded by 1 pixel")
-        atlases = AtlasRegistry()
-        atlases.rescanAtlases()
-        atlas = atlases.loadAtlas("harvardoxford-subcortical", loadSummary=False, resolution=2)
-        ventricles = ((atlas.data[..., 2] + atlas.data[..., 13]) > 0.1).astype(np.int)
-        wsp.calibration.ventricles = Image(scipy.ndimage.binary_erosion(ventricles, structure=np.ones([3, 3, 3]), border_value=1).astype(np.int), header=atlas.header)
-        std_img = Image(os.path.join(os.environ["FSLDIR"], "data", "standard", 'MNI152_T1_2mm_brain'))
-        page.image("ventricles_std", LightboxImage(wsp.calibration.ventricles, bgimage=std_img))
+        wsp.calibration.ventricles = stdcache.ventricles_std(log=wsp.log)
+        page.image("ventricles_std", LightboxImage(wsp.calibration.ventricles, bgimage=stdcache.std_brain()))
 
         page.heading("Structural space ventricles mask", level=1)
         reg.reg_struc2std(wsp)
@@ -632,7 +1057,12 @@ def get_tissrefmask(wsp):
 
     wsp.log.write(" - Transforming tissue reference mask into ASL space\n")
     # FIXME calibration image may not be in ASL space! Oxford_asl does not handle this currently
-    wsp.calibration.refpve_calib = reg.struc2asl(wsp, wsp.calibration.refpve)
+    if ventricle_masking:
+        wsp.calibration.refpve_calib = reg.struc2asl(wsp, wsp.calibration.refpve)
+    else:
+        # Unmasked tissue PVE so we can use the tissue PVEs already in ASL space
+        pves = dict(zip(struc.PVE_TISSUES, struc.get_pves_asl(wsp)))
+        wsp.calibration.refpve_calib = pves[wsp.tissref.lower()]
     #wsp.calibration.refpve_calib.data[wsp.calibration.refpve_calib.data < 0.001] = 0 # Better for display
     page.heading("Reference region in ASL space", level=1)
     page.text("Partial volume map")
@@ -683,7 +1113,7 @@ class CalibOptions(OptionCategory):
         group = IgnorableOptionGroup(parser, "Calibration", ignore=self.ignore)
         group.add_option("--calib", "-c", help="Calibration image", type="image")
         group.add_option("--perf", "-i", help="Perfusion image for calibration, in same image space as calibration image", type="image")
-        group.add_option("--calib-method", "--cmethod", help="Calibration method: voxelwise or refregion")
+        group.add_option("--calib-method", "--cmethod", help="Calibration method: voxelwise, quantitative, refregion or wholebrain")
         group.add_option("--calib-alpha", "--alpha", help="Inversion efficiency", type=float, default=None)
         group.add_option("--calib-gain", "--cgain", help="Relative gain between calibration and ASL data", type=float, default=1.0)
         group.add_option("--calib-aslreg", help="Calibration image is already aligned with ASL image", action="store_true", default=False)
@@ -693,10 +1123,13 @@ class CalibOptions(OptionCategory):
 
         group = IgnorableOptionGroup(parser, "Voxelwise calibration", ignore=self.ignore)
         group.add_option("--pct", help="Tissue/arterial partition coefficiant", type=float, default=0.9)
+        group.add_option("--calib-edgecorr-3d", help="Use a 3D neighbourhood rather than slicewise extrapolation for edge correction", action="store_true", default=False)
+        group.add_option("--calib-t1map", help="Tissue T1 map (s) in calibration image space for quantitative calibration", type="image")
+        group.add_option("--calib-t2map", help="Tissue T2/T2* map (ms) in calibration image space for quantitative calibration", type="image")
         groups.append(group)
 
         group = IgnorableOptionGroup(parser, "Reference region calibration", ignore=self.ignore)
-        group.add_option("--mode", help="Calibration mode (longtr or satrevoc)", default="longtr")
+        group.add_option("--mode", help="Calibration mode (longtr or satrecov)", default="longtr")
         group.add_option("--tissref", help="Tissue reference type (csf, wm, gm or none)", default="csf")
         group.add_option("--te", help="Sequence TE (ms)", type=float, default=0.0)
         group.add_option("--refmask", "--csf", help="Reference tissue mask in calibration image space", type="image")
@@ -710,7 +1143,8 @@ class CalibOptions(OptionCategory):
         groups.append(group)
 
         group = IgnorableOptionGroup(parser, "satrecov mode (calibration image is a sequnce of control images at various TIs)", ignore=self.ignore)
-        group.add_option("--tis", help="Comma separated list of inversion times, e.group. --tis 0.2,0.4,0.6")
+        group.add_option("--tis", help="Comma separated list of inversion times, e.g. --tis 0.2,0.4,0.6")
+        group.add_option("--satrecov-tis", help="Comma separated list of inversion times of calibration images if different from --tis")
         group.add_option("--fa", help="Flip angle (in degrees) for Look-Locker readouts", type=float)
         group.add_option("--lfa", help="Lower flip angle (in degrees) for dual FA calibration", type=float)
         group.add_option("--calib-nphases", help="Number of phases (repetitions) of higher FA", type=int)
@@ -0,0 +1,140 @@
+"""
+Cropping of images to the bounding box of a mask
+
+Much of the processing in the pipeline (in particular model fitting) only
+involves voxels within the brain mask, which typically occupies a much smaller
+box than the full acquisition field of view. Cropping images to the bounding
+box of the mask before processing reduces memory use and processing time.
+
+Cropped images have their affine adjusted so they remain correctly located
+in world space. The original grid is restored using ``uncrop_image``.
+
+    bbox = get_bbox(mask, margin=1)
+    cropped_data = crop_image(asldata, bbox)
+    ...
+    output = uncrop_image(cropped_output, bbox, mask)
+
+A bounding box is a list of ``[lower, upper]`` voxel index pairs for each of
+the three spatial dimensions, with the upper bound exclusive.
+
+Copyright (c) 2008-2018 University of Oxford
+"""
+import numpy as np
+
+from fsl.data.image import Image
+
+from oxasl.image import AslImage
+
+def get_bbox(mask, margin=0):
+    """
+    Get the bounding box of the nonzero voxels in a mask
+
+    :param mask: Mask as an Image or Numpy array
+    :param margin: Number of voxels to add around the mask in each direction
+    :return: Bounding box as a list of [lower, upper] pairs, or None if the mask is empty
+    """
+    if isinstance(mask, Image):
+        mask = mask.data
+    nonzero = np.nonzero(mask)
+    if len(nonzero[0]) == 0:
+        return None
+
+    bbox = []
+    for dim in range(3):
+        lower = max(int(np.min(nonzero[dim])) - margin, 0)
+        upper = min(int(np.max(nonzero[dim])) + margin + 1, mask.shape[dim])
+        bbox.append([lower, upper])
+    return bbox
+
+def bbox_slices(bbox):
+    """
+    :return: Tuple of slice objects corresponding to a bounding box
+    """
+    return tuple([slice(lower, upper) for lower, upper in bbox])
+
+def bbox_shape(bbox):
+    """
+    :return: 3D shape of a bounding box
+    """
+    return tuple([upper - lower for lower, upper in bbox])
+
+def _cropped_header(header, bbox):
+    """
+    Get a copy of a Nifti header with sform/qform adjusted to the origin of a bounding box
+    """
+    header = header.copy()
+    offset = np.identity(4)
+    offset[:3, 3] = [lower for lower, _ in bbox]
+    sform, sform_code = header.get_sform(coded=True)
+    if sform is not None:
+        header.set_sform(np.dot(sform, offset), code=int(sform_code))
+    qform, qform_code = header.get_qform(coded=True)
+    if qform is not None:
+        header.set_qform(np.dot(qform, offset), code=int(qform_code))
+    return header
+
+def crop_image(img, bbox):
+    """
+    Crop an image to a bounding box
+
+    :param img: Image or AslImage. May be 3D or 4D
+    :param bbox: Bounding box as returned by ``get_bbox``. If None the image is returned unchanged
+    :return: Cropped Image. AslImage metadata is preserved if the input is an AslImage
+    """
+    if bbox is None or img is None:
+        return img
+
+    data = img.data[bbox_slices(bbox)]
+    header = _cropped_header(img.header, bbox)
+    if isinstance(img, AslImage):
+        return img.derived(data, header=header)
+    else:
+        return Image(data, name=img.name, header=header)
+
+def uncrop_image(img, bbox, ref, fill=0):
+    """
+    Restore a cropped image to the full voxel grid
+
+    :param img: Cropped Image
+    :param bbox: Bounding box used to crop the image. If None the image is returned unchanged
+    :param ref: Reference Image on the full voxel grid
+    :param fill: Value to use for voxels outside the bounding box
+    :return: Image on the same grid as ``ref``
+    """
+    if bbox is None or img is None:
+        return img
+    if tuple(img.shape[:3]) == tuple(ref.shape[:3]):
+        # Not cropped
+        return img
+
+    data = np.full(tuple(ref.shape[:3]) + tuple(img.shape[3:]), fill, dtype=img.data.dtype)
+    data[bbox_slices(bbox)] = img.data
+    return Image(data, name=img.name, header=ref.header)
+
+def crop_options(options, bbox, shape, cropped=None):
+    """
+    Crop all images in a dictionary of options which are defined on a given voxel grid
+
+    This is used to crop the inputs to a model fitting step. Images which are
+    not on the full grid (e.g. because they have already been cropped) are
+    left unchanged.
+
+    :param options: Dictionary of options
+    :param bbox: Bounding box as returned by ``get_bbox``
+    :param shape: 3D shape of the full voxel grid
+    :param cropped: Optional dictionary of previously cropped images, keyed by the id of
+                    the original image. This is updated so that an image shared
+                    between several sets of options is only cropped once and
+                    the same cropped image is used for each
+    :return: Copy of options dictionary with images cropped
+    """
+    if cropped is None:
+        cropped = {}
+    options = dict(options)
+    for key, value in options.items():
+        if isinstance(value, Image) and tuple(value.shape[:3]) == tuple(shape[:3]):
+            if id(value) not in cropped:
+                # Original is kept with the cropped image so its id cannot be re-used
+                cropped[id(value)] = (value, crop_image(value, bbox))
+            options[key] = cropped[id(value)][1]
+    return options
@@ -16,6 +16,7 @@ from wx.lib.pubsub import pub
 
 from oxasl import Workspace
 from oxasl.oxford_asl import oxasl
+from oxasl.progress import Progress
 from oxasl.gui.widgets import OptionError
 
 class LogWriter():
@@ -28,6 +29,12 @@ class LogWriter():
     def flush(self):
         pass
 
+def send_progress(event):
+    """
+    Progress sink which sends OXASL progress events to the GUI
+    """
+    wx.CallAfter(pub.sendMessage, "run_progress", event=event)
+
 class OxaslRunner(Thread):
     """
     Runs OXASL pipeline in a background thread
@@ -39,7 +46,7 @@ class OxaslRunner(Thread):
     def run(self):
         ret = -1
         try:
-            wsp = Workspace(log=LogWriter(), **self.options)
+            wsp = Workspace(log=LogWriter(), progress=Progress(send_progress), **self.options)
             oxasl(wsp)
             ret = 0
         finally:
@@ -69,6 +76,7 @@ class AslRun(wx.Frame):
         self.Bind(wx.EVT_CLOSE, self.close)
         pub.subscribe(self.write_output, "run_stdout")
         pub.subscribe(self.finished, "run_finished")
+        pub.subscribe(self.show_progress, "run_progress")
 
     def write_output(self, line):
         """
@@ -76,6 +84,23 @@ class AslRun(wx.Frame):
         """
         self.output_text.AppendText(line)
 
+    def show_progress(self, event):
+        """
+        Show the latest progress event from the pipeline in the status label
+        """
+        if event["status"] != "running" or event["step"] is None:
+            return
+        text = "Running - %s step %i" % (event["stage"], event["step"])
+        if event["nsteps"]:
+            text += " of %i" % event["nsteps"]
+        if event["desc"]:
+            text += ": %s" % event["desc"]
+        if event["step_percent"] is not None:
+            text += " (%i%%)" % event["step_percent"]
+        if event["eta"] is not None:
+            text += " - about %i:%02i remaining" % (int(event["eta"]) // 60, int(event["eta"]) % 60)
+        self.run_label.SetLabel(text)
+
     def close(self, _):
         """
         Hide the log output window
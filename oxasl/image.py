@@ -203,6 +203,10 @@ class AslImage(Image):
             self.calib = None
             Image.__init__(self, image, name=name, **img_args)
 
+        # Volume index tables and lookups for each data ordering, generated on demand
+        self._vol_tables = {}
+        self._vol_lookups = {}
+
         order = kwargs.pop("order", None)
         iaf = kwargs.pop("iaf", None)
         ibf = kwargs.pop("ibf", None)
@@ -408,6 +412,81 @@ class AslImage(Image):
         """
         return min(self.rpts) != max(self.rpts)
 
+    def _full_order(self, order=None):
+        if order is None:
+            order = self.order
+        else:
+            order = order.lower()
+
+        if "l" not in order:
+            # Need labelling image ordering even if differenced - harmless if ntc == 1
+            order = "l" + order
+
+        if "e" not in order:
+            # Need ordering for TEs even if data is single-TE - this is harmless if ntes == 1
+            order = "e" + order
+        return order
+
+    def vol_index_table(self, order=None):
+        """
+        Get the label, TI, repeat and TE indices of every volume
+
+        :param order: If specified use custom data ordering string (does not change ordering
+                      within this AslImage - use ``reorder`` for that)
+        :return: Integer array of shape [nvols, 4]. Each row contains the label, TI, repeat
+                 and TE index of the corresponding volume
+        """
+        order = self._full_order(order)
+        if order not in self._vol_tables:
+            lookup = self._vol_lookup(order)
+            exists = np.arange(lookup.shape[2])[np.newaxis, :] < np.array(self.rpts)[:, np.newaxis]
+            exists = np.broadcast_to(exists[np.newaxis, :, :, np.newaxis], lookup.shape)
+            vols = lookup[exists]
+            if np.any(vols < 0) or np.any(vols >= self.nvols) or len(np.unique(vols)) != len(vols):
+                raise ValueError("Data ordering '%s' is not consistent with repeats %s" % (order, self.rpts))
+            table = np.zeros((self.nvols, 4), dtype=np.int32)
+            table[vols] = np.argwhere(exists)
+            table.flags.writeable = False
+            self._vol_tables[order] = table
+        return self._vol_tables[order]
+
+    def _vol_lookup(self, order=None):
+        """
+        :return: Array indexed by label, TI, repeat and TE index containing the volume
+                 index, or -1 where there is no such volume
+        """
+        order = self._full_order(order)
+        if order not in self._vol_lookups:
+            # Volumes are enumerated by a single pass over the components of the ordering,
+            # with the number of repeats depending on the current TI. For variable repeats
+            # not every ordering gives a unique volume for each label, TI, repeat and TE
+            lookup = np.full([self.ntc, self.ntis, max(self.rpts), self.ntes], -1, dtype=np.int32)
+            ti_pos, rpt_pos, label_pos, te_pos = order.index("t"), order.index("r"), order.index("l"), order.index("e")
+            its = [0, 0, 0, 0]
+            vol_idx = 0
+            try:
+                while vol_idx <= self.nvols:
+                    ti, rpt, label, te = its[ti_pos], its[rpt_pos], its[label_pos], its[te_pos]
+                    if label < self.ntc and ti < self.ntis and rpt < lookup.shape[2] and te < self.ntes and lookup[label, ti, rpt, te] < 0:
+                        lookup[label, ti, rpt, te] = vol_idx
+                    its[0] += 1
+                    for pos in range(3):
+                        if its[pos] == self._get_ncomp(order[pos], ti):
+                            its[pos] = 0
+                            its[pos+1] += 1
+                    if its[3] != self._get_ncomp(order[3], ti):
+                        vol_idx += 1
+            except IndexError:
+                # Ran off the end of the TIs
+                pass
+            lookup.flags.writeable = False
+            self._vol_lookups[order] = lookup
+        return self._vol_lookups[order]
+
+    def _get_ncomp(self, comp_id, ti):
+        ret = {"t": self.ntis, "r" : self.rpts[ti], "l" : self.ntc, "e" : self.ntes}
+        return ret[comp_id]
+
     def get_vol_index(self, label_idx, ti_idx, rpt_idx, te_idx=0, order=None):
         """
         Get the volume index for a specified label, TI and repeat index
@@ -420,60 +499,15 @@ class AslImage(Image):
         :param order: If specified use custom data ordering string (does not change ordering
                       within this AslImage - use ``reorder`` for that)
         """
-        if order is None:
-            order = self.order
-        else:
-            order = order.lower()
-        
-        if "l" not in order:
-            # Need labelling image ordering even if differenced - harmless if ntc == 1
-            order = "l" + order
-        
-        if "e" not in order:
-            # Need ordering for TEs even if data is single-TE - this is harmless if ntes == 1
-            order = "e" + order
-
         if ti_idx >= self.ntis:
             raise ValueError("Requested TI index %i but only %i TIs present" % (ti_idx, self.ntis))
         if te_idx >= self.ntes:
             raise ValueError("Requested TE index %i but only %i TEs present" % (te_idx, self.ntes))
 
-        # Not yet found a simple way to do this which works for variable repeats
-        # without crude iteration!
-        ti_pos, rpt_pos, label_pos, te_pos = order.index("t"), order.index("r"), order.index("l"), order.index("e")
-        its = [0, 0, 0, 0]
-        vol_idx = 0
-        while 1:
-            ti, rpt, label, te = its[ti_pos], its[rpt_pos], its[label_pos], its[te_pos]
-            if (ti, rpt, label, te) == (ti_idx, rpt_idx, label_idx, te_idx):
-                return vol_idx
-            its[0] += 1
-            if its[0] == self._get_ncomp(order[0], ti):
-                its[0] = 0
-                its[1] += 1
-            if its[1] == self._get_ncomp(order[1], ti):
-                its[1] = 0
-                its[2] += 1
-            if its[2] == self._get_ncomp(order[2], ti):
-                its[2] = 0
-                its[3] += 1
-            if its[3] == self._get_ncomp(order[3], ti):
-                # Normally this is the end but we might have run out of
-                # repeats but not run out of TIs
-                pass
-            else:
-                vol_idx += 1
-            if vol_idx > self.nvols:
-                break
-
-        raise ValueError("No volume for supplied TI, TE, label and repeat")
-
-    def _get_ncomp(self, comp_id, ti):
-        ret = {"t": self.ntis, "r" : self.rpts[ti], "l" : self.ntc, "e" : self.ntes}
-        if comp_id in ret:
-            return ret[comp_id]
-        else:
-            raise RuntimeError("Unknown ordering character: %s" % comp_id)
+        lookup = self._vol_lookup(order)
+        if label_idx >= lookup.shape[0] or rpt_idx >= lookup.shape[2] or lookup[label_idx, ti_idx, rpt_idx, te_idx] < 0:
+            raise ValueError("No volume for supplied TI, TE, label and repeat")
+        return int(lookup[label_idx, ti_idx, rpt_idx, te_idx])
 
     def reorder(self, out_order=None, iaf=None, name=None):
         """
@@ -505,20 +539,15 @@ class AslImage(Image):
         input_data = self.data
         if input_data.ndim == 3:
             input_data = input_data[..., np.newaxis]
-        output_data = np.zeros(input_data.shape, dtype=input_data.dtype)
-        tags = range(self.ntc)
-        for te in range(self.ntes):
-            for ti in range(self.ntis):
-                for rpt in range(self.rpts[ti]):
-                    for tag in tags:
-                        if iaf != self.iaf:
-                            # Change from TC to CT or vice versa
-                            out_tag = 1-tag
-                        else:
-                            out_tag = tag
-                        in_idx = self.get_vol_index(tag, ti, rpt, te)
-                        out_idx = self.get_vol_index(out_tag, ti, rpt, te, order=out_order)
-                        output_data[:, :, :, out_idx] = input_data[:, :, :, in_idx]
+
+        # Find the input volume for each output volume and gather them in one go. Both
+        # orderings must give a unique volume for each label, TI, repeat and TE
+        self.vol_index_table()
+        labels, tis, rpts, tes = self.vol_index_table(out_order).T
+        if iaf != self.iaf:
+            # Change from TC to CT or vice versa
+            labels = 1 - labels
+        output_data = input_data[..., self._vol_lookup()[labels, tis, rpts, tes]]
 
         if not name:
             name = self.name + "_reorder"
@@ -587,16 +616,14 @@ class AslImage(Image):
         elif self.iaf not in ("tc", "ct"):
             raise ValueError("Data is not tag-control pairs - cannot difference")
         else:
-            output_data = np.zeros(list(self.shape[:3]) + [int(self.nvols/2)])
-
-            # Re-order so that TC pairs are together with the tag first
+            # Find the tag and control volumes for each output volume
             out_order = self.order.replace("l", "")
-            reordered = self.reorder("l" + out_order, iaf="tc").data
-
-            for vol in range(int(self.nvols / 2)):
-                tag = 2*vol
-                ctrl = tag+1
-                output_data[..., vol] = reordered[..., ctrl] - reordered[..., tag]
+            table = self.vol_index_table(out_order)
+            _, tis, rpts, tes = table[table[:, 0] == 0].T
+            tag_label, ctrl_label = (0, 1) if self.iaf == "tc" else (1, 0)
+            lookup = self._vol_lookup()
+            data = self.data
+            output_data = data[..., lookup[ctrl_label, tis, rpts, tes]].astype(np.float64) - data[..., lookup[tag_label, tis, rpts, tes]]
 
         out_order = self.order.replace("l", "")
 
@@ -615,33 +642,24 @@ class AslImage(Image):
         if diff and self.ntc > 1:
             # Have tag-control pairs - need to subtract
             data = self.diff()
-            out_order = "ret"
-        elif self.ntc > 1:
-            data = self
-            out_order = "relt"
         else:
             data = self
-            out_order = "ret"
 
-        # Reorder so repeats are together saving original order. Note that
-        # rt and tr are equivalent in the output but we want to preserve
-        # whatever it was beforehand
+        # Note that rt and tr are equivalent in the output but we want to preserve
+        # whatever the order was beforehand
         orig_order = data.order
-        data = data.reorder(out_order)
         input_data = data.data
         if input_data.ndim == 3:
             input_data = input_data[..., np.newaxis]
 
-        # Create output data - one repeat per ti. Note ordering of nested loops follows
-        # out_order defined above
-        output_data = np.zeros(list(self.shape[:3]) + [self.ntis * data.ntc * data.ntes])
-        start = 0
-        for ti, nrp in enumerate(self.rpts):
-            for label in range(data.ntc):
-                for te in range(data.ntes):
-                    repeat_data = input_data[..., start:start+nrp]
-                    output_data[..., te+data.ntes*(label+data.ntc*ti)] = np.mean(repeat_data, 3)
-                    start += nrp
+        # Create output data - one repeat per ti, ordered by TE, then label, then TI.
+        # The mean over repeats is calculated in a single operation using a matrix of
+        # weights mapping input volumes to output volumes
+        labels, tis, _, tes = data.vol_index_table().T
+        out_idx = tes + data.ntes * (labels + data.ntc * tis)
+        weights = np.zeros([data.nvols, self.ntis * data.ntc * data.ntes])
+        weights[np.arange(data.nvols), out_idx] = 1.0 / np.array(self.rpts)[tis]
+        output_data = np.dot(input_data, weights)
 
         if not name:
             name = self.name + "_mean"
@@ -783,7 +801,7 @@ class AslImage(Image):
             
         return md
 
-    def derived(self, image, name=None, suffix="", **kwargs):
+    def derived(self, image, name=None, suffix="", header=None, **kwargs):
         """
         Create a derived ASL image based on this one, but with different data
 
@@ -798,6 +816,8 @@ class AslImage(Image):
         :param data: Numpy data for derived image
         :param name: Name for new image (can be simple name or full filename)
         :param suffix: If name not specified, construct by adding suffix to original image name
+        :param header: Nifti header for derived image. If not specified, the header of this
+                       image is used
         :return: derived AslImage. However if the AslImage constructor fails, a basic
                  fsl.data.image.Image is returned and a warning is output.
         """
@@ -820,8 +840,11 @@ class AslImage(Image):
         if self.iaf in ("ve", "vediff"):
             derived_kwargs["nenc"] = self.nenc
 
+        if header is None:
+            header = self.header
+
         try:
-            return AslImage(image=image, name=name, header=self.header, **derived_kwargs)
+            return AslImage(image=image, name=name, header=header, **derived_kwargs)
         except ValueError as exc:
             warnings.warn("AslImage.derived failed (%s) - returning fsl.data.image.Image" % str(exc))
-            return Image(image=image, name=name, header=self.header, **kwargs)
+            return Image(image=image, name=name, header=header, **kwargs)
@@ -33,7 +33,7 @@ class AslOptionParser(OptionParser):
         if argv is None:
             argv = sys.argv[1:]
         options, args = OptionParser.parse_args(self, argv, values)
-        if options.optfile:
+        if getattr(options, "optfile", None):
             # When an option file is specifeid, extract the options, build
             # a new argv vector and re-parse it. This is the only way to ensure
             # that options in the file work identically to CLI options.
@@ -41,7 +41,7 @@ class AslOptionParser(OptionParser):
             options, args = OptionParser.parse_args(self, new_argv, values)
 
         # Deal with case where asldata is given as separate files
-        if args and options.asldata is None:
+        if args and hasattr(options, "asldata") and options.asldata is None:
             merged_data = None
             for idx, fname in enumerate(args):
                 img = Image(fname)
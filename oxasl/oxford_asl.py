@@ -55,6 +55,11 @@ from __future__ import print_function
 import sys
 import os
 import traceback
+import shutil
+import tempfile
+import atexit
+import multiprocessing
+from multiprocessing.util import Finalize
 
 import numpy as np
 
@@ -92,9 +97,12 @@ try:
 except ImportError:
     oxasl_multite = None
 
-from oxasl import Workspace, __version__, image, calib, struc, basil, mask, corrections, reg
+from oxasl import Workspace, __version__, image, calib, struc, basil, mask, corrections, reg, crop
 from oxasl.options import AslOptionParser, GenericOptions, OptionCategory, IgnorableOptionGroup
-from oxasl.reporting import LightboxImage
+from oxasl.reporting import Report, BuiltReport, LightboxImage
+from oxasl.progress import get_progress
+from oxasl.utils import Tee
+from oxasl.wrappers.fabber import reset_workers, clear_workers
 
 class OxfordAslOptions(OptionCategory):
     """
@@ -122,7 +130,38 @@ class OxfordAslOptions(OptionCategory):
         g.add_option("--infertexch", help="Infer exchange time (multi-TE data only)", action="store_true", default=False)
         g.add_option("--infert1", help="Infer T1 value", action="store_true", default=False)
         g.add_option("--infert2", help="Infer T2 value (multi-TE data only)", action="store_true", default=False)
+        g.add_option("--mean-repeats", help="Fit model to the mean over repeats at each TI/PLD and TE", action="store_true", default=False)
         g.add_option("--basil-options", "--fit-options", help="File containing additional options for model fitting step", type="optfile", default=None)
+        g.add_option("--crop", help="Crop data to bounding box of brain mask for model fitting", action="store_true", default=False)
+        g.add_option("--crop-margin", help="Number of voxels to add around brain mask bounding box when cropping", type=int, default=1)
+        g.add_option("--adaptive", help="Stop each model fitting step when a sufficient fraction of voxels have converged", action="store_true", default=False)
+        g.add_option("--refit-bad-voxels", help="Refit voxels which fail to converge in each model fitting step", action="store_true", default=False)
+        g.add_option("--basil-workers", help="Number of partial volume corrected model fitting analyses to run concurrently", type=int, default=1)
+        ret.append(g)
+
+        g = IgnorableOptionGroup(parser, "Model fitting cache options")
+        g.add_option("--fabber-cache", help="Re-use cached model fitting results when data and options are unchanged", action="store_true", default=False)
+        g.add_option("--fabber-cache-dir", help="Directory for cached model fitting results (default: ~/.oxasl/fabber_cache)")
+        g.add_option("--fabber-cache-size", help="Maximum size of model fitting cache in Mb", type=float)
+        ret.append(g)
+
+        g = IgnorableOptionGroup(parser, "Resampling options")
+        g.add_option("--bootstrap", help="Estimate parameter uncertainty from this number of bootstrap resamples over repeats", type=int)
+        g.add_option("--jackknife", help="Estimate parameter uncertainty by jackknife resampling over repeats", action="store_true", default=False)
+        g.add_option("--resample-workers", help="Number of processes used to fit resamples", type=int, default=1)
+        g.add_option("--resample-seed", help="Random seed for bootstrap resamples", type=int)
+        ret.append(g)
+
+        g = IgnorableOptionGroup(parser, "Progress reporting options")
+        g.add_option("--progress-file", help="File to append progress events to as JSON lines")
+        g.add_option("--progress-metrics-file", help="File to write latest progress metrics to in Prometheus text format")
+        ret.append(g)
+
+        g = IgnorableOptionGroup(parser, "Population prior options")
+        g.add_option("--pop-ftiss", help="Population mean perfusion map (standard or native space) used as a prior", type="image")
+        g.add_option("--pop-ftiss-var", help="Population perfusion variance map used to set the precision of the perfusion prior", type="image")
+        g.add_option("--pop-delttiss", help="Population mean arrival time map (standard or native space) used as a prior", type="image")
+        g.add_option("--pop-delttiss-var", help="Population arrival time variance map used to set the precision of the arrival time prior", type="image")
         ret.append(g)
         
         g = IgnorableOptionGroup(parser, "Physiological parameters (all have default values from literature)")
@@ -219,30 +258,35 @@ def oxasl(wsp):
     wsp.log.write("\nInput ASL data: %s\n" % wsp.asldata.name)
     wsp.asldata.summary(wsp.log)
 
-    oxasl_preproc(wsp)
-    calib.init(wsp)
+    with get_progress(wsp).stage("oxasl", nsteps=3) as stage:
+        stage.step(1, "Preprocessing")
+        oxasl_preproc(wsp)
+        calib.init(wsp)
+
+        stage.step(2, "Model fitting")
+        if wsp.asldata.iaf in ("tc", "ct", "diff"):
+            if wsp.ntes == 1:
+                model_basil(wsp)
+            elif oxasl_multite is None:
+                raise ValueError("Multi-TE data supplied but oxasl_multite is not installed")
+            else:
+                oxasl_multite.model_multite(wsp)
 
-    if wsp.asldata.iaf in ("tc", "ct", "diff"):
-        if wsp.ntes == 1:
-            model_basil(wsp)
-        elif oxasl_multite is None:
-            raise ValueError("Multi-TE data supplied but oxasl_multite is not installed")
+        elif wsp.asldata.iaf in ("ve", "vediff"):
+            if oxasl_ve is None:
+                raise ValueError("Vessel encoded data supplied but oxasl_ve is not installed")
+            oxasl_ve.model_ve(wsp)
         else:
-            oxasl_multite.model_multite(wsp)
+            if oxasl_mp is None:
+                raise ValueError("Multiphase data supplied but oxasl_mp is not installed")
+            oxasl_mp.model_mp(wsp)
 
-    elif wsp.asldata.iaf in ("ve", "vediff"):
-        if oxasl_ve is None:
-            raise ValueError("Vessel encoded data supplied but oxasl_ve is not installed")
-        oxasl_ve.model_ve(wsp)
-    else:
-        if oxasl_mp is None:
-            raise ValueError("Multiphase data supplied but oxasl_mp is not installed")
-        oxasl_mp.model_mp(wsp)
+        stage.step(3, "Output")
+        if wsp.save_report:
+            do_report(wsp)
 
-    if wsp.save_report:
-        do_report(wsp)
+        do_cleanup(wsp)
 
-    do_cleanup(wsp)
     wsp.log.write("\nOutput is %s\n" % wsp.savedir)
     wsp.log.write("OXASL - done\n")
 
@@ -308,13 +352,18 @@ def model_basil(wsp):
      - ``basil``         - Contains model fitting output on data without partial volume correction
      - ``basil_pvcorr``  - Contains model fitting output with partial volume correction if
                            ``wsp.pvcorr`` is ``True``
+     - ``basil_surf_pvcorr`` - Contains model fitting output with surface based partial volume
+                               correction if ``wsp.surf_pvcorr`` is ``True``
      - ``output.native`` - Native (ASL) space output from last Basil modelling output
      - ``output.struc``  - Structural space output
     """
     wsp.basil_options = wsp.ifnone("basil_options", {})
 
     basil.basil(wsp, output_wsp=wsp.sub("basil"))
-    redo_reg(wsp, wsp.basil.finalstep.mean_ftiss)
+    redo_reg(wsp, crop.uncrop_image(wsp.basil.finalstep.mean_ftiss, wsp.basil.finalstep.bbox, wsp.rois.mask))
+    if wsp.pop_priors is not None:
+        # Native space population priors depend on the registration so must be re-derived
+        wsp.pop_priors = None
 
     wsp.sub("output")
     output_native(wsp.output, wsp.basil)
@@ -331,6 +380,10 @@ def model_basil(wsp):
             wsp.rois.mask = None
             mask.generate_mask(wsp)
 
+        # The partial volume corrected analyses are independent of each other once
+        # the PV maps and mask have been prepared so these are collected as jobs which
+        # may be run concurrently
+        jobs = []
         if wsp.pvcorr or user_pv_flag:
             # Do partial volume correction fitting
             #
@@ -343,17 +396,11 @@ def model_basil(wsp):
                 wsp.structural.wm_pv_asl = wsp.pvwm
                 wsp.structural.gm_pv_asl = wsp.pvgm
             else:
-                struc.segment(wsp)
-                wsp.structural.wm_pv_asl = reg.struc2asl(wsp, wsp.structural.wm_pv)
-                wsp.structural.gm_pv_asl = reg.struc2asl(wsp, wsp.structural.gm_pv)
+                _, wsp.structural.gm_pv_asl, wsp.structural.wm_pv_asl = struc.get_pves_asl(wsp)
 
             wsp.basil_options.update({"pwm" : wsp.structural.wm_pv_asl, 
                                       "pgm" : wsp.structural.gm_pv_asl})
-            basil.basil(wsp, output_wsp=wsp.sub("basil_pvcorr"), prefit=False)
-
-            wsp.sub("output_pvcorr")
-            output_native(wsp.output_pvcorr, wsp.basil_pvcorr)
-            output_trans(wsp.output_pvcorr)
+            jobs.append(("pvcorr", dict(wsp.basil_options), wsp.rois.mask))
 
         if wsp.surf_pvcorr:
             if oxasl_surfpvc is None:
@@ -368,11 +415,127 @@ def model_basil(wsp):
             min_pv = 0.01
             new_roi = (wsp.basil_options["pwm"].data > min_pv) | (wsp.basil_options["pgm"].data > min_pv)
             wsp.rois.mask = Image(new_roi.astype(np.int8), header=wsp.rois.mask_pvcorr.header)
-            basil.basil(wsp, output_wsp=wsp.sub("basil_surf_pvcorr"), prefit=False)
+            jobs.append(("surf_pvcorr", dict(wsp.basil_options), wsp.rois.mask))
+
+        run_basil_jobs(wsp, jobs)
+
+# Model fitting jobs run by worker processes. These are set before the process
+# pool is created so they are shared with the child processes rather than being
+# pickled
+_JOBS = []
+
+def _init_job_process():
+    # Fabber workers inherited from the parent process belong to it
+    reset_workers()
+    Finalize(None, clear_workers, exitpriority=10)
 
-            wsp.sub('output_surf_pvcorr')
-            output_native(wsp.output_surf_pvcorr, wsp.basil_surf_pvcorr)
-            output_trans(wsp.output_surf_pvcorr)
+def _run_job(job):
+    """
+    Run Basil model fitting for a job and generate its output
+    """
+    name, basil_wsp, output_wsp = job[:3]
+    basil.basil(basil_wsp, output_wsp=basil_wsp, prefit=False, stage="basil_%s" % name)
+    output_native(output_wsp, basil_wsp)
+    output_trans(output_wsp)
+
+def _run_job_process(idx):
+    """
+    Run a model fitting job in a worker process
+
+    Images are saved to the job's workspaces by the worker process. The report
+    is written to the job's report directory as report objects cannot be
+    returned to the main process.
+
+    :return: Log output of the job
+    """
+    job = _JOBS[idx]
+    _run_job(job)
+    job[1].report.tofile(job[3])
+    return str(job[1].log)
+
+def _prepare_jobs(wsp):
+    """
+    Do any processing which the output of each job would otherwise do in the main
+    workspace, so concurrent jobs do not write the same files. Normally this has
+    already been done for the output of the main analysis
+    """
+    reg.init(wsp)
+    if wsp.output_mni and wsp.reg.struc2asl is not None:
+        reg.reg_struc2std(wsp)
+    if wsp.calib is not None and wsp.output_native:
+        calib.calculate_m0(wsp)
+
+def run_basil_jobs(wsp, jobs):
+    """
+    Run independent Basil model fitting analyses and generate their output
+
+    If ``wsp.basil_workers`` is greater than 1 the analyses are run concurrently
+    in separate processes, as the Fabber library cannot be used from multiple
+    threads. Each analysis logs to its own stream and generates its own report.
+    When all analyses have finished the logs are written to the main log, and
+    the reports added to the main report, in the order the jobs were given so
+    the output does not depend on which analysis finished first.
+
+    Output images of concurrent analyses are saved to the job workspaces by the
+    worker processes, but the job workspace objects in this process are not
+    updated. Concurrent analyses require the ``fork`` start method, otherwise
+    the analyses are run one at a time.
+
+    :param wsp: Workspace object
+    :param jobs: Sequence of tuples of (name, basil options, mask). Model fitting output
+                 for each job is placed in ``basil_<name>`` and output images in
+                 ``output_<name>``
+    """
+    nworkers = min(wsp.ifnone("basil_workers", 1), len(jobs))
+    concurrent = nworkers > 1
+    if concurrent and "fork" not in multiprocessing.get_all_start_methods():
+        wsp.log.write("\nWARNING: Concurrent model fitting not supported on this platform - running analyses one at a time\n")
+        concurrent = False
+    if concurrent:
+        wsp.log.write("\nRunning %i model fitting analyses using %i workers\n" % (len(jobs), nworkers))
+        _prepare_jobs(wsp)
+
+    # Workspaces are created up front so the main workspace is not modified
+    # by the worker processes
+    job_wsps = []
+    for name, options, roi in jobs:
+        kwargs = {}
+        if concurrent:
+            log = Tee()
+            fsllog = {"stderr" : log}
+            if wsp.debug or wsp.log_cmds:
+                fsllog["cmd"] = log
+            if wsp.debug or wsp.log_cmdout:
+                fsllog["stdout"] = log
+            kwargs = {"log" : log, "fsllog" : fsllog, "report" : Report(title="Output: %s" % name)}
+        basil_wsp = wsp.sub("basil_%s" % name, **kwargs)
+        basil_wsp.basil_options = options
+        basil_wsp.sub("rois")
+        basil_wsp.rois.mask = roi
+        output_wsp = wsp.sub("output_%s" % name, **kwargs)
+        output_wsp.rois = basil_wsp.rois
+        job_wsps.append((name, basil_wsp, output_wsp))
+
+    if not concurrent:
+        for job in job_wsps:
+            _run_job(job)
+        return
+
+    report_dirs = [tempfile.mkdtemp("_oxasl_report") for _ in job_wsps]
+    for report_dir in report_dirs:
+        atexit.register(shutil.rmtree, report_dir, True)
+    _JOBS[:] = [job + (os.path.join(report_dir, "report"),) for job, report_dir in zip(job_wsps, report_dirs)]
+    pool = multiprocessing.get_context("fork").Pool(nworkers, initializer=_init_job_process)
+    try:
+        logs = pool.map(_run_job_process, range(len(job_wsps)))
+    finally:
+        pool.close()
+        pool.join()
+        del _JOBS[:]
+
+    for (name, _, _), log, report_dir in zip(job_wsps, logs, report_dirs):
+        wsp.log.write(log)
+        wsp.report.add(name, BuiltReport(os.path.join(report_dir, "report")))
 
 def redo_reg(wsp, pwi):
     """
@@ -410,6 +573,15 @@ OUTPUT_ITEMS = {
     "asldata_diff" : ("asldata_diff", 1, False, "", "", ""),
 }
 
+def _expand(factor, ndim):
+    """
+    :return: Voxelwise factor with trailing dimensions added so it can be broadcast
+             against data with ``ndim`` dimensions. Scalars are returned unchanged
+    """
+    if isinstance(factor, np.ndarray) and factor.ndim < ndim:
+        return factor.reshape(list(factor.shape) + [1] * (ndim - factor.ndim))
+    return factor
+
 def output_native(wsp, basil_wsp, report=None):
     """
     Create native space output images
@@ -426,14 +598,24 @@ def output_native(wsp, basil_wsp, report=None):
         prefixes.append("std")
     if wsp.output_var:
         prefixes.append("var")
+
+    # Sensitivity correction and calibration are combined into a single voxelwise
+    # factor for each multiplier and for values/variances, calculated on first use
+    inv_sens = None
+    if wsp.senscorr is not None:
+        inv_sens = 1 / wsp.senscorr.sensitivity.data
+    if wsp.calib is not None:
+        alpha = wsp.ifnone("calib_alpha", 1.0 if wsp.asldata.iaf in ("ve", "vediff") else 0.85 if wsp.asldata.casl else 0.98)
+    calib_factors = {}
+    outside_mask = wsp.rois.mask.data == 0
+
     for fabber_name, oxasl_output in OUTPUT_ITEMS.items():
         for prefix in prefixes:
             is_variance = prefix == "var"
             if is_variance:
                 # Variance is not output by Fabber natively so we get it by
-                # squaring the standard deviation. We also pass the flag
-                # to the calibration routine so it can square the correction
-                # factors
+                # squaring the standard deviation. We also square the
+                # calibration factors
                 fabber_output = "std_%s" % fabber_name
             elif prefix:
                 fabber_output = "%s_%s" % (prefix, fabber_name)
@@ -442,29 +624,35 @@ def output_native(wsp, basil_wsp, report=None):
 
             img = basil_wsp.finalstep.ifnone(fabber_output, None)
             if img is not None:
-                # Make negative/nan values = 0 and ensure masked value zeroed
-                data = np.copy(img.data)
-                data[~np.isfinite(data)] = 0
-                data[img.data < 0] = 0
-                data[wsp.rois.mask.data == 0] = 0
-                img = Image(data, header=img.header)
+                # Model fitting output may be cropped to the mask bounding box
+                img = crop.uncrop_image(img, basil_wsp.finalstep.bbox, wsp.rois.mask)
                 name, multiplier, calibrate, _, _, _ = oxasl_output
                 if prefix and prefix != "mean":
                     name = "%s_%s" % (name, prefix)
 
-                if calibrate:
-                    # Anything that needs calibration also requires sensitivity correction
-                    img, = corrections.apply_sensitivity_correction(wsp, img)
+                # Anything that needs calibration also requires sensitivity correction
+                sens_corr = calibrate and inv_sens is not None
+                dtype = np.result_type(img.data, inv_sens) if sens_corr else img.data.dtype
+                data = np.array(img.data, dtype=dtype)
 
+                # Make negative/nan values = 0 and ensure masked value zeroed
+                data[~np.isfinite(data)] = 0
+                data[data < 0] = 0
+                data[outside_mask] = 0
+                if sens_corr:
+                    wsp.log.write(" - Applying sensitivity correction\n")
+                    data *= _expand(inv_sens, data.ndim)
                 if is_variance:
-                    img = Image(np.square(img.data), header=img.header)
-                setattr(wsp.native, name, img)
+                    np.square(data, out=data)
+                setattr(wsp.native, name, Image(data, header=img.header))
 
                 if calibrate and wsp.calib is not None:
-                    alpha = wsp.ifnone("calib_alpha", 1.0 if wsp.asldata.iaf in ("ve", "vediff") else 0.85 if wsp.asldata.casl else 0.98)
-                    img = calib.calibrate(wsp, img, multiplier=multiplier, alpha=alpha, var=is_variance)
-                    name = "%s_calib" % name
-                    setattr(wsp.native, name, img)
+                    key = (multiplier, is_variance)
+                    if key not in calib_factors:
+                        wsp.log.write("\nCalculating calibration factor (multiplier=%f, variance=%s)\n" % (multiplier, is_variance))
+                        calib_factors[key] = calib.get_calibration_factor(wsp, multiplier=multiplier, alpha=alpha, var=is_variance)
+                    calibrated = data * _expand(calib_factors[key], data.ndim)
+                    setattr(wsp.native, "%s_calib" % name, Image(calibrated, header=img.header))
 
     if wsp.save_mask:
         wsp.native.mask = wsp.rois.mask
@@ -482,8 +670,7 @@ def output_report(wsp, report=None):
 
     roi = wsp.rois.mask.data
     if wsp.structural.struc is not None:
-        gm = reg.struc2asl(wsp, wsp.structural.gm_pv).data
-        wm = reg.struc2asl(wsp, wsp.structural.wm_pv).data
+        _, gm, wm = [pve.data for pve in struc.get_pves_asl(wsp)]
 
     for oxasl_name, multiplier, calibrate, units, normal_gm, normal_wm in OUTPUT_ITEMS.values():
         name = oxasl_name + "_calib"
@@ -514,42 +701,85 @@ def output_report(wsp, report=None):
             page.table(table, headers=["Metric", "Value", "Typical"])
 
             page.heading("Image", level=1)
-            page.image("%s_img" % name, LightboxImage(img, zeromask=False, mask=wsp.rois.mask, colorbar=True))
+            page.image("%s_img" % name, LightboxImage(img, zeromask=False, mask=wsp.rois.mask, colorbar=True, crop=bool(wsp.crop)))
+
+# Native space outputs which are transformed into structural/standard space
+TRANS_OUTPUTS = ("perfusion", "aCBV", "arrival", "perfusion_wm", "arrival_wm", "modelfit")
+TRANS_SUFFIXES = ("", "_std", "_var", "_calib", "_std_calib", "_var_calib")
+
+def _stack_outputs(wsp):
+    """
+    Stack 3D native space outputs into a single 4D image so they can be transformed together
+
+    :return: Tuple of sequence of output names and 4D Image, or None if there are no outputs
+    """
+    names, data = [], []
+    for suffix in TRANS_SUFFIXES:
+        for output in TRANS_OUTPUTS:
+            native_output = getattr(wsp.native, output + suffix)
+            # Don't transform 4D output (e.g. modelfit) - too large!
+            if native_output is not None and native_output.ndim == 3:
+                names.append(output + suffix)
+                data.append(native_output.data.astype(np.float32))
+    if not names:
+        return names, None
+    return names, Image(np.stack(data, axis=-1), header=getattr(wsp.native, names[0]).header)
+
+def _split_outputs(wsp, names, stacked):
+    """
+    Save each volume of a transformed 4D stack of outputs in the workspace
+    """
+    for idx, name in enumerate(names):
+        setattr(wsp, name, Image(stacked.data[..., idx], header=stacked.header))
 
 def output_trans(wsp):
     """
     Create transformed output, i.e. in structural and/or standard space
 
-    FIXME ugly code duplication
+    All 3D outputs are stacked into a single 4D image so that only one
+    transformation is required for each output space. Masks are transformed
+    separately so they can be binarised.
     """
-    if wsp.output_struc and wsp.reg.asl2struc is not None:
+    output_mni = wsp.output_mni
+    if output_mni and wsp.reg.struc2asl is None:
+        wsp.log.write("\nGenerating output in standard (MNI) space\n")
+        wsp.log.write(" - WARNING: No structural registration - cannot output in standard space\n")
+        output_mni = False
+
+    output_struc = wsp.output_struc and wsp.reg.asl2struc is not None
+    if not output_struc and not output_mni:
+        return
+
+    if output_struc:
         wsp.log.write("\nGenerating output in structural space\n")
+    else:
+        wsp.log.write("\nGenerating output in standard (MNI) space\n")
+
+    names, stacked = _stack_outputs(wsp)
+    masks = [("mask" + suffix, getattr(wsp.native, "mask" + suffix)) for suffix in TRANS_SUFFIXES]
+    masks = [(name, mask) for name, mask in masks if mask is not None and mask.ndim == 3]
+    if stacked is not None:
+        stacked = reg.asl2struc(wsp, stacked)
+    masks = [(name, reg.asl2struc(wsp, mask, mask=True)) for name, mask in masks]
+
+    if output_struc:
         wsp.sub("struct")
-        for suffix in ("", "_std", "_var", "_calib", "_std_calib", "_var_calib"):
-            for output in ("perfusion", "aCBV", "arrival", "perfusion_wm", "arrival_wm", "modelfit", "mask"):
-                native_output = getattr(wsp.native, output + suffix)
-                # Don't transform 4D output (e.g. modelfit) - too large!
-                if native_output is not None and native_output.ndim == 3:
-                    if wsp.reg.asl2struc is not None:
-                        setattr(wsp.struct, output + suffix, reg.asl2struc(wsp, native_output, mask=(output == 'mask')))
+        if stacked is not None:
+            _split_outputs(wsp.struct, names, stacked)
+        for name, mask in masks:
+            setattr(wsp.struct, name, mask)
         wsp.log.write(" - DONE\n")
 
-    if wsp.output_mni:
-        wsp.log.write("\nGenerating output in standard (MNI) space\n")
-        if wsp.reg.struc2asl is None:
-            wsp.log.write(" - WARNING: No structural registration - cannot output in standard space\n")
-        else:
-            reg.reg_struc2std(wsp)
-            wsp.sub("mni")
-            for suffix in ("", "_std", "_var", "_calib", "_std_calib", "_var_calib"):
-                for output in ("perfusion", "aCBV", "arrival", "perfusion_wm", "arrival_wm", "modelfit", "mask"):
-                    native_output = getattr(wsp.native, output + suffix)
-                    # Don't transform 4D output (e.g. modelfit) - too large!
-                    if native_output is not None and native_output.ndim == 3:
-                        struc_output = reg.asl2struc(wsp, native_output, mask=(output == 'mask'))
-                        setattr(wsp.mni, output + suffix, reg.struc2std(wsp, struc_output))
-
-            wsp.log.write(" - DONE\n")
+    if output_mni:
+        if output_struc:
+            wsp.log.write("\nGenerating output in standard (MNI) space\n")
+        reg.reg_struc2std(wsp)
+        wsp.sub("mni")
+        if stacked is not None:
+            _split_outputs(wsp.mni, names, reg.struc2std(wsp, stacked))
+        for name, mask in masks:
+            setattr(wsp.mni, name, reg.struc2std(wsp, mask))
+        wsp.log.write(" - DONE\n")
 
 def do_cleanup(wsp):
     """
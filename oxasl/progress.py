@@ -0,0 +1,281 @@
+"""
+Structured progress reporting
+
+Long running parts of the pipeline (in particular model fitting) report their
+progress as a stream of events. Each event is a dictionary containing:
+
+ - ``time``    : Unix time the event was generated
+ - ``stage``   : Name of the processing stage, e.g. ``preproc``, ``basil``
+ - ``status``  : ``started``, ``running``, ``finished`` or ``failed``
+ - ``step``    : Current step number within the stage (1-based), or None
+ - ``nsteps``  : Number of steps in the stage, or None if not known
+ - ``desc``    : Description of the current step, or None
+ - ``step_percent`` : Percentage completion of the current step, or None
+ - ``percent`` : Percentage completion of the stage, or None if not known
+ - ``eta``     : Estimated time to completion of the stage in seconds, or None
+ - ``elapsed`` : Time since the stage started in seconds
+
+Events are passed to any number of sinks, which are callables taking the
+event dictionary as their only argument. Sinks are provided to write events
+to a JSON-lines file and to export the latest state as metrics which can
+be used to detect stalled jobs:
+
+    progress = Progress(JsonLinesSink("progress.jsonl"))
+    with progress.stage("basil", nsteps=2) as stage:
+        stage.step(1, "VB - Tissue")
+        fabber(options, progress_cb=stage.callback())
+
+The ``Progress`` object for a workspace is given by ``get_progress``. This
+uses the ``progress`` attribute if set, otherwise creates sinks based on the
+``progress_file`` and ``progress_metrics_file`` attributes.
+
+Copyright (c) 2008-2018 University of Oxford
+"""
+import os
+import json
+import time
+import threading
+
+class Progress(object):
+    """
+    Dispatches progress events to a set of sinks
+    """
+
+    def __init__(self, *sinks):
+        self.sinks = [sink for sink in sinks if sink is not None]
+        self._lock = threading.Lock()
+
+    def add_sink(self, sink):
+        """
+        Add a sink to receive progress events
+        """
+        self.sinks.append(sink)
+
+    def event(self, stage, status="running", **kwargs):
+        """
+        Send a progress event to all sinks
+
+        :param stage: Name of processing stage
+        :param status: Status string
+        :param kwargs: Additional event fields as described in the module documentation
+        """
+        if not self.sinks:
+            return
+        event = {
+            "time" : time.time(),
+            "stage" : stage,
+            "status" : status,
+            "step" : None,
+            "nsteps" : None,
+            "desc" : None,
+            "step_percent" : None,
+            "percent" : None,
+            "eta" : None,
+            "elapsed" : None,
+        }
+        event.update(kwargs)
+        # Sinks may be shared between stages running in different threads
+        with self._lock:
+            for sink in self.sinks:
+                sink(event)
+
+    def stage(self, name, nsteps=None):
+        """
+        :return: ``StageProgress`` for a named stage, usable as a context manager
+        """
+        return StageProgress(self, name, nsteps)
+
+class StageProgress(object):
+    """
+    Tracks progress through the steps of a single processing stage
+
+    The ETA is estimated from the progress through the current step and the
+    mean time taken by completed steps.
+    """
+
+    def __init__(self, progress, name, nsteps=None):
+        self.progress = progress
+        self.name = name
+        self.nsteps = nsteps
+        self.start_time = None
+        self.step_num = None
+        self.desc = None
+        self._step_start = None
+        self._step_times = []
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.finish()
+        else:
+            self._event("failed", desc=str(exc_value))
+
+    def _event(self, status, **kwargs):
+        elapsed = None
+        if self.start_time is not None:
+            elapsed = time.time() - self.start_time
+        fields = {"step" : self.step_num, "nsteps" : self.nsteps, "desc" : self.desc, "elapsed" : elapsed}
+        fields.update(kwargs)
+        self.progress.event(self.name, status, **fields)
+
+    def start(self):
+        """
+        Mark the start of the stage
+        """
+        self.start_time = time.time()
+        self._event("started", percent=0.0)
+
+    def finish(self):
+        """
+        Mark the completion of the stage
+        """
+        self._end_step()
+        self._event("finished", percent=100.0, eta=0.0)
+
+    def _end_step(self):
+        if self._step_start is not None:
+            self._step_times.append(time.time() - self._step_start)
+            self._step_start = None
+
+    def step(self, step_num, desc=None):
+        """
+        Mark the start of a step within the stage
+
+        :param step_num: Step number (1-based)
+        :param desc: Description of the step
+        """
+        self._end_step()
+        self.step_num = step_num
+        self.desc = desc
+        self._step_start = time.time()
+        self.update(0)
+
+    def update(self, step_percent):
+        """
+        Report progress through the current step
+
+        :param step_percent: Percentage completion of the current step
+        """
+        percent, eta = None, None
+        if self.nsteps and self.step_num:
+            done_steps = self.step_num - 1 + float(step_percent) / 100
+            percent = 100 * done_steps / self.nsteps
+
+            # Estimate time for the rest of the current step from its progress so
+            # far and time for remaining steps from the mean of completed steps
+            step_elapsed = time.time() - self._step_start
+            step_eta = None
+            if step_percent > 0:
+                step_eta = step_elapsed * (100 - step_percent) / step_percent
+            if self._step_times:
+                mean_step = sum(self._step_times) / len(self._step_times)
+            elif step_eta is not None:
+                mean_step = step_elapsed + step_eta
+            else:
+                mean_step = None
+            if step_eta is not None and mean_step is not None:
+                eta = step_eta + (self.nsteps - self.step_num) * mean_step
+        self._event("running", step_percent=float(step_percent), percent=percent, eta=eta)
+
+    def callback(self):
+        """
+        :return: Progress callback suitable for passing to the Fabber API, taking
+                 the number of voxels done and the total number of voxels. Events
+                 are only generated when the integer percentage changes. If there
+                 are no progress sinks, returns None
+        """
+        if not self.progress.sinks:
+            return None
+
+        last = [None]
+        def _progress(done, total):
+            if total > 0:
+                percent = int(100 * done / total)
+                if percent != last[0]:
+                    last[0] = percent
+                    self.update(percent)
+        return _progress
+
+class JsonLinesSink(object):
+    """
+    Progress sink which appends each event to a file as a line of JSON
+    """
+
+    def __init__(self, fname):
+        self.fname = fname
+
+    def __call__(self, event):
+        with open(self.fname, "a") as outfile:
+            outfile.write(json.dumps(event, sort_keys=True) + "\n")
+
+class MetricsSink(object):
+    """
+    Progress sink which keeps the latest state of each stage
+
+    If a file name is given, the state is written to it in the Prometheus text
+    exposition format after each event, replacing the previous content. This is
+    suitable for collection by the node exporter textfile collector.
+    """
+
+    def __init__(self, fname=None):
+        self.fname = fname
+        self.latest = {}
+
+    def __call__(self, event):
+        self.latest[event["stage"]] = dict(event)
+        if self.fname:
+            tmpfile = "%s.tmp%i" % (self.fname, os.getpid())
+            with open(tmpfile, "w") as outfile:
+                outfile.write(self.metrics())
+            os.rename(tmpfile, self.fname)
+
+    def stalled(self, timeout):
+        """
+        :param timeout: Time in seconds
+        :return: List of names of stages which are in progress but have not
+                 reported any progress for longer than ``timeout``
+        """
+        now = time.time()
+        return [stage for stage, event in sorted(self.latest.items())
+                if event["status"] in ("started", "running") and now - event["time"] > timeout]
+
+    def metrics(self):
+        """
+        :return: Latest state of each stage in Prometheus text exposition format
+        """
+        metrics = [
+            ("oxasl_progress_percent", "Percentage completion of processing stage", "percent"),
+            ("oxasl_progress_eta_seconds", "Estimated time to completion of processing stage", "eta"),
+            ("oxasl_progress_elapsed_seconds", "Time since processing stage started", "elapsed"),
+            ("oxasl_progress_step", "Current step number within processing stage", "step"),
+            ("oxasl_progress_nsteps", "Number of steps in processing stage", "nsteps"),
+            ("oxasl_progress_last_update_timestamp_seconds", "Unix time of last progress update", "time"),
+        ]
+        lines = []
+        for name, desc, key in metrics:
+            lines.append("# HELP %s %s" % (name, desc))
+            lines.append("# TYPE %s gauge" % name)
+            for stage, event in sorted(self.latest.items()):
+                if event.get(key) is not None:
+                    lines.append('%s{stage="%s",status="%s"} %s' % (name, stage, event["status"], repr(float(event[key]))))
+        return "\n".join(lines) + "\n"
+
+def get_progress(wsp):
+    """
+    Get the progress reporter for a workspace
+
+    :return: ``Progress`` instance from the ``progress`` workspace attribute. If
+             not set, one is created with sinks for the ``progress_file`` and
+             ``progress_metrics_file`` attributes and stored in the workspace
+    """
+    if wsp.progress is None:
+        sinks = []
+        if wsp.progress_file:
+            sinks.append(JsonLinesSink(wsp.progress_file))
+        if wsp.progress_metrics_file:
+            sinks.append(MetricsSink(wsp.progress_metrics_file))
+        wsp.progress = Progress(*sinks)
+    return wsp.progress
@@ -0,0 +1,244 @@
+"""
+Batch recalibration of existing OXASL output
+
+Reprocessing a study often only requires the calibration to be redone, for
+example with a different calibration gain, reference tissue type or partition
+coefficient. This module recalculates M0 and the calibrated output images from
+existing OXASL output directories without repeating preprocessing or model
+fitting::
+
+    oxasl_recalib --calib-gain 1.2 --workers 8 --summary recalib.csv sub-*/oxasl_out
+
+The following items are read from each OXASL output directory, so the original
+run must have saved its intermediate data (e.g. using ``--save-all``):
+
+ - ``input/_oxasl.yml`` : Options used in the original run. Calibration options
+                          given on the command line override these
+ - ``corrected/calib`` or ``input/calib`` : Calibration image
+ - ``rois/mask`` or ``output/native/mask`` : Brain mask in ASL space
+ - ``calibration/refmask`` : Reference region mask in ASL space (reference
+                             region calibration only)
+ - ``input/sens`` : Sensitivity image (reference region calibration only)
+ - ``output*/native`` : Uncalibrated native space output
+
+Recalibrated output is written to a new sub-directory (by default ``recalib``)
+of each output directory with the same layout as the original output. Output
+in structural and standard space is only recalibrated when M0 is a single
+value, since voxelwise M0 would need to be transformed into those spaces.
+
+Copyright (c) 2008-2018 University of Oxford
+"""
+import os
+import sys
+import csv
+import glob
+import shutil
+import multiprocessing
+from optparse import OptionGroup
+
+import six
+import numpy as np
+import yaml
+
+from fsl.data.image import Image
+
+from oxasl import Workspace, calib
+from oxasl.options import AslOptionParser, GenericOptions
+from oxasl.oxford_asl import OUTPUT_ITEMS
+
+SUMMARY_COLUMNS = ["subject", "status", "calib_method", "m0", "noutputs", "error"]
+
+def _find_image(subjdir, *names):
+    """
+    :return: The first of a sequence of images which exists in a directory, or None
+    """
+    for name in names:
+        fnames = sorted(glob.glob(os.path.join(subjdir, name) + ".nii*"))
+        if fnames:
+            return Image(fnames[0])
+    return None
+
+def load_options(subjdir):
+    """
+    :param subjdir: OXASL output directory
+    :return: Dictionary of the options used in the original run
+    """
+    fname = os.path.join(subjdir, "input", "_oxasl.yml")
+    if not os.path.exists(fname):
+        raise ValueError("No saved options found in %s - was the original run done with --save-all?" % subjdir)
+    with open(fname) as infile:
+        return yaml.safe_load(infile) or {}
+
+def recalibrate(subjdir, output_name="recalib", overwrite=False, **overrides):
+    """
+    Recalibrate the output in an existing OXASL output directory
+
+    :param subjdir: OXASL output directory
+    :param output_name: Name of sub-directory to save recalibrated output in
+    :param overwrite: If True, overwrite existing recalibrated output
+    :param overrides: Calibration options which override the options used in
+                      the original run
+    :return: Dictionary containing the summary for this subject (see ``SUMMARY_COLUMNS``)
+    """
+    outdir = os.path.join(subjdir, output_name)
+    if os.path.exists(outdir):
+        if not overwrite:
+            raise ValueError("Output directory %s already exists - use --overwrite to replace it" % outdir)
+        shutil.rmtree(outdir)
+
+    options = load_options(subjdir)
+    options.update(overrides)
+    for name in ("log", "report", "fsllog"):
+        options.pop(name, None)
+
+    calib_img = _find_image(subjdir, os.path.join("corrected", "calib"), os.path.join("input", "calib"))
+    if calib_img is None:
+        raise ValueError("No calibration image found in %s" % subjdir)
+    mask = _find_image(subjdir, os.path.join("rois", "mask"), os.path.join("output", "native", "mask"))
+    if "refmask" not in options:
+        refmask = _find_image(subjdir, os.path.join("calibration", "refmask"))
+        if refmask is not None:
+            # Reference mask from the original run is already in ASL space
+            options.update({"refmask" : refmask, "calib_aslreg" : True})
+    sens = _find_image(subjdir, os.path.join("input", "sens"))
+    if sens is not None:
+        options["sens"] = sens
+
+    log = six.StringIO()
+    try:
+        wsp = Workspace(savedir=outdir, log=log, calib=calib_img, **options)
+        wsp.log.write("Recalibrating OXASL output in %s\n" % subjdir)
+        if mask is not None:
+            wsp.sub("rois")
+            wsp.rois.mask = mask
+
+        calib.calculate_m0(wsp)
+        voxelwise_m0 = isinstance(wsp.calibration.m0, Image)
+        alpha = wsp.ifnone("calib_alpha", 1.0 if wsp.iaf in ("ve", "vediff") else 0.85 if wsp.casl else 0.98)
+        factors = {}
+        noutputs = 0
+        for output_dir in sorted(glob.glob(os.path.join(subjdir, "output*"))):
+            output_wsp = None
+            for space in ("native", "struct", "mni"):
+                if not os.path.isdir(os.path.join(output_dir, space)):
+                    continue
+                if voxelwise_m0 and space != "native":
+                    wsp.log.write(" - WARNING: Voxelwise M0 - not recalibrating %s space output in %s\n" % (space, output_dir))
+                    continue
+
+                for name, multiplier, calibrate, _, _, _ in OUTPUT_ITEMS.values():
+                    if not calibrate:
+                        continue
+                    for suffix in ("", "_std", "_var"):
+                        img = _find_image(output_dir, os.path.join(space, name + suffix))
+                        if img is None:
+                            continue
+                        is_variance = suffix == "_var"
+                        key = (multiplier, is_variance)
+                        if key not in factors:
+                            factors[key] = calib.get_calibration_factor(wsp, multiplier=multiplier, alpha=alpha, var=is_variance)
+                        factor = factors[key]
+                        if voxelwise_m0 and img.ndim > factor.ndim:
+                            factor = factor.reshape(list(factor.shape) + [1] * (img.ndim - factor.ndim))
+
+                        if output_wsp is None:
+                            output_wsp = wsp.sub(os.path.basename(output_dir))
+                        if getattr(output_wsp, space) is None:
+                            output_wsp.sub(space)
+                        setattr(getattr(output_wsp, space), name + suffix + "_calib", Image(img.data * factor, header=img.header))
+                        noutputs += 1
+
+        m0 = wsp.calibration.m0
+        if isinstance(m0, Image):
+            m0 = np.mean(m0.data[m0.data > 0]) if np.any(m0.data > 0) else 0.0
+        wsp.log.write("\nRecalibrated %i output images\n" % noutputs)
+    finally:
+        if os.path.isdir(outdir):
+            with open(os.path.join(outdir, "logfile"), "w") as logfile:
+                logfile.write(log.getvalue())
+
+    return {
+        "subject" : subjdir,
+        "status" : "ok",
+        "calib_method" : options.get("calib_method", ""),
+        "m0" : float(m0),
+        "noutputs" : noutputs,
+        "error" : "",
+    }
+
+def _recalibrate_job(args):
+    subjdir, kwargs = args
+    try:
+        return recalibrate(subjdir, **kwargs)
+    except Exception as exc:
+        return {"subject" : subjdir, "status" : "failed", "calib_method" : "", "m0" : "", "noutputs" : 0, "error" : str(exc)}
+
+def recalibrate_batch(subjdirs, nworkers=1, summary=None, log=sys.stdout, **kwargs):
+    """
+    Recalibrate the output in multiple OXASL output directories
+
+    Failures are recorded in the summary rather than stopping the batch.
+
+    :param subjdirs: Sequence of OXASL output directories
+    :param nworkers: Number of processes to use
+    :param summary: Optional file name to write a CSV summary of results to
+    :param log: Stream for progress reporting
+    :param kwargs: Keyword arguments passed to ``recalibrate``
+    :return: List of summary dictionaries, one for each subject in order
+    """
+    jobs = [(subjdir, kwargs) for subjdir in subjdirs]
+    if nworkers > 1:
+        pool = multiprocessing.Pool(nworkers)
+        try:
+            results = pool.map(_recalibrate_job, jobs)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        results = [_recalibrate_job(job) for job in jobs]
+
+    for result in results:
+        if result["status"] == "ok":
+            log.write(" - %s: M0=%s (%i outputs)\n" % (result["subject"], result["m0"], result["noutputs"]))
+        else:
+            log.write(" - %s: FAILED: %s\n" % (result["subject"], result["error"]))
+
+    if summary:
+        with open(summary, "w") as outfile:
+            writer = csv.DictWriter(outfile, fieldnames=SUMMARY_COLUMNS)
+            writer.writeheader()
+            for result in results:
+                writer.writerow(result)
+    return results
+
+def main():
+    """
+    Entry point for oxasl_recalib command line program
+    """
+    parser = AslOptionParser(usage="oxasl_recalib [options] <oxasl output dir> [<oxasl output dir> ...]")
+    group = OptionGroup(parser, "Batch recalibration")
+    group.add_option("--output-name", help="Name of sub-directory for recalibrated output", default="recalib")
+    group.add_option("--summary", help="CSV file to write summary of M0 values to", default="recalib_summary.csv")
+    group.add_option("--workers", help="Number of subjects to process in parallel", type=int, default=1)
+    parser.add_option_group(group)
+    parser.add_category(GenericOptions(ignore=["output", "mask", "log-cmds", "log-cmdout"]))
+    parser.add_category(calib.CalibOptions(ignore=["calib", "perf", "refmask"]))
+
+    # Only calibration options given explicitly override those of the original run
+    parser.set_defaults(**dict([(option.dest, None) for option in parser._categories["calib"]]))
+    options, args = parser.parse_args()
+    if not args:
+        parser.print_help()
+        sys.exit(1)
+
+    overrides = dict([(key, value) for key, value in parser.filter(options, "calib").items() if value is not None])
+    if overrides:
+        sys.stdout.write("Overriding calibration options: %s\n" % ", ".join(["%s=%s" % item for item in sorted(overrides.items())]))
+    results = recalibrate_batch(args, nworkers=options.workers, summary=options.summary,
+                                output_name=options.output_name, overwrite=options.overwrite, **overrides)
+    sys.stdout.write("Recalibrated %i of %i subjects\n" % (len([r for r in results if r["status"] == "ok"]), len(results)))
+    if any([r["status"] != "ok" for r in results]):
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
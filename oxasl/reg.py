@@ -19,7 +19,7 @@ import numpy as np
 from fsl.data.image import Image
 import fsl.wrappers as fsl
 
-from oxasl import __version__, Workspace, struc, brain
+from oxasl import __version__, Workspace, struc, brain, resample
 from oxasl.options import AslOptionParser, GenericOptions, OptionCategory, IgnorableOptionGroup, load_matrix
 from oxasl.wrappers import epi_reg
 from oxasl.reporting import LightboxImage
@@ -239,14 +239,14 @@ def std2struc(wsp, img, **kwargs):
     """
     Transform an image from standard space to structural space
     """
-    return transform(wsp, img, wsp.reg.std2struc, wsp.structural.struc, **kwargs)
+    return transform(wsp, img, wsp.reg.std2struc, wsp.structural.struc, name="std2struc", **kwargs)
 
 def struc2std(wsp, img, **kwargs):
     """
     Transform an image from structural space to standard space
     """
     ref = Image(os.path.join(os.environ["FSLDIR"], "data/standard/MNI152_T1_2mm_brain"))
-    return transform(wsp, img, wsp.reg.struc2std, ref, **kwargs)
+    return transform(wsp, img, wsp.reg.struc2std, ref, name="struc2std", **kwargs)
 
 def struc2asl(wsp, img, **kwargs):
     """
@@ -256,7 +256,7 @@ def struc2asl(wsp, img, **kwargs):
     :return: Transformed Image object in ASL (native) space
     """
     init(wsp)
-    return transform(wsp, img, wsp.reg.struc2asl, wsp.nativeref, **kwargs)
+    return transform(wsp, img, wsp.reg.struc2asl, wsp.nativeref, name="struc2asl", **kwargs)
 
 def asl2struc(wsp, img, **kwargs):
     """
@@ -268,7 +268,7 @@ def asl2struc(wsp, img, **kwargs):
     :return: Transformed Image object in structural space
     """
     init(wsp)
-    return transform(wsp, img, wsp.reg.asl2struc, wsp.structural.struc, **kwargs)
+    return transform(wsp, img, wsp.reg.asl2struc, wsp.structural.struc, name="asl2struc", **kwargs)
 
 def calib2asl(wsp, img, **kwargs):
     """
@@ -278,7 +278,7 @@ def calib2asl(wsp, img, **kwargs):
     :return: Transformed Image object in ASL (native) space
     """
     init(wsp)
-    return transform(wsp, img, wsp.reg.calib2asl, wsp.nativeref, **kwargs)
+    return transform(wsp, img, wsp.reg.calib2asl, wsp.nativeref, name="calib2asl", **kwargs)
 
 def asl2calib(wsp, img, **kwargs):
     """
@@ -290,9 +290,9 @@ def asl2calib(wsp, img, **kwargs):
     :return: Transformed Image object in calibration space
     """
     init(wsp)
-    return transform(wsp, img, wsp.reg.asl2calib, wsp.structural.struc, **kwargs)
+    return transform(wsp, img, wsp.reg.asl2calib, wsp.structural.struc, name="asl2calib", **kwargs)
 
-def transform(wsp, img, trans, ref, use_flirt=False, interp="trilinear", paddingsize=1, premat=None, mask=False, mask_thresh=0.5):
+def transform(wsp, img, trans, ref, use_flirt=False, interp="trilinear", paddingsize=1, premat=None, mask=False, mask_thresh=0.5, engine=None, name=None):
     """
     Transform an image
 
@@ -304,15 +304,36 @@ def transform(wsp, img, trans, ref, use_flirt=False, interp="trilinear", padding
     :param interp: Interpolation method
     :param paddingsize: Padding size in pixels
     :param premat: If trans is a warp, this can be set to a pre-warp affine transformation matrix
+    :param engine: ``numpy`` to resample in-process or ``fsl`` to use FSL tools. Warps and
+                   interpolation methods not supported by ``oxasl.resample`` always use FSL.
+                   Default is taken from ``wsp.resample_engine``, or ``fsl`` if not set
+    :param name: Name of the transformation, e.g. ``struc2asl``. If given, the numpy engine
+                 caches the interpolation weights in ``wsp.reg`` for reuse by subsequent calls
 
     :return: Transformed Image object
     """
     if trans is None:
         raise ValueError("Transformation matrix not available - has registration been performed?")
 
+    if engine is None:
+        engine = wsp.ifnone("resample_engine", "fsl")
+    if engine not in ("numpy", "fsl"):
+        raise ValueError("Unknown resampling engine: %s" % engine)
+
     have_warp = isinstance(trans, Image)
     if use_flirt and have_warp:
         raise ValueError("Cannot transform using Flirt when we have a warp")
+    elif premat is not None and not have_warp:
+        raise ValueError("Can't set a pre-transformation matrix unless using a warp")
+    elif engine == "numpy" and not have_warp and interp in resample.INTERP_ORDER:
+        # Flirt does not supersample so neither do we when emulating it
+        operator = None
+        if name is not None:
+            operator = get_resampling_operator(wsp, name, trans, img, ref, interp=interp, paddingsize=paddingsize, supersample=not use_flirt)
+        if operator is not None:
+            ret = operator.apply(img)
+        else:
+            ret = resample.resample(img, trans, ref, interp=interp, paddingsize=paddingsize, supersample=not use_flirt)
     elif use_flirt:
         if interp == "nn":
             interp = "nearestneighbour"
@@ -320,8 +341,6 @@ def transform(wsp, img, trans, ref, use_flirt=False, interp="trilinear", padding
     else:
         if have_warp:
             kwargs = {"warp" : trans, "premat" : premat, "rel" : True}
-        elif premat:
-            raise ValueError("Can't set a pre-transformation matrix unless using a warp")
         else:
             kwargs = {"premat" : trans}
         ret = fsl.applywarp(img, ref, out=fsl.LOAD, interp=interp, paddingsize=paddingsize, super=True, superlevel="a", log=wsp.fsllog, **kwargs)["out"]
@@ -330,6 +349,31 @@ def transform(wsp, img, trans, ref, use_flirt=False, interp="trilinear", padding
         ret = Image((ret.data > mask_thresh).astype(np.int), header=ret.header)
     return ret
 
+def get_resampling_operator(wsp, name, trans, src, ref, interp="trilinear", paddingsize=1, supersample=True):
+    """
+    Get the resampling operator for a named transformation
+
+    Operators are cached in ``wsp.reg.resampling_ops`` and recreated if the
+    transformation or the image grids change.
+
+    :return: ``resample.ResamplingOperator`` or None if an operator cannot be used for
+             this interpolation method or would exceed ``resample.MAX_OPERATOR_SIZE``
+    """
+    if resample.INTERP_ORDER.get(interp, 3) > 1:
+        return None
+    if resample.ResamplingOperator.size_estimate(trans, src, ref, interp, supersample) > resample.MAX_OPERATOR_SIZE:
+        return None
+
+    init(wsp)
+    if wsp.reg.resampling_ops is None:
+        wsp.reg.resampling_ops = {}
+    key = (name, interp, paddingsize, supersample)
+    operator = wsp.reg.resampling_ops.get(key, None)
+    if operator is None or not operator.matches(trans, src, ref):
+        operator = resample.ResamplingOperator(trans, src, ref, interp=interp, paddingsize=paddingsize, supersample=supersample)
+        wsp.reg.resampling_ops[key] = operator
+    return operator
+
 def reg_flirt(wsp, img, ref, initial_transform=None):
     """
     Register low resolution ASL or calibration data to a high resolution
@@ -436,6 +480,7 @@ class RegOptions(OptionCategory):
 
         group = IgnorableOptionGroup(parser, "Registration", ignore=self.ignore)
         group.add_option("--regfrom", help="Registration image (e.g. perfusion weighted image)", type="image")
+        group.add_option("--resample-engine", help="Engine for applying affine transformations: fsl (applywarp) or numpy (in-process)", default="fsl")
         #group.add_option("--omat", help="Output file for transform matrix", default=None)
         #group.add_option("--bbr", dest="do_bbr", help="Include BBR registration step using EPI_REG", action="store_true", default=False)
         #group.add_option("--flirt", dest="do_flirt", help="Include rigid-body registration step using FLIRT", action="store_true", default=True)
@@ -79,6 +79,7 @@ class LightboxImage(object):
         :param zeromask: If True, treat zero values as transparent
         :param outline: If True, show image as an outline (assumes image is binarised)
         :param colorbar: If True, display colorbar
+        :param crop: If True, crop each slice to the in-plane extent of ``mask``
         """
         self._img = img
         self._bgimage = bgimage
@@ -87,6 +88,7 @@ class LightboxImage(object):
         self._outline = kwargs.get("outline", False)
         self._colorbar = kwargs.get("colorbar", False)
         self._clamp_colors = kwargs.get("clamp_colors", True)
+        self._crop = kwargs.get("crop", False)
         self.extension = ".png"
 
     def _slicerange(self, img, shape):
@@ -97,6 +99,17 @@ class LightboxImage(object):
         else:
             return 0, shape[2]-1
 
+    def _inplane_range(self, mask, margin=2):
+        """
+        :return: Tuple of x and y slices covering the nonzero region of a mask plus a
+                 margin, or the full slice if no mask
+        """
+        if mask is not None:
+            nonzero = np.nonzero(mask.data)
+            if len(nonzero[0]) > 0:
+                return tuple([slice(max(np.min(nonzero[dim]) - margin, 0), np.max(nonzero[dim]) + margin + 1) for dim in (0, 1)])
+        return (slice(None), slice(None))
+
     def tofile(self, fname):
         """
         Write image to a file
@@ -119,6 +132,10 @@ class LightboxImage(object):
                 raise ValueError("Images do not have consistent shapes")
 
         min_slice, max_slice = self._slicerange(self._img, shape)
+        if self._crop:
+            inplane = self._inplane_range(self._mask)
+        else:
+            inplane = (slice(None), slice(None))
         num_slices = min(16, max_slice - min_slice + 1)
         grid_size = int(math.ceil(math.sqrt(num_slices)))
 
@@ -133,11 +150,11 @@ class LightboxImage(object):
             slice_idx = int(float((max_slice - min_slice + 1)*nslice)/num_slices) + min_slice
 
             if self._bgimage:
-                data = self._bgimage.data[:, :, slice_idx].T
+                data = self._bgimage.data[inplane + (slice_idx,)].T
                 axes.imshow(data, cmap='gray')
 
             if self._img:
-                data = self._img.data[:, :, slice_idx].T
+                data = self._img.data[inplane + (slice_idx,)].T
                 data[~np.isfinite(data)] = 0
 
                 if issubclass(data.dtype.type, np.integer):
@@ -157,7 +174,7 @@ class LightboxImage(object):
                     data = data - scipy.ndimage.morphology.binary_erosion(data, structure=np.ones((3, 3)))
 
                 if self._mask:
-                    data = np.ma.masked_array(data, self._mask.data[:, :, slice_idx].T == 0)
+                    data = np.ma.masked_array(data, self._mask.data[inplane + (slice_idx,)].T == 0)
                 elif self._zeromask:
                     data = np.ma.masked_array(data, data == 0)
 
@@ -206,6 +223,25 @@ class LineGraph(object):
 
         fig.savefig(fname, bbox_inches='tight')
 
+class BuiltReport(object):
+    """
+    A report which has already been written to a build directory, e.g. by
+    another process. The directory is copied when the report is written out
+    """
+
+    def __init__(self, build_dir):
+        """
+        :param build_dir: Directory containing the output of ``Report.tofile``
+        """
+        self.build_dir = build_dir
+        self.extension = ""
+
+    def tofile(self, dest_dir):
+        """
+        Copy the report content to a build directory
+        """
+        shutil.copytree(self.build_dir, dest_dir)
+
 class ReportPage(object):
     """
     Simple helper class for creating documents containing ReStructuredText
@@ -447,7 +483,7 @@ class Report(object):
         self._files[fname] = content
         if isinstance(content, ReportPage):
             self._contents.append(name)
-        if isinstance(content, Report):
+        if isinstance(content, (Report, BuiltReport)):
             self._contents.append(name + "/index")
         return name
 
@@ -0,0 +1,283 @@
+"""
+In-process resampling of images using affine transformations
+
+Applying a transformation using FSL's ``applywarp`` involves writing the input
+to a temporary file, running a subprocess and reading the output back. For
+affine transformations the same result can be obtained in-process by mapping
+each reference voxel into source voxel coordinates and interpolating the
+source data using ``scipy.ndimage.map_coordinates``::
+
+    asl_img = resample(struc_img, struc2asl, nativeref, interp="trilinear")
+
+Transformation matrices are FLIRT matrices, i.e. they map between FSL scaled
+voxel coordinates of the source and reference images, as used by ``applywarp
+--premat`` and ``flirt -applyxfm``.
+
+When the reference voxels are larger than the source voxels the output is
+supersampled in the same way as ``applywarp --super --superlevel=a``, i.e. each
+reference voxel is sampled at a grid of points within it and the results
+averaged.
+
+Where the same transformation is applied to many images, a ``ResamplingOperator``
+stores the interpolation weights as a sparse matrix so each subsequent
+transformation is a single sparse matrix multiplication::
+
+    op = ResamplingOperator(struc2asl, struc_img, nativeref)
+    gm_asl, wm_asl = op.apply(gm_pv), op.apply(wm_pv)
+
+Copyright (c) 2008-2018 University of Oxford
+"""
+import math
+import itertools
+
+import numpy as np
+import scipy.ndimage
+import scipy.sparse
+
+from fsl.data.image import Image
+
+# Interpolation methods supported and the corresponding spline order
+INTERP_ORDER = {
+    "nn" : 0,
+    "nearestneighbour" : 0,
+    "trilinear" : 1,
+    "spline" : 3,
+}
+
+# Maximum number of weights in a cached resampling operator (about 240Mb)
+MAX_OPERATOR_SIZE = 20000000
+
+def _vox2fsl(img):
+    """
+    :return: Matrix mapping voxel coordinates to FSL scaled voxel coordinates
+    """
+    if hasattr(img, "getAffine"):
+        return img.getAffine("voxel", "fsl")
+    else:
+        return img.voxToScaledVoxMat
+
+def vox2vox(trans, src, ref):
+    """
+    Get the voxel to voxel mapping corresponding to a FLIRT transformation matrix
+
+    :param trans: 4x4 FLIRT matrix from source to reference image
+    :param src: Source Image
+    :param ref: Reference Image
+    :return: 4x4 matrix mapping reference voxel coordinates to source voxel coordinates
+    """
+    return np.dot(np.linalg.inv(_vox2fsl(src)), np.dot(np.linalg.inv(trans), _vox2fsl(ref)))
+
+def supersampling_levels(mat):
+    """
+    Get the supersampling level along each axis of the reference image
+
+    This is the number of source voxels spanned by a single reference voxel
+    along each axis, rounded up.
+
+    :param mat: Reference to source voxel mapping matrix
+    :return: Sequence of 3 supersampling levels, each at least 1
+    """
+    return [max(1, int(math.ceil(np.linalg.norm(mat[:3, axis]) - 1e-3))) for axis in range(3)]
+
+def _subvoxel_offsets(levels):
+    """
+    :return: Array of shape [N, 3] of offsets of the sample points within a voxel
+    """
+    axis_offsets = [(np.arange(level) + 0.5) / level - 0.5 for level in levels]
+    return np.array(list(itertools.product(*axis_offsets)))
+
+def _outside(coords, shape, paddingsize):
+    """
+    :return: Boolean array, True for sample coordinates outside the padded source volume
+    """
+    outside = np.zeros(coords.shape[1], dtype=np.bool_)
+    for axis in range(3):
+        outside |= coords[axis] < -paddingsize - 1e-6
+        outside |= coords[axis] > shape[axis] - 1 + paddingsize + 1e-6
+    return outside
+
+def resample(img, trans, ref, interp="trilinear", paddingsize=1, supersample=True, chunk_size=1000000):
+    """
+    Resample an image onto the grid of a reference image using an affine transformation
+
+    :param img: Image to transform (3D or 4D)
+    :param trans: 4x4 FLIRT matrix from image to reference space
+    :param ref: Reference Image defining the output grid
+    :param interp: Interpolation method - ``trilinear``, ``nn`` or ``spline``
+    :param paddingsize: Number of voxels to extrapolate beyond the edge of the source volume
+    :param supersample: If True, supersample when reference voxels are larger than
+                        source voxels. Not used for nearest neighbour interpolation
+    :param chunk_size: Approximate number of reference voxels to process at once
+    :return: Transformed Image on the reference grid
+    """
+    if interp not in INTERP_ORDER:
+        raise ValueError("Unsupported interpolation method: %s" % interp)
+    order = INTERP_ORDER[interp]
+
+    mat = vox2vox(trans, img, ref)
+    if supersample and order > 0:
+        levels = supersampling_levels(mat)
+    else:
+        levels = [1, 1, 1]
+    offsets = _subvoxel_offsets(levels)
+
+    # Spline coefficients are calculated assuming mirror boundary conditions so
+    # the same must be used when interpolating
+    mode = "mirror" if order > 1 else "nearest"
+
+    src_shape = img.shape[:3]
+    data = img.data.reshape(list(src_shape) + [-1])
+    volumes = []
+    for vol in range(data.shape[3]):
+        vol_data = data[..., vol].astype(np.float64)
+        if order > 1:
+            vol_data = scipy.ndimage.spline_filter(vol_data, order=order)
+        volumes.append(vol_data)
+
+    ref_shape = list(ref.shape[:3])
+    output = np.zeros(ref_shape + [len(volumes)], dtype=np.float32)
+    chunk_slices = max(1, chunk_size // (ref_shape[0] * ref_shape[1]))
+    for z_start in range(0, ref_shape[2], chunk_slices):
+        z_end = min(z_start + chunk_slices, ref_shape[2])
+        chunk_shape = ref_shape[:2] + [z_end - z_start]
+        voxels = np.indices(chunk_shape).reshape(3, -1).astype(np.float64)
+        voxels[2] += z_start
+        chunk = np.zeros([voxels.shape[1], len(volumes)], dtype=np.float64)
+        for offset in offsets:
+            coords = np.dot(mat[:3, :3], voxels + offset[:, np.newaxis]) + mat[:3, 3:]
+            outside = _outside(coords, src_shape, paddingsize)
+            for vol, vol_data in enumerate(volumes):
+                values = scipy.ndimage.map_coordinates(vol_data, coords, order=order, mode=mode, prefilter=False)
+                values[outside] = 0
+                chunk[:, vol] += values
+        chunk /= len(offsets)
+        output[:, :, z_start:z_end, :] = chunk.reshape(chunk_shape + [len(volumes)])
+
+    if img.ndim == 3:
+        output = output[..., 0]
+    return Image(output, header=ref.header)
+
+class ResamplingOperator(object):
+    """
+    Precomputed resampling from a source grid to a reference grid
+
+    The interpolation weights for a given transformation, source grid and
+    reference grid are stored as a sparse matrix, so the same transformation
+    can be applied to any number of 3D or 4D images by a sparse matrix
+    multiplication. Results are the same as ``resample`` with the same
+    arguments. Spline interpolation is not supported.
+    """
+
+    def __init__(self, trans, src, ref, interp="trilinear", paddingsize=1, supersample=True, chunk_size=4000000):
+        """
+        :param trans: 4x4 FLIRT matrix from source to reference space
+        :param src: Image defining the source grid
+        :param ref: Image defining the reference (output) grid
+        :param interp: Interpolation method - ``trilinear`` or ``nn``
+        :param paddingsize: Number of voxels to extrapolate beyond the edge of the source volume
+        :param supersample: If True, supersample when reference voxels are larger than
+                            source voxels. Not used for nearest neighbour interpolation
+        :param chunk_size: Approximate number of weights to calculate at once
+        """
+        if interp not in INTERP_ORDER or INTERP_ORDER[interp] > 1:
+            raise ValueError("Unsupported interpolation method for resampling operator: %s" % interp)
+        self.order = INTERP_ORDER[interp]
+        self.paddingsize = paddingsize
+        self.src_shape = tuple(src.shape[:3])
+        self.ref_shape = tuple(ref.shape[:3])
+        self.ref_header = ref.header
+        self.mat = vox2vox(trans, src, ref)
+        if supersample and self.order > 0:
+            self.levels = supersampling_levels(self.mat)
+        else:
+            self.levels = [1, 1, 1]
+        self.matrix = self._weights(chunk_size)
+
+    @staticmethod
+    def size_estimate(trans, src, ref, interp="trilinear", supersample=True):
+        """
+        :return: Upper bound on the number of nonzero weights of the operator, so
+                 the memory required can be checked before creating it
+        """
+        nref = np.prod(ref.shape[:3])
+        if INTERP_ORDER.get(interp, 0) == 0:
+            return int(nref)
+        levels = supersampling_levels(vox2vox(trans, src, ref)) if supersample else [1, 1, 1]
+        return int(nref * np.prod([level + 1 for level in levels]))
+
+    def matches(self, trans, src, ref):
+        """
+        :return: True if this operator implements the given transformation between the given grids
+        """
+        return (tuple(src.shape[:3]) == self.src_shape and tuple(ref.shape[:3]) == self.ref_shape and
+                np.allclose(vox2vox(trans, src, ref), self.mat))
+
+    def _sample_weights(self, coords):
+        """
+        :return: Tuple of source voxel indices and weights for a set of sample
+                 points, each of shape [number of corners, number of samples]
+        """
+        shape = np.array(self.src_shape)[:, np.newaxis]
+        # Equivalent of 'nearest' boundary mode - clamp to the edge of the volume
+        coords = np.clip(coords, 0, shape - 1)
+        if self.order == 0:
+            voxels = np.floor(coords + 0.5).astype(np.int64)
+            return np.ravel_multi_index(voxels, self.src_shape)[np.newaxis, :], np.ones([1, coords.shape[1]])
+
+        base = np.minimum(np.floor(coords), np.maximum(shape - 2, 0)).astype(np.int64)
+        frac = coords - base
+        indices, weights = [], []
+        for corner in itertools.product((0, 1), repeat=3):
+            corner = np.array(corner)[:, np.newaxis]
+            voxels = np.minimum(base + corner, shape - 1)
+            indices.append(np.ravel_multi_index(voxels, self.src_shape))
+            weights.append(np.prod(np.where(corner, frac, 1 - frac), axis=0))
+        return np.array(indices), np.array(weights)
+
+    def _weights(self, chunk_size):
+        """
+        :return: CSR matrix of shape [reference voxels, source voxels] of interpolation weights
+        """
+        offsets = _subvoxel_offsets(self.levels)
+        ncorners = 1 if self.order == 0 else 8
+        nsrc = int(np.prod(self.src_shape))
+        # Chunks are taken along the first axis so the rows of each chunk are
+        # contiguous in the flattened reference grid
+        chunk_slices = max(1, chunk_size // (self.ref_shape[1] * self.ref_shape[2] * len(offsets) * ncorners))
+        chunks = []
+        for x_start in range(0, self.ref_shape[0], chunk_slices):
+            x_end = min(x_start + chunk_slices, self.ref_shape[0])
+            chunk_shape = [x_end - x_start] + list(self.ref_shape[1:])
+            voxels = np.indices(chunk_shape).reshape(3, -1).astype(np.float64)
+            voxels[0] += x_start
+            rows, cols, vals = [], [], []
+            for offset in offsets:
+                coords = np.dot(self.mat[:3, :3], voxels + offset[:, np.newaxis]) + self.mat[:3, 3:]
+                inside = ~_outside(coords, self.src_shape, self.paddingsize)
+                indices, weights = self._sample_weights(coords[:, inside])
+                rows.append(np.broadcast_to(np.nonzero(inside)[0], indices.shape).ravel())
+                cols.append(indices.ravel())
+                vals.append(weights.ravel())
+            chunk = scipy.sparse.coo_matrix((np.concatenate(vals) / len(offsets), (np.concatenate(rows), np.concatenate(cols))),
+                                            shape=(voxels.shape[1], nsrc))
+            chunks.append(chunk.tocsr())
+        matrix = scipy.sparse.vstack(chunks, format="csr")
+        matrix.eliminate_zeros()
+        return matrix
+
+    def apply(self, img):
+        """
+        Apply the resampling to an image
+
+        :param img: 3D or 4D Image on the source grid
+        :return: Image on the reference grid
+        """
+        if tuple(img.shape[:3]) != self.src_shape:
+            raise ValueError("Image shape %s does not match resampling operator source grid %s" % (img.shape[:3], self.src_shape))
+        data = img.data.reshape(int(np.prod(self.src_shape)), -1)
+        output = self.matrix.dot(data.astype(np.float64)).astype(np.float32)
+        if img.ndim == 3:
+            output = output.reshape(self.ref_shape)
+        else:
+            output = output.reshape(list(self.ref_shape) + list(img.shape[3:]))
+        return Image(output, header=self.ref_header)
@@ -0,0 +1,143 @@
+"""
+Cache of derived standard space images
+
+Some processing steps use images derived from FSL standard space data which
+are the same for every subject, for example the ventricle mask used for CSF
+reference region calibration, which requires scanning the FSL atlases,
+loading the Harvard-Oxford subcortical atlas and eroding the mask. These are
+cached both in memory (for the lifetime of the process) and on disk, so a
+batch of runs only pays the cost of generating them once.
+
+Cached images are keyed by the FSL installation directory and the
+modification time and size of the files they are derived from, so a change
+to the FSL installation or atlas version results in the image being
+regenerated.
+
+The disk cache is a directory (by default ``~/.oxasl/std_cache``, can be
+overridden by setting the ``OXASL_STD_CACHE`` environment variable).
+
+Copyright (c) 2008-2018 University of Oxford
+"""
+import os
+import hashlib
+import threading
+
+import numpy as np
+import scipy.ndimage
+
+from fsl.data.image import Image
+from fsl.data.atlases import AtlasRegistry
+
+DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser("~"), ".oxasl", "std_cache")
+
+# Increment if the way any cached image is derived changes
+CACHE_VERSION = 1
+
+_MEMORY_CACHE = {}
+_LOCK = threading.Lock()
+
+def _fsldir():
+    return os.environ["FSLDIR"]
+
+def _file_signature(fname):
+    try:
+        stat = os.stat(fname)
+        return "%s:%i:%i" % (fname, int(stat.st_mtime), stat.st_size)
+    except OSError:
+        return "%s:missing" % fname
+
+def cache_key(name, source_files):
+    """
+    :param name: Name of cached image
+    :param source_files: Sequence of files the image is derived from
+    :return: Hex digest string identifying the image and the version of its source files
+    """
+    hasher = hashlib.sha1()
+    hasher.update(("%s:%i:%s" % (name, CACHE_VERSION, _fsldir())).encode("utf-8"))
+    for fname in source_files:
+        hasher.update(_file_signature(fname).encode("utf-8"))
+    return hasher.hexdigest()
+
+def cached_image(name, source_files, create, disk=True, log=None):
+    """
+    Get a cached image, generating it if required
+
+    :param name: Name of cached image
+    :param source_files: Sequence of files the image is derived from
+    :param create: Callable taking no arguments which generates the image
+    :param disk: If True, also cache the image on disk
+    :param log: Optional stream for logging cache failures
+    :return: Image
+    """
+    key = cache_key(name, source_files)
+    with _LOCK:
+        if key in _MEMORY_CACHE:
+            return _MEMORY_CACHE[key]
+
+    img = None
+    fname = os.path.join(os.environ.get("OXASL_STD_CACHE", DEFAULT_CACHE_DIR), "%s_%s.nii.gz" % (name, key))
+    if disk and os.path.isfile(fname):
+        try:
+            img = Image(fname, loadData=True)
+            # Make sure data is in memory in case the file is removed
+            img.data
+        except Exception as exc:
+            if log is not None:
+                log.write("WARNING: Failed to load cached image %s: %s\n" % (fname, exc))
+            img = None
+
+    if img is None:
+        img = create()
+        if disk:
+            tmpfile = "%s.tmp%i.nii.gz" % (fname[:-7], os.getpid())
+            try:
+                if not os.path.exists(os.path.dirname(fname)):
+                    os.makedirs(os.path.dirname(fname))
+                img.save(tmpfile)
+                os.rename(tmpfile, fname)
+            except Exception as exc:
+                # Caching on disk is optional
+                if log is not None:
+                    log.write("WARNING: Failed to cache image %s: %s\n" % (name, exc))
+                if os.path.exists(tmpfile):
+                    os.remove(tmpfile)
+
+    with _LOCK:
+        _MEMORY_CACHE[key] = img
+    return img
+
+def clear():
+    """
+    Clear the in-memory cache. The disk cache is not affected
+    """
+    with _LOCK:
+        _MEMORY_CACHE.clear()
+
+def std_brain():
+    """
+    :return: MNI152 2mm standard brain Image
+    """
+    fname = os.path.join(_fsldir(), "data", "standard", "MNI152_T1_2mm_brain.nii.gz")
+    return cached_image("MNI152_T1_2mm_brain", [fname],
+                        lambda: Image(os.path.join(_fsldir(), "data", "standard", "MNI152_T1_2mm_brain")),
+                        disk=False)
+
+def _create_ventricles():
+    atlases = AtlasRegistry()
+    atlases.rescanAtlases()
+    atlas = atlases.loadAtlas("harvardoxford-subcortical", loadSummary=False, resolution=2)
+    ventricles = ((atlas.data[..., 2] + atlas.data[..., 13]) > 0.1).astype(np.int32)
+    return Image(scipy.ndimage.binary_erosion(ventricles, structure=np.ones([3, 3, 3]), border_value=1).astype(np.int32), header=atlas.header)
+
+def ventricles_std(log=None):
+    """
+    :param log: Optional stream for logging cache failures
+    :return: Standard space ventricles mask from the Harvard-Oxford subcortical
+             atlas, eroded by 1 voxel
+    """
+    atlas_dir = os.path.join(_fsldir(), "data", "atlases")
+    source_files = [
+        os.path.join(atlas_dir, "HarvardOxford-Subcortical.xml"),
+        os.path.join(atlas_dir, "HarvardOxford", "HarvardOxford-sub-prob-2mm.nii.gz"),
+    ]
+    return cached_image("ventricles_std", source_files, _create_ventricles, log=log)
@@ -141,3 +141,36 @@ def segment(wsp):
         page.image("gm_pv", LightboxImage(wsp.structural.gm_pv, bgimage=wsp.structural.brain))
         page.text("White matter partial volume")
         page.image("wm_pv", LightboxImage(wsp.structural.wm_pv, bgimage=wsp.structural.brain))
+
+PVE_TISSUES = ("csf", "gm", "wm")
+
+def get_pves_asl(wsp):
+    """
+    Get tissue partial volume estimates in ASL (native) space
+
+    The CSF, GM and WM PVEs are stacked into a single 4D image so only one
+    transformation is required. The result is stored in the structural
+    workspace and reused until the structural->ASL registration changes.
+
+    Workspace attributes updated
+    ----------------------------
+
+     - ``structural.pves_asl`` : 4D Image of CSF, GM and WM PVEs in ASL space
+     - ``structural.pves_asl_trans`` : Structural->ASL transformation used
+
+    :return: Tuple of CSF, GM and WM PVE Images in ASL space
+    """
+    from oxasl import reg
+    segment(wsp)
+    reg.init(wsp)
+
+    trans = wsp.structural.pves_asl_trans
+    if wsp.structural.pves_asl is None or trans is None or not np.array_equal(trans, wsp.reg.struc2asl):
+        wsp.log.write(" - Transforming tissue PVEs into ASL space\n")
+        pves = np.stack([getattr(wsp.structural, "%s_pv" % tiss_type).data for tiss_type in PVE_TISSUES], axis=-1)
+        wsp.structural.pves_asl = reg.struc2asl(wsp, Image(pves, header=wsp.structural.struc.header))
+        wsp.structural.pves_asl_trans = wsp.reg.struc2asl
+
+    pves_asl = wsp.structural.pves_asl
+    return tuple([Image(pves_asl.data[..., idx], name="%s_pv_asl" % tiss_type, header=pves_asl.header)
+                  for idx, tiss_type in enumerate(PVE_TISSUES)])
@@ -287,6 +287,36 @@ def test_initmvn():
     })
     _check_step(steps[0], desc_text="tissue", options=options)
 
+def test_pop_priors():
+    """
+    Check native space population priors are added as image priors and the
+    perfusion prior is replaced by the spatial prior in the spatial step
+    """
+    d = np.random.rand(5, 5, 5, 6)
+    img = AslImage(name="asldata", image=d, tis=[1.5], order="prt")
+    wsp = Workspace(infertiss=True, inferbat=True, spatial=True, asldata=img)
+
+    wsp.pop_ftiss = Image(np.random.rand(5, 5, 5), header=img.header)
+    wsp.pop_ftiss_var = Image(np.full((5, 5, 5), 4.0), header=img.header)
+    steps = basil.basil_steps(wsp, img)
+    assert(len(steps) == 2)
+
+    options = _get_defaults(img)
+    _check_step(steps[0], desc_text="tissue",
+                options=dict(options, **{
+                    "PSP_byname1" : "ftiss",
+                    "PSP_byname1_type" : "I",
+                    "PSP_byname1_prec" : 0.25,
+                }))
+
+    _check_step(steps[1], desc_text="spatial",
+                options={
+                    "PSP_byname1" : "ftiss",
+                    "PSP_byname1_type" : "M",
+                })
+    assert("PSP_byname1_image" not in steps[1].options)
+    assert("PSP_byname1_prec" not in steps[1].options)
+
 def test_spatial():
     """
     Check final spatial step
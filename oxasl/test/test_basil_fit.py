@@ -0,0 +1,371 @@
+"""
+Tests for BASIL model fitting using a simulated Fabber run
+
+The Fabber wrapper is replaced by a stub which fits a simple two parameter
+model. Each iteration halves the difference between the current estimate of
+each parameter and its true value, so convergence can be controlled precisely.
+"""
+import time
+import importlib
+
+import pytest
+import numpy as np
+
+from fsl.data.image import Image
+
+from oxasl import AslImage, Workspace
+from oxasl.utils import Tee
+import oxasl.basil as basil
+from oxasl.wrappers.fabber import _Results
+from oxasl.wrappers.mvn import MVN
+
+SHAPE = (4, 4, 4)
+PARAMS = ["ftiss", "delttiss"]
+
+# The wrapper module is hidden by the function of the same name in oxasl.wrappers
+fabber_wrapper = importlib.import_module("oxasl.wrappers.fabber")
+
+class StubFabber(object):
+    """
+    Simulated Fabber run
+
+    The true parameter values are given by the ``truth-<param>`` options. Voxels
+    in the optional ``stub-fail`` image produce non-finite output unless the
+    run uses more than ``stub-fail-iterations`` iterations.
+    """
+
+    def __init__(self):
+        self.runs = []
+
+    def __call__(self, options, output=None, progress_log=None, log=None, progress_cb=None, outputs=None, **kwargs):
+        start = time.time()
+        options = fabber_wrapper.select_outputs(options, outputs)
+        self.runs.append(dict(options))
+        mask = options["mask"].data > 0 if "mask" in options else np.ones(SHAPE, dtype=bool)
+        truth = np.stack([options["truth-%s" % param].data for param in PARAMS], axis=-1)
+        if "continue-from-mvn" in options:
+            est = MVN(options["continue-from-mvn"]).means()[..., :len(PARAMS)].astype(np.float64)
+        else:
+            est = np.zeros(list(SHAPE) + [len(PARAMS)])
+
+        max_its = int(options.get("max-iterations", 10))
+        if options.get("convergence", "maxits") == "maxits":
+            its = np.full(SHAPE, max_its)
+        else:
+            # Voxelwise convergence: stop when the estimate changes by less than 0.01
+            change = np.max(np.abs(est - truth), axis=-1)
+            its = np.zeros(SHAPE, dtype=int)
+            while np.any((change * 0.5**its > 0.01) & (its < max_its)):
+                its += (change * 0.5**its > 0.01) & (its < max_its)
+        est = truth + (est - truth) * 0.5**its[..., np.newaxis]
+        est[~mask] = 0
+        fe = -100 * np.max(np.abs(est - truth), axis=-1)
+        fe[~mask] = 0
+        if "stub-fail" in options:
+            failed = (options["stub-fail"].data > 0) & mask & (max_its <= options.get("stub-fail-iterations", 0))
+            est[failed] = np.nan
+
+        mvn = MVN(Image(np.zeros(list(SHAPE) + [10], dtype=np.float32)), paramnames=PARAMS + ["noise"])
+        for idx, param in enumerate(PARAMS):
+            mvn.update(param, mean=est[..., idx], var=0.01)
+
+        ret = _Results([])
+        ret["paramnames"] = list(PARAMS)
+        ret["logfile"] = "Stub fabber log"
+        if "save-mean" in options:
+            for idx, param in enumerate(PARAMS):
+                ret["mean_%s" % param] = Image(est[..., idx].astype(np.float32))
+        if "save-std" in options:
+            for param in PARAMS:
+                ret["std_%s" % param] = Image(np.full(SHAPE, 0.1, dtype=np.float32))
+        if "save-free-energy" in options:
+            ret["freeEnergy"] = Image(fe.astype(np.float32))
+        if "save-model-fit" in options:
+            ret["modelfit"] = Image(np.repeat(est[..., :1], 3, axis=-1).astype(np.float32))
+        if "save-mvn" in options:
+            ret["finalMVN"] = mvn.image()
+        ret.stats["run_time"] = time.time() - start
+        return ret
+
+def _options(max_iterations=20, **kwargs):
+    options = {
+        "method" : "vb",
+        "max-iterations" : max_iterations,
+        "convergence" : "maxits",
+        "save-mean" : True,
+        "save-std" : True,
+        "save-mvn" : True,
+        "save-model-fit" : True,
+        "save-free-energy" : True,
+        "data" : Image(np.zeros(list(SHAPE) + [3], dtype=np.float32)),
+        "truth-ftiss" : Image(np.random.uniform(10, 100, SHAPE)),
+        "truth-delttiss" : Image(np.random.uniform(0.5, 1.5, SHAPE)),
+    }
+    options.update(kwargs)
+    return options
+
+@pytest.fixture
+def stub(monkeypatch):
+    """ Replace the Fabber wrapper with a simulated run """
+    stub = StubFabber()
+    monkeypatch.setattr(fabber_wrapper, "fabber", stub)
+    return stub
+
+def _fit(monkeypatch, steps, **kwargs):
+    """ Run basil_fit on a set of steps """
+    monkeypatch.setattr(basil, "basil_steps", lambda *args, **kw: steps)
+    asldata = AslImage(np.random.rand(*(list(SHAPE) + [6])), tis=[1.5], iaf="diff", order="rt")
+    kwargs.setdefault("log", _NullLog())
+    wsp = Workspace(**kwargs)
+    basil.basil_fit(wsp, asldata)
+    return wsp
+
+class _NullLog(object):
+    """ Log stream which discards output """
+    def write(self, text):
+        pass
+
+    def flush(self):
+        pass
+
+def test_step_outputs(stub, monkeypatch):
+    """ Intermediate steps keep parameter means but not the model fit """
+    options = _options()
+    steps = [basil.FabberStep(options, "Step 1"), basil.FabberStep(options, "Step 2")]
+    wsp = _fit(monkeypatch, steps)
+    for param in PARAMS:
+        assert(wsp.step1.ifnone("mean_%s" % param, None) is not None)
+        assert(wsp.step1.ifnone("std_%s" % param, None) is not None)
+    assert(wsp.step1.ifnone("modelfit", None) is None)
+    assert("save-model-fit" not in stub.runs[0])
+    assert(wsp.step2.ifnone("modelfit", None) is not None)
+    assert(wsp.finalstep.ifnone("mean_ftiss", None) is not None)
+
+def _failing_options(fail, **kwargs):
+    """
+    Options where voxels in ``fail`` produce non-finite output unless refitted with more
+    iterations. Uniform true values give identical free energy in converged voxels so
+    none are flagged as outliers
+    """
+    return _options(max_iterations=20, **dict({
+        "truth-ftiss" : Image(np.full(SHAPE, 50.0)),
+        "truth-delttiss" : Image(np.full(SHAPE, 1.0)),
+        "stub-fail" : Image(fail.astype(np.int8)),
+        "stub-fail-iterations" : 20,
+    }, **kwargs))
+
+def test_voxel_status():
+    """ Voxels with non-finite output or outlying free energy are flagged """
+    mask = np.ones(SHAPE, dtype=np.int8)
+    mask[0] = 0
+    mean = np.ones(SHAPE, dtype=np.float32)
+    mean[1, 1, 1] = np.nan
+    mean[0, 1, 1] = np.nan
+    fe = np.random.normal(-100, 1, SHAPE).astype(np.float32)
+    fe[2, 2, 2] = -1000
+    result = {"mean_ftiss" : Image(mean), "freeEnergy" : Image(fe)}
+
+    status, fe_thresh = basil.voxel_status(result, Image(mask))
+    assert(fe_thresh < -100 and fe_thresh > -1000)
+    assert(np.all(status.data[0] == basil.VOXEL_OUTSIDE_MASK))
+    assert(status.data[1, 1, 1] == basil.VOXEL_NONFINITE)
+    assert(status.data[2, 2, 2] == basil.VOXEL_FE_OUTLIER)
+    assert(np.count_nonzero(status.data == basil.VOXEL_OK) == np.count_nonzero(mask) - 2)
+
+    # A given threshold is used instead of the robust estimate
+    status, _ = basil.voxel_status(result, Image(mask), fe_thresh=0)
+    assert(np.count_nonzero(status.data == basil.VOXEL_FE_OUTLIER) == np.count_nonzero(mask) - 1)
+
+def test_bad_voxels_flagged(stub, monkeypatch):
+    """ Failed voxels are recorded in the step workspace but not refitted by default """
+    fail = np.zeros(SHAPE, dtype=bool)
+    fail[1, 2, 3] = fail[3, 0, 1] = True
+    steps = [basil.FabberStep(_failing_options(fail), "Step 1")]
+    wsp = _fit(monkeypatch, steps)
+    assert(len(stub.runs) == 1)
+    assert(np.all((wsp.step1.voxel_status.data == basil.VOXEL_NONFINITE) == fail))
+    assert(np.all(np.isnan(wsp.step1.mean_ftiss.data[fail])))
+
+def test_refit(stub, monkeypatch):
+    """ Failed voxels are refitted within a mask of the failed voxels and merged back """
+    fail = np.zeros(SHAPE, dtype=bool)
+    fail[1, 2, 3] = fail[3, 0, 1] = True
+    steps = [basil.FabberStep(_failing_options(fail), "Step 1")]
+    wsp = _fit(monkeypatch, steps, refit_bad_voxels=True)
+
+    assert(len(stub.runs) == 2)
+    refit = stub.runs[1]
+    assert(np.all((refit["mask"].data > 0) == fail))
+    assert(refit["max-iterations"] == 40)
+    assert(np.all(wsp.step1.voxel_status.data == basil.VOXEL_OK))
+    mean_ftiss = wsp.step1.mean_ftiss.data
+    assert(np.all(np.isfinite(mean_ftiss)))
+    # Refitted voxels replace failed voxels, others are unchanged from the original run
+    assert(np.allclose(mean_ftiss, 50, atol=1e-3))
+    assert(np.allclose(mean_ftiss[fail], 50 - 50 * 0.5**40))
+    assert(np.allclose(mean_ftiss[~fail], 50 - 50 * 0.5**20))
+    assert("Refit of non-converged voxels" in wsp.step1.logfile)
+
+def test_refit_max_iterations(stub, monkeypatch):
+    """ Number of iterations used in refit can be specified """
+    fail = np.zeros(SHAPE, dtype=bool)
+    fail[0, 0, 0] = True
+    steps = [basil.FabberStep(_failing_options(fail), "Step 1")]
+    wsp = _fit(monkeypatch, steps, refit_bad_voxels=True, refit_max_iterations=15)
+    assert(stub.runs[1]["max-iterations"] == 15)
+    # Still failing with too few iterations, so original output is kept
+    assert(wsp.step1.voxel_status.data[0, 0, 0] == basil.VOXEL_NONFINITE)
+    assert(np.isnan(wsp.step1.mean_ftiss.data[0, 0, 0]))
+
+def test_refit_spatial(stub, monkeypatch):
+    """ Refit is skipped, and logged, for spatial steps """
+    fail = np.zeros(SHAPE, dtype=bool)
+    fail[1, 2, 3] = True
+    step = basil.FabberStep(_failing_options(fail, method="spatialvb"), "Spatial step")
+    wsp = _fit(monkeypatch, [step], refit_bad_voxels=True, log=Tee())
+    assert(len(stub.runs) == 1)
+    assert("Not refitting voxels in spatial step" in str(wsp.log))
+    assert(wsp.step1.voxel_status.data[1, 2, 3] == basil.VOXEL_NONFINITE)
+    with pytest.raises(ValueError):
+        step.refit({}, wsp.step1.voxel_status)
+
+def test_metrics(stub, monkeypatch):
+    """ Metrics are recorded for each Fabber step """
+    options = _options()
+    steps = [basil.FabberStep(dict(options), "Step 1"), basil.FabberStep(dict(options), "Step 2")]
+    wsp = _fit(monkeypatch, steps)
+    metrics = wsp.metrics
+    assert(list(metrics.columns) == basil.METRICS_COLUMNS)
+    assert(list(metrics["step"]) == [1, 2])
+    assert(list(metrics["desc"]) == ["Step 1", "Step 2"])
+    assert(list(metrics["voxels"]) == [np.prod(SHAPE)] * 2)
+    assert(list(metrics["max_iterations"]) == [20, 20])
+    assert(list(metrics["bad_voxels"]) == [0, 0])
+    # Iterations used are not reported by Fabber
+    assert(np.all(np.isnan(metrics["iterations"])))
+    assert(np.isnan(metrics["fe_change"][0]))
+    # Second step continues from the first so free energy improves
+    assert(metrics["fe_change"][1] > 0)
+    assert(np.all(metrics["wall_time"] >= 0))
+    assert(np.all(metrics["peak_rss_increase_mb"] >= 0))
+    assert(np.all(metrics["peak_rss_increase_mb"] <= metrics["process_peak_rss_mb"]))
+    assert(wsp.step1.metrics is not None)
+
+def test_step_metrics_memory(monkeypatch):
+    """ Peak memory is the process high-water mark and the increase during the step """
+    monkeypatch.setattr(basil, "_peak_rss_mb", lambda: 300.0)
+    step = basil.FabberStep(_options(), "Step")
+    status = Image(np.ones(SHAPE, dtype=np.int8))
+    result = {"freeEnergy" : Image(np.full(SHAPE, -5, dtype=np.float32))}
+    metrics = dict(zip(basil.METRICS_COLUMNS, basil._step_metrics(1, step, result, status, None, 1.0, 2.0, 250.0)))
+    assert(metrics["process_peak_rss_mb"] == 300)
+    assert(metrics["peak_rss_increase_mb"] == 50)
+    assert(metrics["fe_median"] == -5)
+    assert(metrics["fe_iqr"] == 0)
+    assert(metrics["wall_time"] == 1 and metrics["cpu_time"] == 2)
+
+def _adaptive_options(**kwargs):
+    """
+    Options with known true values. Free energy converges to within 0.1 in the first
+    voxel after 20 iterations but takes 25 iterations in all voxels
+    """
+    return _options(max_iterations=100, **dict({
+        "truth-ftiss" : Image(np.linspace(10, 100, np.prod(SHAPE)).reshape(SHAPE)),
+        "truth-delttiss" : Image(np.full(SHAPE, 1.0)),
+    }, **kwargs))
+
+def test_adaptive_blocks(stub, monkeypatch):
+    """ Fixed iteration steps are run in blocks until the free energy converges """
+    steps = [basil.FabberStep(_adaptive_options(), "Step 1")]
+    wsp = _fit(monkeypatch, steps, adaptive=True, adaptive_block=5)
+    assert(len(stub.runs) == 5)
+    assert(all(run["max-iterations"] == 5 for run in stub.runs))
+    assert("continue-from-mvn" not in stub.runs[0])
+    assert(all("continue-from-mvn" in run for run in stub.runs[1:]))
+    assert(steps[0].adaptive_info["iterations"] == 25)
+    assert(steps[0].adaptive_info["converged_frac"] >= 0.95)
+    metrics = wsp.metrics
+    assert(list(metrics.columns) == basil.METRICS_COLUMNS + basil.ADAPTIVE_COLUMNS)
+    assert(metrics["iterations"][0] == 25)
+    assert(metrics["budget"][0] == 100)
+    assert(metrics["blocks"][0] == 5)
+    # Overhead outside the Fabber run is only counted once in the estimated full run time
+    run_time, overhead = metrics["run_time"][0], metrics["overhead_time"][0]
+    assert(0 <= overhead < run_time)
+    assert(np.isclose(metrics["est_full_time"][0], (run_time - overhead) * 4 + overhead / 5))
+
+def test_adaptive_iteration_limit(stub, monkeypatch):
+    """ Blocks stop at the iteration limit of the step """
+    steps = [basil.FabberStep(_adaptive_options(**{"max-iterations" : 12}), "Step 1")]
+    _fit(monkeypatch, steps, adaptive=True, adaptive_block=5)
+    assert([run["max-iterations"] for run in stub.runs] == [5, 5, 2])
+    assert(steps[0].adaptive_info["iterations"] == 12)
+
+def test_adaptive_voxelwise_convergence(stub, monkeypatch):
+    """ Steps using Fabber's voxelwise convergence are run unchanged """
+    options = _adaptive_options(convergence="trialmode", **{"max-trials" : 10})
+    steps = [basil.FabberStep(options, "Step 1")]
+    wsp = _fit(monkeypatch, steps, adaptive=True, adaptive_block=5)
+    assert(len(stub.runs) == 1)
+    assert(stub.runs[0]["convergence"] == "trialmode")
+    assert(stub.runs[0]["max-trials"] == 10)
+    assert(stub.runs[0]["max-iterations"] == 100)
+    assert(np.isnan(wsp.metrics["iterations"][0]))
+    assert(wsp.metrics["blocks"][0] == 1)
+
+def test_adaptive_convergence_within_step(stub, monkeypatch):
+    """ Convergence is judged between blocks of a step, not against the previous step """
+    steps = [basil.FabberStep(_adaptive_options(), "Step 1"), basil.FabberStep(_adaptive_options(), "Step 2")]
+    _fit(monkeypatch, steps, adaptive=True, adaptive_block=5)
+    # Step 2 starts from the converged output of step 1 but still needs a second block to
+    # check convergence
+    assert(len(stub.runs) == 7)
+    assert(steps[1].adaptive_info["blocks"] == 2)
+
+def test_adaptive_skip(stub, monkeypatch):
+    """ Intermediate steps are skipped when the previous step made negligible changes """
+    steps = [basil.FabberStep(_adaptive_options(), "Step %i" % (idx+1)) for idx in range(4)]
+    wsp = _fit(monkeypatch, steps, adaptive=True, adaptive_block=5, log=Tee())
+    assert(steps[2].adaptive_info is None)
+    assert(wsp.step2 is not None)
+    assert(wsp.step3 is None)
+    assert(wsp.finalstep is wsp.step4)
+    assert("Step 3 of 4: Step 3 - Skipped" in str(wsp.log))
+    assert(list(wsp.metrics["step"]) == [1, 2, 4])
+    # Step 4 is initialised from step 2
+    assert(len(stub.runs) == 9)
+    step2_mvn = MVN(stub.runs[6]["continue-from-mvn"]).means()
+    assert(np.allclose(step2_mvn[..., 0], wsp.step2.mean_ftiss.data))
+
+def test_adaptive_no_skip(stub, monkeypatch):
+    """ Steps are not skipped if the previous step changed the parameters """
+    steps = [basil.FabberStep(_adaptive_options(), "Step 1"),
+             basil.FabberStep(_adaptive_options(**{"truth-ftiss" : Image(np.full(SHAPE, 200.0))}), "Step 2"),
+             basil.FabberStep(_adaptive_options(), "Step 3"),
+             basil.FabberStep(_adaptive_options(), "Step 4")]
+    wsp = _fit(monkeypatch, steps, adaptive=True, adaptive_block=5)
+    assert(list(wsp.metrics["step"]) == [1, 2, 3, 4])
+
+def test_can_skip():
+    """ Final steps and steps followed by a non-Fabber step are never skipped """
+    options = _options()
+    fab = basil.FabberStep(options, "Fabber")
+    pvc = basil.PvcInitStep(options, "PVC init")
+    assert(not basil._can_skip([fab, fab, fab], 0))
+    assert(basil._can_skip([fab, fab, fab], 1))
+    assert(not basil._can_skip([fab, fab, fab], 2))
+    assert(not basil._can_skip([fab, fab, pvc, fab], 1))
+    assert(not basil._can_skip([fab, pvc, fab, fab], 1))
+
+def test_adaptive_validate(stub, monkeypatch):
+    """ Validation re-runs the steps to the iteration limit and compares the final means """
+    steps = [basil.FabberStep(_adaptive_options(), "Step 1"), basil.FabberStep(_adaptive_options(), "Step 2")]
+    wsp = _fit(monkeypatch, steps, adaptive=True, adaptive_block=5, adaptive_validate=True)
+    assert(len(stub.runs) == 9)
+    assert([run["max-iterations"] for run in stub.runs[-2:]] == [100, 100])
+    validation = wsp.adaptive_validation
+    assert(sorted(validation["param"]) == ["delttiss", "ftiss"])
+    # Both runs are close to the true values
+    assert(np.all(validation["median_rel_diff"] < 1e-3))
+    assert(np.all(validation["max_abs_diff"] < 0.01))
+    assert(wsp.adaptive_speedup > 0)
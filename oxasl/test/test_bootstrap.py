@@ -0,0 +1,51 @@
+"""
+Tests for resampling uncertainty estimation
+"""
+import numpy as np
+
+import pytest
+
+from oxasl import AslImage
+from oxasl.bootstrap import resample_indices, resample_data
+
+def test_bootstrap_indices():
+    rpts = [3, 4]
+    samples = list(resample_indices(rpts, "bootstrap", nsamples=10, seed=1))
+    assert(len(samples) == 10)
+    for indices, sample_rpts in samples:
+        assert(sample_rpts == rpts)
+        assert(len(indices) == 7)
+        assert(np.all(indices[:3] >= 0) and np.all(indices[:3] < 3))
+        assert(np.all(indices[3:] >= 3) and np.all(indices[3:] < 7))
+
+def test_bootstrap_seed():
+    samples1 = list(resample_indices([5], "bootstrap", nsamples=3, seed=42))
+    samples2 = list(resample_indices([5], "bootstrap", nsamples=3, seed=42))
+    for (indices1, _), (indices2, _) in zip(samples1, samples2):
+        assert(np.all(indices1 == indices2))
+
+def test_jackknife_indices():
+    samples = list(resample_indices([3, 1, 2], "jackknife"))
+    assert(len(samples) == 3)
+    assert(list(samples[0][0]) == [1, 2, 3, 5])
+    assert(samples[0][1] == [2, 1, 1])
+    assert(list(samples[1][0]) == [0, 2, 3, 4])
+    assert(samples[1][1] == [2, 1, 1])
+    # Third repeat only exists at the first TI
+    assert(list(samples[2][0]) == [0, 1, 3, 4, 5])
+    assert(samples[2][1] == [2, 1, 2])
+
+def test_unknown_method():
+    with pytest.raises(ValueError):
+        list(resample_indices([3], "magic"))
+
+def test_resample_data():
+    d = np.zeros([5, 5, 5, 6], dtype=np.float32)
+    for vol in range(6):
+        d[..., vol] = vol
+    img = AslImage(name="asldata", image=d, tis=[1.5, 2.0], iaf="diff", order="rt", rpts=[2, 4])
+    indices, rpts = next(resample_indices(img.rpts, "jackknife"))
+    resampled = resample_data(img, indices, rpts)
+    assert(resampled.rpts == [1, 3])
+    assert(resampled.ntis == 2)
+    assert(list(resampled.data[0, 0, 0, :]) == [1, 3, 4, 5])
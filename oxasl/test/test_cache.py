@@ -0,0 +1,81 @@
+"""
+Tests for Fabber results cache
+"""
+import os
+import shutil
+import tempfile
+
+import numpy as np
+
+from fsl.data.image import Image
+
+from oxasl.cache import FabberCache, options_hash
+from oxasl.wrappers.fabber import _Results
+
+def _results(value=1.0):
+    ret = _Results(["output text"])
+    ret["mean_ftiss"] = Image(np.full((5, 5, 5), value, dtype=np.float32))
+    ret["paramnames"] = ["ftiss", "delttiss"]
+    ret["logfile"] = "fabber log"
+    return ret
+
+def test_hash_same_content():
+    """ Images with the same content give the same hash """
+    d = np.random.rand(5, 5, 5)
+    opts1 = {"data" : Image(d), "model" : "aslrest", "max-iterations" : 20}
+    opts2 = {"max-iterations" : 20, "model" : "aslrest", "data" : Image(np.copy(d))}
+    assert(options_hash(opts1) == options_hash(opts2))
+
+def test_hash_different_content():
+    """ Changing image data or options changes the hash """
+    d = np.random.rand(5, 5, 5)
+    opts = {"data" : Image(d), "model" : "aslrest"}
+    d2 = np.copy(d)
+    d2[2, 2, 2] += 1
+    assert(options_hash(opts) != options_hash({"data" : Image(d2), "model" : "aslrest"}))
+    assert(options_hash(opts) != options_hash({"data" : Image(d), "model" : "aslrest", "spatial" : True}))
+
+def test_hash_version():
+    """ Changing the Fabber version changes the hash """
+    opts = {"data" : Image(np.random.rand(5, 5, 5)), "model" : "aslrest"}
+    assert(options_hash(opts, "libfabber_models_asl.so:100:1") == options_hash(opts, "libfabber_models_asl.so:100:1"))
+    assert(options_hash(opts, "libfabber_models_asl.so:100:1") != options_hash(opts, "libfabber_models_asl.so:100:2"))
+
+def test_put_get():
+    """ Stored results can be retrieved """
+    tempdir = tempfile.mkdtemp("_oxasl")
+    try:
+        cache = FabberCache(tempdir)
+        opts = {"data" : Image(np.random.rand(5, 5, 5)), "model" : "aslrest"}
+        assert(cache.get(opts) is None)
+        cache.put(opts, _results(3.0))
+        ret = cache.get(opts)
+        assert(ret is not None)
+        assert(np.allclose(ret["mean_ftiss"].data, 3.0))
+        assert(ret["paramnames"] == ["ftiss", "delttiss"])
+        assert(ret["logfile"] == "fabber log")
+        assert(ret.output == ["output text"])
+        assert(len(cache.entries()) == 1)
+    finally:
+        shutil.rmtree(tempdir)
+
+def test_evict():
+    """ Least recently used entries are removed when cache exceeds maximum size """
+    tempdir = tempfile.mkdtemp("_oxasl")
+    try:
+        cache = FabberCache(tempdir)
+        opts1 = {"data" : Image(np.random.rand(5, 5, 5)), "model" : "aslrest"}
+        opts2 = {"data" : Image(np.random.rand(5, 5, 5)), "model" : "aslrest"}
+        cache.put(opts1, _results())
+        cache.put(opts2, _results())
+        entry1 = os.path.join(tempdir, options_hash(opts1))
+        os.utime(entry1, (0, 0))
+        assert(len(cache.entries()) == 2)
+        cache.evict(cache.size() - 1)
+        assert(len(cache.entries()) == 1)
+        assert(cache.get(opts1) is None)
+        assert(cache.get(opts2) is not None)
+        assert(cache.clear() == 1)
+        assert(len(cache.entries()) == 0)
+    finally:
+        shutil.rmtree(tempdir)
@@ -1,15 +1,14 @@
 """
 Tests for CALIB module
 
-FIXME need satrecov tests
 FIXME need sensitivity correction tests
-FIXME need test with edge correction
 """
 import math
 from six import StringIO
 
 import pytest
 import numpy as np
+import scipy.ndimage
 
 from fsl.data.image import Image
 
@@ -609,3 +608,225 @@ def test_refregion_alpha():
 
     m0_expected =  _expected_m0(np.mean(calib_img.data), 1.0, 50, 0.82, alpha=ALPHA)
     np.testing.assert_allclose(calibrated_d, perf_img.data / m0_expected)
+
+def _masked_mean(vals):
+    voxel_val = vals[int((len(vals)-1) / 2)]
+    if voxel_val == 0:
+        nonzero = vals[vals != 0]
+        if np.any(nonzero):
+            return np.mean(nonzero)
+        else:
+            return 0
+    else:
+        return voxel_val
+
+def test_edge_correct():
+    """ Edge correction matches slicewise masked mean filter """
+    m0 = np.random.rand(20, 20, 6) + 1
+    mask = np.zeros([20, 20, 6], dtype=np.int32)
+    mask[4:16, 5:15, 1:5] = 1
+    mask[8:10, 8:10, 1:5] = 0
+    ret = calib._edge_correct(m0, Image(mask))
+
+    # Original implementation using a filter callback on each slice
+    expected = scipy.ndimage.median_filter(m0, size=3)
+    mask_ero = scipy.ndimage.morphology.binary_erosion(mask, structure=np.ones([3, 3, 3]), border_value=1)
+    expected[mask_ero == 0] = 0
+    for z in range(expected.shape[2]):
+        expected[..., z] = scipy.ndimage.generic_filter(expected[..., z], _masked_mean, footprint=np.ones([5, 5]))
+    expected[mask == 0] = 0
+    assert np.allclose(ret, expected, rtol=1e-12, atol=1e-12)
+
+def test_edge_correct_3d():
+    """ Edge correction with 3D neighbourhood fills all voxels within the mask """
+    m0 = np.random.rand(20, 20, 10) + 1
+    mask = np.zeros([20, 20, 10], dtype=np.int32)
+    mask[4:16, 5:15, 3:7] = 1
+    ret = calib._edge_correct(m0, Image(mask), kernel_3d=True)
+    assert np.all(ret[mask == 0] == 0)
+    assert np.all(ret[mask > 0] > 1)
+
+def _satrecov_data(model, shape=(4, 4, 3)):
+    nvox = np.prod(shape)
+    params = np.zeros((nvox, len(model.paramnames)))
+    params[:, 0] = np.linspace(500, 2000, nvox)
+    params[:, 1] = np.linspace(0.8, 4.0, nvox)
+    for name, value in (("A", 0.95), ("g", 0.9)):
+        if name in model.paramnames:
+            params[:, model.paramnames.index(name)] = value
+    data = model.evaluate(params).reshape(list(shape) + [-1])
+    return data, params.reshape(list(shape) + [-1])
+
+def test_satrecov_fit():
+    """ Saturation recovery fit recovers true parameters """
+    tis = [0.2, 0.6, 1.0, 1.5, 2.0, 3.0, 4.0]
+    model = calib.SatRecovModel(tis, nvols=14)
+    data, params = _satrecov_data(model)
+    ret = calib.fit_satrecov(data, tis)
+    assert sorted(ret.keys()) == ["A", "M0t", "T1t"]
+    for idx, name in enumerate(model.paramnames):
+        np.testing.assert_allclose(ret[name], params[..., idx], rtol=1e-3)
+
+def test_satrecov_fit_lfa():
+    """ Look-Locker fit with low flip angle phase recovers flip angle correction """
+    tis = np.arange(0.04, 3.0, 0.3)
+    model = calib.SatRecovModel(tis, nvols=len(tis)*4, fa=35, lfa=11, nphases=3)
+    assert model.paramnames == ["M0t", "T1t", "A", "g"]
+    data, params = _satrecov_data(model)
+    mask = np.ones(data.shape[:3], dtype=np.int32)
+    mask[0, 0, 0] = 0
+    ret = calib.fit_satrecov(data, tis, mask=mask, fa=35, lfa=11, nphases=3)
+    assert ret["M0t"][0, 0, 0] == 0
+    for idx, name in enumerate(model.paramnames):
+        np.testing.assert_allclose(ret[name][mask > 0], params[..., idx][mask > 0], rtol=1e-3)
+
+def test_satrecov_bad_nvols():
+    """ Number of volumes must be a multiple of the number of TIs """
+    with pytest.raises(ValueError):
+        calib.SatRecovModel([0.5, 1.0, 2.0], nvols=7)
+
+def test_refregion_satrecov():
+    """ Reference region calibration using saturation recovery fit """
+    tis = [0.2, 0.6, 1.0, 1.5, 2.0, 3.0, 4.0]
+    model = calib.SatRecovModel(tis, fixa=True)
+    data, params = _satrecov_data(model, shape=(5, 5, 5))
+    calib_img = Image(name="calib", image=data)
+    perf_img, _ = _get_imgs()
+    ref_d = np.zeros((5, 5, 5))
+    ref_d[1:4, 1:4, 1:4] = 1
+    ref_img = Image(name="refmask", image=ref_d)
+
+    wsp = Workspace(calib=calib_img, calib_method="refregion", mode="satrecov", satrecov_tis=",".join([str(ti) for ti in tis]),
+                    fixa=True, refmask=ref_img, calib_aslreg=True, tissref="csf")
+    perf_calib = calib.calibrate(wsp, perf_img)
+    np.testing.assert_allclose(wsp.calibration.t1t.data, params[..., 1], rtol=1e-3)
+
+    # No T1 correction as M0t is fully relaxed
+    m0_expected = np.mean(params[..., 0][ref_d > 0]) / 1.15
+    np.testing.assert_allclose(perf_calib.data, perf_img.data / m0_expected, rtol=1e-3)
+
+def test_calibration_factor():
+    """ Calibration factor gives the same result as calibrating each image """
+    perf_img, calib_img = _get_imgs()
+    calib_img.data[0, 0, 0] = 0
+    wsp = Workspace(calib=calib_img, calib_method="voxelwise", calib_edgecorr=False)
+    for var in (False, True):
+        factor = calib.get_calibration_factor(wsp, multiplier=6000, alpha=0.85, var=var)
+        perf_calib = calib.calibrate(wsp, perf_img, multiplier=6000, alpha=0.85, var=var)
+        np.testing.assert_allclose(perf_img.data * factor, perf_calib.data)
+        assert factor[0, 0, 0] == 0
+
+def test_calibrate_4d():
+    """ Voxelwise calibration of 4D data """
+    _, calib_img = _get_imgs()
+    perf_d = np.random.rand(5, 5, 5, 3)
+    perf_img = Image(name="perfusion", image=perf_d)
+    wsp = Workspace(calib=calib_img, calib_method="voxelwise")
+    perf_calib = calib.calibrate(wsp, perf_img)
+    np.testing.assert_allclose(perf_calib.data, 0.9 * perf_d / calib_img.data[..., np.newaxis])
+
+def test_quantitative_defaults():
+    """ Quantitative voxelwise calibration without PVEs uses GM properties """
+    perf_img, calib_img = _get_imgs()
+    wsp = Workspace(calib=calib_img, calib_method="quantitative")
+    perf_calib = calib.calibrate(wsp, perf_img)
+    m0 = calib_img.data / (1 - math.exp(-3.2 / 1.3)) / 0.9
+    np.testing.assert_allclose(perf_calib.data, perf_img.data / m0, rtol=1e-5)
+    assert(wsp.calibration.m0_corr.data.dtype == np.float32)
+
+def test_quantitative_maps():
+    """ Quantitative voxelwise calibration using PVEs and tissue T1/T2 maps """
+    _, calib_img = _get_imgs()
+    pvgm = np.random.rand(5, 5, 5) / 2
+    pvwm = np.random.rand(5, 5, 5) / 2
+    pvgm[0], pvwm[0] = 0, 0
+    pvcsf = 1 - pvgm - pvwm
+    t1map = np.random.rand(5, 5, 5) + 0.5
+    t1map[:, :, 0] = 0
+    t2map = np.random.rand(5, 5, 5) * 100 + 50
+    TR, TAQ, TE, GAIN = 2.5, 0.5, 15, 1.5
+    wsp = Workspace(calib=calib_img, calib_method="quantitative", calib_gain=GAIN, tr=TR, taq=TAQ, te=TE,
+                    pvgm=Image(pvgm), pvwm=Image(pvwm), calib_t1map=Image(t1map), calib_t2map=Image(t2map))
+    calib.calculate_m0(wsp)
+
+    # Voxels with no T1 in the map get the PV-weighted T1
+    t1 = np.where(t1map > 0, t1map, pvcsf * 4.3 + pvgm * 1.3 + pvwm * 1.0)
+    pct = pvcsf * 1.15 + pvgm * 0.98 + pvwm * 0.82
+    corr = math.exp(-TE / 150) * np.exp(TE / t2map) / (1 - np.exp(-(TR - TAQ) / t1)) / pct
+    np.testing.assert_allclose(wsp.calibration.m0_corr.data, corr, rtol=1e-5)
+    np.testing.assert_allclose(wsp.calibration.m0.data, GAIN * calib_img.data * corr, rtol=1e-5)
+
+def test_quantitative_gain_sens_not_cached():
+    """ Changing gain or sensitivity with a cached tissue correction factor changes M0 """
+    _, calib_img = _get_imgs()
+    sens = np.random.rand(5, 5, 5) + 0.5
+    wsp = Workspace(calib=calib_img, calib_method="quantitative")
+    calib.calculate_m0(wsp)
+    corr = wsp.calibration.m0_corr.data
+    m0 = wsp.calibration.m0.data
+
+    wsp.calibration.m0 = None
+    wsp.calib_gain = 2.0
+    wsp.sens = Image(sens)
+    calib.calculate_m0(wsp)
+    np.testing.assert_allclose(wsp.calibration.m0_corr.data, corr)
+    np.testing.assert_allclose(wsp.calibration.m0.data, 2.0 * m0 / sens, rtol=1e-5)
+
+def test_quantitative_cached():
+    """ Tissue correction factor is reused when its inputs are unchanged """
+    _, calib_img = _get_imgs()
+    wsp = Workspace(calib=calib_img, calib_method="quantitative")
+    calib.calculate_m0(wsp)
+
+    # Replace the stored map so we can tell whether it is used
+    wsp.calibration.m0_corr = Image(np.full((5, 5, 5), 2, dtype=np.float32))
+    wsp.calibration.m0 = None
+    calib.calculate_m0(wsp)
+    np.testing.assert_allclose(wsp.calibration.m0.data, 2 * calib_img.data)
+
+@pytest.mark.parametrize("attr, value", [
+    ("te", 20), ("tr", 2.0), ("taq", 0.5), ("t2b", 100), ("pct", 0.8), ("t1", 1.5),
+])
+def test_quantitative_recalculated_scalar(attr, value):
+    """ Tissue correction factor is recalculated when sequence or tissue parameters change """
+    _, calib_img = _get_imgs()
+    wsp = Workspace(calib=calib_img, calib_method="quantitative", te=10)
+    calib.calculate_m0(wsp)
+    corr = wsp.calibration.m0_corr.data
+
+    wsp.calibration.m0 = None
+    setattr(wsp, attr, value)
+    calib.calculate_m0(wsp)
+    assert(not np.allclose(wsp.calibration.m0_corr.data, corr))
+
+    # Result matches a calculation from scratch
+    wsp2 = Workspace(calib=calib_img, calib_method="quantitative", te=10)
+    setattr(wsp2, attr, value)
+    calib.calculate_m0(wsp2)
+    np.testing.assert_allclose(wsp.calibration.m0_corr.data, wsp2.calibration.m0_corr.data)
+
+def test_quantitative_recalculated_maps():
+    """ Tissue correction factor is recalculated when T1/T2 maps or PVEs change """
+    _, calib_img = _get_imgs()
+    pvgm = np.random.rand(5, 5, 5) / 2
+    pvwm = np.random.rand(5, 5, 5) / 2
+    wsp = Workspace(calib=calib_img, calib_method="quantitative", te=10, pvgm=Image(pvgm), pvwm=Image(pvwm))
+    calib.calculate_m0(wsp)
+    corr = wsp.calibration.m0_corr.data
+
+    wsp.calibration.m0 = None
+    wsp.pvgm = Image(pvgm / 2)
+    calib.calculate_m0(wsp)
+    corr_pv = wsp.calibration.m0_corr.data
+    assert(not np.allclose(corr_pv, corr))
+
+    wsp.calibration.m0 = None
+    wsp.calib_t1map = Image(np.random.rand(5, 5, 5) + 0.5)
+    calib.calculate_m0(wsp)
+    corr_t1 = wsp.calibration.m0_corr.data
+    assert(not np.allclose(corr_t1, corr_pv))
+
+    wsp.calibration.m0 = None
+    wsp.calib_t2map = Image(np.random.rand(5, 5, 5) * 100 + 50)
+    calib.calculate_m0(wsp)
+    assert(not np.allclose(wsp.calibration.m0_corr.data, corr_t1))
@@ -0,0 +1,82 @@
+"""
+Tests for cropping to mask bounding box
+"""
+import numpy as np
+
+from fsl.data.image import Image
+
+from oxasl import AslImage
+from oxasl.crop import get_bbox, crop_image, uncrop_image, crop_options
+
+def _mask():
+    mask = np.zeros((10, 12, 8), dtype=np.int8)
+    mask[3:6, 4:9, 2:5] = 1
+    return mask
+
+def test_bbox():
+    """ Bounding box of mask """
+    assert(get_bbox(_mask()) == [[3, 6], [4, 9], [2, 5]])
+
+def test_bbox_margin():
+    """ Margin is clipped to image extent """
+    assert(get_bbox(_mask(), margin=3) == [[0, 9], [1, 12], [0, 8]])
+
+def test_bbox_empty():
+    """ Empty mask has no bounding box """
+    assert(get_bbox(np.zeros((5, 5, 5))) is None)
+
+def test_crop_affine():
+    """ Cropped image voxels have the same world coordinates """
+    affine = np.array([[2, 0, 0, -10], [0, 3, 0, 5], [0, 0, 4, 7], [0, 0, 0, 1]], dtype=np.float64)
+    img = Image(np.random.rand(10, 12, 8), xform=affine)
+    bbox = get_bbox(_mask())
+    cropped = crop_image(img, bbox)
+    assert(cropped.shape == (3, 5, 3))
+    assert(np.allclose(cropped.data, img.data[3:6, 4:9, 2:5]))
+    assert(np.allclose(np.dot(cropped.voxToWorldMat, [0, 0, 0, 1]), np.dot(img.voxToWorldMat, [3, 4, 2, 1])))
+
+def test_crop_uncrop():
+    """ Uncropping restores the original grid """
+    img = Image(np.random.rand(10, 12, 8, 3))
+    mask = _mask()
+    bbox = get_bbox(mask)
+    restored = uncrop_image(crop_image(img, bbox), bbox, img)
+    assert(restored.shape == img.shape)
+    assert(np.allclose(restored.data[mask > 0], img.data[mask > 0]))
+    assert(np.all(restored.data[mask == 0] == 0))
+    assert(np.allclose(restored.voxToWorldMat, img.voxToWorldMat))
+
+def test_crop_aslimage():
+    """ Cropping an AslImage preserves metadata """
+    img = AslImage(np.random.rand(10, 12, 8, 4), tis=[1, 2], iaf="tc", order="lrt")
+    cropped = crop_image(img, get_bbox(_mask()))
+    assert(isinstance(cropped, AslImage))
+    assert(cropped.tis == [1, 2])
+    assert(cropped.iaf == "tc")
+    assert(cropped.shape == (3, 5, 3, 4))
+
+def test_crop_options():
+    """ Only images on the full grid are cropped """
+    bbox = get_bbox(_mask())
+    options = {
+        "data" : Image(np.random.rand(10, 12, 8, 4)),
+        "pgm" : Image(np.random.rand(10, 12, 8)),
+        "other" : Image(np.random.rand(3, 5, 3)),
+        "model" : "aslrest",
+    }
+    cropped = crop_options(options, bbox, (10, 12, 8))
+    assert(cropped["data"].shape == (3, 5, 3, 4))
+    assert(cropped["pgm"].shape == (3, 5, 3))
+    assert(cropped["other"] is options["other"])
+    assert(cropped["model"] == "aslrest")
+    assert(options["data"].shape == (10, 12, 8, 4))
+
+def test_crop_options_shared():
+    """ Images shared between option sets are only cropped once """
+    bbox = get_bbox(_mask())
+    data = Image(np.random.rand(10, 12, 8, 4))
+    shared = {}
+    cropped1 = crop_options({"data" : data, "method" : "vb"}, bbox, (10, 12, 8), shared)
+    cropped2 = crop_options({"data" : data, "method" : "spatialvb"}, bbox, (10, 12, 8), shared)
+    assert(cropped1["data"] is cropped2["data"])
+    assert(cropped2["method"] == "spatialvb")
@@ -685,3 +685,68 @@ def test_calib_first_vol_fail():
     d = np.random.rand(5, 5, 5, 8)
     with pytest.raises(Exception):
         img = AslImage(name="asldata", image=d, tis=[1.5, 2.0], iaf="tc", order="lrt", calib_first_vol=True)
+
+def test_vol_index_table():
+    d = np.random.rand(5, 5, 5, 8)
+    img = AslImage(name="asldata", image=d, tis=[1.5, 2.0], iaf="tc", order="lrt", rpts=[1, 3])
+    table = img.vol_index_table()
+    assert table.shape == (8, 4)
+    # label, TI, repeat, TE
+    assert list(table[0]) == [0, 0, 0, 0]
+    assert list(table[1]) == [1, 0, 0, 0]
+    assert list(table[2]) == [0, 1, 0, 0]
+    assert list(table[7]) == [1, 1, 2, 0]
+    for vol, (label, ti, rpt, te) in enumerate(table):
+        assert img.get_vol_index(label, ti, rpt, te) == vol
+
+def test_get_vol_index_no_rpt():
+    d = np.random.rand(5, 5, 5, 8)
+    img = AslImage(name="asldata", image=d, tis=[1.5, 2.0], iaf="tc", order="lrt", rpts=[1, 3])
+    with pytest.raises(ValueError):
+        img.get_vol_index(0, 0, 1)
+
+def test_multite_vol_index_table():
+    d = np.random.rand(5, 5, 5, 16)
+    img = AslImage(name="d", image=d, plds=[1, 2], iaf="tc", ibf="tis", tes=[8, 9], casl=True, bolus=[3, 4])
+    table = img.vol_index_table()
+    assert list(table[0]) == [0, 0, 0, 0]
+    assert list(table[1]) == [0, 0, 0, 1]
+    assert list(table[2]) == [1, 0, 0, 0]
+    assert list(table[4]) == [0, 0, 1, 0]
+    assert list(table[8]) == [0, 1, 0, 0]
+
+def test_multite_diff_var_rpts():
+    d = np.zeros([5, 5, 5, 12])
+    for z in range(12): d[..., z] = z
+    img = AslImage(name="d", image=d, plds=[1, 2], iaf="ct", order="elrt", tes=[8, 9], rpts=[1, 2], casl=True, bolus=[3, 4])
+    imgdiff = img.diff()
+    assert imgdiff.order == "ert"
+    assert imgdiff.rpts == [1, 2]
+    assert imgdiff.nvols == 6
+    # Control first so each difference is -2
+    assert np.all(imgdiff.data == -2)
+    mean = img.mean_across_repeats()
+    assert mean.rpts == [1, 1]
+    assert mean.nvols == 4
+    assert np.all(mean.data == -2)
+
+def test_reorder_rt_tr_var_rpts():
+    """ Repeats after TIs with variable repeats, where the ordering is consistent """
+    d = np.zeros([5, 5, 5, 7])
+    for z in range(7): d[..., z] = z
+    img = AslImage(name="asldata", image=d, tis=[1, 2], rpts=[3, 4], iaf="diff", order='rt')
+    img = img.reorder("tr")
+    assert img.order == "tr"
+    data = img.nibImage.get_fdata()
+    for znew, zold in enumerate([0, 3, 1, 4, 2, 5, 6]):
+        assert np.all(data[..., znew] == zold)
+
+def test_reorder_inconsistent_var_rpts():
+    """
+    Orderings with variable repeats which do not give a unique volume for each TI
+    and repeat raise ValueError rather than returning data with repeated volumes
+    """
+    d = np.zeros([5, 5, 5, 7])
+    img = AslImage(name="asldata", image=d, tis=[1, 2, 3], rpts=[2, 3, 2], iaf="diff", order='rt')
+    with pytest.raises(ValueError):
+        img.reorder("tr")
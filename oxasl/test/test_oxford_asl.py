@@ -0,0 +1,79 @@
+"""
+Tests for oxford_asl pipeline functions
+"""
+import os
+import time
+import shutil
+import tempfile
+import multiprocessing
+
+import pytest
+import numpy as np
+
+from fsl.data.image import Image
+
+from oxasl import Workspace
+from oxasl.utils import Tee
+import oxasl.oxford_asl as oxford_asl
+
+# Time taken by each stub analysis. The first job takes longest so the jobs
+# finish in the reverse of the order they were given
+JOB_TIMES = {"first" : 1.0, "second" : 0.1}
+
+def _stub_basil(wsp, output_wsp=None, prefit=True, stage="basil"):
+    name = stage[len("basil_"):]
+    time.sleep(JOB_TIMES[name])
+    output_wsp.log.write("Fitting %s in process %i\n" % (name, os.getpid()))
+    output_wsp.finalstep = output_wsp.sub("step1")
+    output_wsp.finalstep.mean_ftiss = Image(np.full((3, 3, 3), len(name), dtype=np.float32))
+    page = output_wsp.report.page("fit")
+    page.heading("Model fit for %s" % name)
+
+def _stub_output(wsp, basil_wsp=None):
+    pass
+
+@pytest.fixture
+def stub_jobs(monkeypatch):
+    monkeypatch.setattr(oxford_asl.basil, "basil", _stub_basil)
+    monkeypatch.setattr(oxford_asl, "output_native", _stub_output)
+    monkeypatch.setattr(oxford_asl, "output_trans", _stub_output)
+    monkeypatch.setattr(oxford_asl, "_prepare_jobs", lambda wsp: None)
+
+def _jobs():
+    mask = Image(np.ones((3, 3, 3), dtype=np.int8))
+    return [("first", {}, mask), ("second", {}, mask)]
+
+@pytest.mark.skipif("fork" not in multiprocessing.get_all_start_methods(), reason="Requires fork start method")
+def test_concurrent_jobs(stub_jobs):
+    """ Concurrent jobs run in separate processes and output is merged in job order """
+    tempdir = tempfile.mkdtemp("_oxasl")
+    try:
+        wsp = Workspace(savedir=os.path.join(tempdir, "wsp"), log=Tee(), basil_workers=2)
+        oxford_asl.run_basil_jobs(wsp, _jobs())
+
+        log = str(wsp.log)
+        assert(log.index("Fitting first") < log.index("Fitting second"))
+        assert("in process %i" % os.getpid() not in log)
+        assert(wsp.report._contents[-2:] == ["first/index", "second/index"])
+
+        # Images saved by the worker processes
+        for name in ("first", "second"):
+            saved = Image(os.path.join(tempdir, "wsp", "basil_%s" % name, "step1", "mean_ftiss.nii.gz"))
+            assert(np.all(saved.data == len(name)))
+
+        build_dir = os.path.join(tempdir, "report")
+        wsp.report.tofile(build_dir)
+        for name in ("first", "second"):
+            with open(os.path.join(build_dir, name, "fit.rst")) as page:
+                assert("Model fit for %s" % name in page.read())
+    finally:
+        shutil.rmtree(tempdir)
+
+def test_sequential_jobs(stub_jobs):
+    """ With one worker jobs run in this process using the main log and report """
+    wsp = Workspace(log=Tee(), basil_workers=1)
+    oxford_asl.run_basil_jobs(wsp, _jobs())
+    log = str(wsp.log)
+    assert(log.index("Fitting first") < log.index("Fitting second"))
+    assert("in process %i" % os.getpid() in log)
+    assert(wsp.basil_first.finalstep.mean_ftiss is not None)
@@ -0,0 +1,112 @@
+"""
+Tests for progress reporting
+"""
+import os
+import json
+import tempfile
+import shutil
+
+import pytest
+
+from oxasl import Workspace
+from oxasl.progress import Progress, JsonLinesSink, MetricsSink, get_progress
+
+def test_no_sinks():
+    progress = Progress()
+    with progress.stage("test", nsteps=2) as stage:
+        stage.step(1)
+        assert(stage.callback() is None)
+
+def test_stage_events():
+    events = []
+    progress = Progress(events.append)
+    with progress.stage("test", nsteps=2) as stage:
+        stage.step(1, "first")
+        stage.update(50)
+        stage.step(2, "second")
+
+    statuses = [event["status"] for event in events]
+    assert(statuses == ["started", "running", "running", "running", "finished"])
+    assert(all([event["stage"] == "test" for event in events]))
+    assert(events[2]["step"] == 1)
+    assert(events[2]["desc"] == "first")
+    assert(events[2]["step_percent"] == 50)
+    assert(events[2]["percent"] == 25)
+    assert(events[2]["eta"] is not None)
+    assert(events[3]["step"] == 2)
+    assert(events[3]["percent"] == 50)
+    assert(events[-1]["percent"] == 100)
+
+def test_stage_failed():
+    events = []
+    progress = Progress(events.append)
+    with pytest.raises(ValueError):
+        with progress.stage("test") as stage:
+            stage.step(1)
+            raise ValueError("oops")
+    assert(events[-1]["status"] == "failed")
+    assert(events[-1]["desc"] == "oops")
+
+def test_callback_throttled():
+    events = []
+    progress = Progress(events.append)
+    stage = progress.stage("test", nsteps=1)
+    stage.start()
+    stage.step(1)
+    callback = stage.callback()
+    for done in range(1001):
+        callback(done, 1000)
+    running = [event for event in events if event["status"] == "running"]
+    # Initial step event, then one event per percentage point
+    assert(len(running) == 102)
+    assert(running[-1]["step_percent"] == 100)
+
+def test_json_lines_sink():
+    tempdir = tempfile.mkdtemp("_oxasl")
+    try:
+        fname = os.path.join(tempdir, "progress.jsonl")
+        progress = Progress(JsonLinesSink(fname))
+        with progress.stage("test", nsteps=1) as stage:
+            stage.step(1, "step")
+        with open(fname) as infile:
+            events = [json.loads(line) for line in infile]
+        assert(len(events) == 3)
+        assert(events[1]["desc"] == "step")
+        assert(events[2]["status"] == "finished")
+    finally:
+        shutil.rmtree(tempdir)
+
+def test_metrics_sink():
+    tempdir = tempfile.mkdtemp("_oxasl")
+    try:
+        fname = os.path.join(tempdir, "progress.prom")
+        sink = MetricsSink(fname)
+        progress = Progress(sink)
+        stage = progress.stage("test", nsteps=2)
+        stage.start()
+        stage.step(1)
+        stage.update(50)
+        with open(fname) as infile:
+            metrics = infile.read()
+        assert('oxasl_progress_percent{stage="test",status="running"} 25.0' in metrics)
+        assert('oxasl_progress_nsteps{stage="test",status="running"} 2.0' in metrics)
+
+        assert(sink.stalled(60) == [])
+        sink.latest["test"]["time"] -= 120
+        assert(sink.stalled(60) == ["test"])
+        stage.finish()
+        assert(sink.stalled(0) == [])
+    finally:
+        shutil.rmtree(tempdir)
+
+def test_get_progress():
+    tempdir = tempfile.mkdtemp("_oxasl")
+    try:
+        fname = os.path.join(tempdir, "progress.jsonl")
+        wsp = Workspace(progress_file=fname)
+        progress = get_progress(wsp)
+        assert(len(progress.sinks) == 1)
+        assert(get_progress(wsp) is progress)
+        assert(get_progress(wsp.sub("child")) is progress)
+    finally:
+        shutil.rmtree(tempdir)
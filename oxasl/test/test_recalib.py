@@ -0,0 +1,114 @@
+"""
+Tests for batch recalibration of existing output
+"""
+import os
+import csv
+import tempfile
+import shutil
+
+import pytest
+import numpy as np
+import yaml
+from six import StringIO
+
+from fsl.data.image import Image
+
+from oxasl import recalib
+
+SHAPE = (5, 5, 5)
+
+@pytest.fixture
+def tempdir():
+    tempdir = tempfile.mkdtemp("_oxasl")
+    try:
+        yield tempdir
+    finally:
+        shutil.rmtree(tempdir)
+
+def _save(subjdir, name, data):
+    fname = os.path.join(subjdir, name)
+    if not os.path.exists(os.path.dirname(fname)):
+        os.makedirs(os.path.dirname(fname))
+    Image(data).save(fname)
+
+def _make_output(subjdir, **options):
+    """
+    Create an output directory with the same layout as oxasl --save-all
+    """
+    os.makedirs(os.path.join(subjdir, "input"))
+    with open(os.path.join(subjdir, "input", "_oxasl.yml"), "w") as outfile:
+        yaml.dump(options, outfile, default_flow_style=False)
+    data = {
+        "calib" : np.random.rand(*SHAPE) + 1,
+        "mask" : np.ones(SHAPE, dtype=np.int32),
+        "refmask" : np.zeros(SHAPE, dtype=np.int32),
+        "perfusion" : np.random.rand(*SHAPE),
+        "perfusion_var" : np.random.rand(*SHAPE),
+        "arrival" : np.random.rand(*SHAPE),
+    }
+    data["refmask"][1:3, 1:3, 1:3] = 1
+    _save(subjdir, "input/calib", data["calib"])
+    _save(subjdir, "rois/mask", data["mask"])
+    _save(subjdir, "calibration/refmask", data["refmask"])
+    for name in ("perfusion", "perfusion_var", "arrival"):
+        _save(subjdir, "output/native/%s" % name, data[name])
+        _save(subjdir, "output/struct/%s" % name, data[name])
+    return data
+
+def test_voxelwise(tempdir):
+    subjdir = os.path.join(tempdir, "subj1")
+    data = _make_output(subjdir, calib_method="voxelwise", calib_edgecorr=False, casl=True)
+    result = recalib.recalibrate(subjdir, pct=0.8)
+    assert(result["status"] == "ok")
+    assert(result["noutputs"] == 2)
+
+    # Voxelwise M0 can only be applied to native space output
+    outdir = os.path.join(subjdir, "recalib", "output")
+    assert(os.listdir(outdir) == ["native"])
+    perf_calib = Image(os.path.join(outdir, "native", "perfusion_calib"))
+    m0 = data["calib"] / 0.8
+    np.testing.assert_allclose(perf_calib.data, 6000 * data["perfusion"] / m0 / 0.85, rtol=1e-5)
+    var_calib = Image(os.path.join(outdir, "native", "perfusion_var_calib"))
+    np.testing.assert_allclose(var_calib.data, (6000 / 0.85)**2 * data["perfusion_var"] / m0**2, rtol=1e-5)
+    assert(not os.path.exists(os.path.join(outdir, "native", "arrival_calib.nii.gz")))
+
+def test_refregion(tempdir):
+    subjdir = os.path.join(tempdir, "subj1")
+    data = _make_output(subjdir, calib_method="refregion", tissref="csf", calib_gain=1.0)
+    result = recalib.recalibrate(subjdir, calib_gain=2.0)
+    assert(result["noutputs"] == 4)
+
+    # Reference region mask from original run is used
+    ref_mean = np.mean(data["calib"][data["refmask"] > 0])
+    m0 = 2.0 * ref_mean / (1 - np.exp(-3.2 / 4.3)) / 1.15
+    np.testing.assert_allclose(result["m0"], m0)
+    for space in ("native", "struct"):
+        perf_calib = Image(os.path.join(subjdir, "recalib", "output", space, "perfusion_calib"))
+        np.testing.assert_allclose(perf_calib.data, 6000 * data["perfusion"] / m0 / 0.98, rtol=1e-5)
+
+def test_existing_output(tempdir):
+    subjdir = os.path.join(tempdir, "subj1")
+    _make_output(subjdir, calib_method="voxelwise")
+    recalib.recalibrate(subjdir)
+    with pytest.raises(ValueError):
+        recalib.recalibrate(subjdir)
+    result = recalib.recalibrate(subjdir, overwrite=True)
+    assert(result["status"] == "ok")
+
+def test_batch_summary(tempdir):
+    subjdirs = [os.path.join(tempdir, "subj%i" % idx) for idx in range(3)]
+    for subjdir in subjdirs[:2]:
+        _make_output(subjdir, calib_method="voxelwise")
+    os.makedirs(subjdirs[2])
+
+    summary = os.path.join(tempdir, "summary.csv")
+    log = StringIO()
+    results = recalib.recalibrate_batch(subjdirs, summary=summary, log=log)
+    assert([result["status"] for result in results] == ["ok", "ok", "failed"])
+    with open(summary) as infile:
+        rows = list(csv.DictReader(infile))
+    assert([row["subject"] for row in rows] == subjdirs)
+    assert(rows[0]["calib_method"] == "voxelwise")
+    assert(float(rows[0]["m0"]) > 0)
+    assert("saved options" in rows[2]["error"])
+    assert("FAILED" in log.getvalue())
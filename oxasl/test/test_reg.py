@@ -5,6 +5,7 @@ FIXME need satrecov tests
 FIXME need sensitivity correction tests
 FIXME need test with edge correction
 """
+import os
 import math
 
 import pytest
@@ -12,7 +13,7 @@ import numpy as np
 
 from fsl.data.image import Image
 
-from oxasl import Workspace, reg, AslImage, brain
+from oxasl import Workspace, reg, struc, AslImage, brain
 
 def get_wsp():
     wsp = Workspace(debug=True)
@@ -59,3 +60,98 @@ def test_get_regfrom_calib():
     reg.get_regfrom(wsp)
     calib_brain = brain.brain(wsp, wsp.calib, thresh=0.2)
     assert(np.allclose(calib_brain.data, wsp.reg.regfrom.data))
+
+def test_get_pves_asl(monkeypatch):
+    """
+    Test tissue PVEs are transformed in a single call and cached until the registration changes
+    """
+    calls = []
+    def _struc2asl(wsp, img, **kwargs):
+        calls.append(img.shape)
+        return Image(img.data * 2, header=img.header)
+    monkeypatch.setattr(reg, "struc2asl", _struc2asl)
+
+    wsp = get_wsp()
+    wsp.sub("structural")
+    wsp.structural.struc = wsp.struc
+    for tiss_type in ("csf", "gm", "wm"):
+        setattr(wsp.structural, "%s_pv" % tiss_type, Image(np.random.rand(10, 10, 10)))
+        setattr(wsp.structural, "%s_seg" % tiss_type, Image(np.ones((10, 10, 10), dtype=np.int32)))
+    wsp.sub("reg")
+    wsp.reg.struc2asl = np.identity(4)
+
+    csf, gm, wm = struc.get_pves_asl(wsp)
+    assert(calls == [(10, 10, 10, 3)])
+    assert(np.allclose(csf.data, wsp.structural.csf_pv.data * 2))
+    assert(np.allclose(gm.data, wsp.structural.gm_pv.data * 2))
+    assert(np.allclose(wm.data, wsp.structural.wm_pv.data * 2))
+
+    struc.get_pves_asl(wsp)
+    assert(len(calls) == 1)
+
+    wsp.reg.struc2asl = 2 * np.identity(4)
+    struc.get_pves_asl(wsp)
+    assert(len(calls) == 2)
+
+def test_transform_numpy():
+    """
+    Test affine transformation using the in-process resampling engine
+    """
+    wsp = get_wsp()
+    ret = reg.transform(wsp, wsp.calib, np.identity(4), wsp.calib, engine="numpy")
+    np.testing.assert_allclose(ret.data, wsp.calib.data, rtol=1e-6)
+
+    ret = reg.transform(wsp, wsp.calib, np.identity(4), wsp.calib, mask=True, engine="numpy")
+    assert(np.all(ret.data == (wsp.calib.data > 0.5)))
+
+def test_transform_bad_engine():
+    wsp = get_wsp()
+    with pytest.raises(ValueError):
+        reg.transform(wsp, wsp.calib, np.identity(4), wsp.calib, engine="itk")
+
+def test_resampling_operator_cached():
+    """
+    Test resampling operators for named transformations are reused until the transformation changes
+    """
+    wsp = get_wsp()
+    wsp.resample_engine = "numpy"
+    wsp.nativeref = wsp.calib
+    wsp.sub("reg")
+    wsp.reg.struc2asl = np.identity(4)
+    img = Image(np.random.rand(10, 10, 10))
+    ret = reg.struc2asl(wsp, img)
+    assert(ret.shape == (5, 5, 5))
+    op = wsp.reg.resampling_ops[("struc2asl", "trilinear", 1, True)]
+    np.testing.assert_allclose(ret.data, reg.transform(wsp, img, np.identity(4), wsp.calib, engine="numpy").data, rtol=1e-5)
+
+    reg.struc2asl(wsp, Image(np.random.rand(10, 10, 10, 2)))
+    assert(wsp.reg.resampling_ops[("struc2asl", "trilinear", 1, True)] is op)
+
+    wsp.reg.struc2asl = 2 * np.identity(4)
+    reg.struc2asl(wsp, img)
+    assert(wsp.reg.resampling_ops[("struc2asl", "trilinear", 1, True)] is not op)
+
+def _have_fsl():
+    fsldir = os.environ.get("FSLDIR", "")
+    return bool(fsldir) and os.path.exists(os.path.join(fsldir, "bin", "applywarp"))
+
+@pytest.mark.skipif(not _have_fsl(), reason="FSL not available")
+@pytest.mark.parametrize("interp", ["trilinear", "nn"])
+def test_transform_numpy_applywarp(interp):
+    """
+    Test the numpy engine agrees with applywarp for an oblique downsampling transformation
+    """
+    wsp = get_wsp()
+    x, y, z = np.indices((30, 32, 28)).astype(np.float32)
+    src = Image(np.sin(x / 5) + np.cos(y / 7) + z / 10, xform=np.identity(4))
+    ref = Image(np.zeros((10, 11, 8)), xform=np.diag([2.7, 2.5, 3.3, 1]))
+    trans = np.identity(4)
+    trans[:3, :3] = [[0.99, 0.1, 0], [-0.1, 0.99, 0.05], [0, -0.05, 1]]
+    trans[:3, 3] = [1.3, -2.1, 0.7]
+
+    fsl_ret = reg.transform(wsp, src, trans, ref, interp=interp, engine="fsl")
+    numpy_ret = reg.transform(wsp, src, trans, ref, interp=interp, engine="numpy")
+    # Compare away from the edge of the source volume where padding conventions may differ
+    inside = np.zeros(ref.shape, dtype=bool)
+    inside[2:-2, 2:-2, 2:-2] = True
+    np.testing.assert_allclose(numpy_ret.data[inside], fsl_ret.data[inside], atol=0.02)
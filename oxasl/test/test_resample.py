@@ -0,0 +1,131 @@
+"""
+Tests for in-process affine resampling
+"""
+import numpy as np
+import pytest
+
+from fsl.data.image import Image
+
+from oxasl import resample
+
+def _ramp(shape, coeffs=(1.0, 2.0, 3.0), const=5.0):
+    """ Linear function of voxel coordinates, preserved exactly by trilinear interpolation """
+    voxels = np.indices(shape).astype(np.float64)
+    return sum([c * v for c, v in zip(coeffs, voxels)]) + const
+
+def _grid(shape, voxel_size):
+    return Image(np.zeros(shape), xform=np.diag(list(voxel_size) + [1.0]))
+
+def test_identity():
+    img = Image(np.random.rand(6, 7, 8))
+    ret = resample.resample(img, np.identity(4), img)
+    assert(ret.shape == img.shape)
+    np.testing.assert_allclose(ret.data, img.data, rtol=1e-6)
+
+def test_translation():
+    img = Image(np.random.rand(6, 7, 8))
+    trans = np.identity(4)
+    trans[1, 3] = 2
+    ret = resample.resample(img, trans, img, paddingsize=0)
+    np.testing.assert_allclose(ret.data[:, 2:, :], img.data[:, :-2, :], rtol=1e-6)
+    assert(np.all(ret.data[:, :2, :] == 0))
+
+def test_padding():
+    img = Image(np.random.rand(6, 7, 8))
+    trans = np.identity(4)
+    trans[1, 3] = 2
+    ret = resample.resample(img, trans, img, paddingsize=1)
+    # One voxel is extrapolated from the edge of the source volume
+    np.testing.assert_allclose(ret.data[:, 1, :], img.data[:, 0, :], rtol=1e-6)
+    assert(np.all(ret.data[:, 0, :] == 0))
+
+def test_downsample_supersampled():
+    img = Image(_ramp((12, 12, 12)), xform=np.identity(4))
+    ref = _grid((4, 4, 4), (3, 3, 3))
+    mat = resample.vox2vox(np.identity(4), img, ref)
+    assert(resample.supersampling_levels(mat) == [3, 3, 3])
+
+    ret = resample.resample(img, np.identity(4), ref, paddingsize=0)
+    src_voxels = np.dot(mat[:3, :3], np.indices((4, 4, 4)).reshape(3, -1)) + mat[:3, 3:]
+    expected = (np.dot([1.0, 2.0, 3.0], src_voxels) + 5.0).reshape(4, 4, 4)
+    # Only compare voxels whose supersampled points are all inside the source volume
+    inside = np.all((src_voxels >= 1) & (src_voxels <= 10), axis=0).reshape(4, 4, 4)
+    assert(np.any(inside))
+    np.testing.assert_allclose(ret.data[inside], expected[inside], rtol=1e-5)
+
+def test_nn_labels():
+    labels = np.random.randint(0, 4, size=(12, 12, 12))
+    img = Image(labels.astype(np.float32), xform=np.identity(4))
+    ref = _grid((4, 4, 4), (3, 3, 3))
+    ret = resample.resample(img, np.identity(4), ref, interp="nn")
+    assert(np.all(np.isin(ret.data, [0, 1, 2, 3])))
+
+def test_spline_identity():
+    img = Image(np.random.rand(6, 7, 8))
+    ret = resample.resample(img, np.identity(4), img, interp="spline")
+    np.testing.assert_allclose(ret.data, img.data, rtol=1e-4, atol=1e-5)
+
+def test_4d():
+    data = np.random.rand(6, 7, 8, 3)
+    img = Image(data)
+    trans = np.identity(4)
+    trans[0, 3] = -1.5
+    ret = resample.resample(img, trans, Image(data[..., 0]))
+    assert(ret.shape == (6, 7, 8, 3))
+    for vol in range(3):
+        ret_vol = resample.resample(Image(data[..., vol]), trans, Image(data[..., 0]))
+        np.testing.assert_allclose(ret.data[..., vol], ret_vol.data)
+
+def test_chunks():
+    img = Image(np.random.rand(6, 7, 8))
+    trans = np.identity(4)
+    trans[:3, 3] = [0.3, -0.7, 1.2]
+    ret1 = resample.resample(img, trans, img)
+    ret2 = resample.resample(img, trans, img, chunk_size=50)
+    np.testing.assert_allclose(ret1.data, ret2.data)
+
+def test_bad_interp():
+    img = Image(np.random.rand(6, 7, 8))
+    with pytest.raises(ValueError):
+        resample.resample(img, np.identity(4), img, interp="sinc")
+
+def _oblique():
+    trans = np.identity(4)
+    trans[:3, :3] = [[0.99, 0.1, 0], [-0.1, 0.99, 0.05], [0, -0.05, 1]]
+    trans[:3, 3] = [1.3, -2.1, 0.7]
+    return trans
+
+@pytest.mark.parametrize("interp", ["trilinear", "nn"])
+@pytest.mark.parametrize("supersample", [True, False])
+def test_operator_matches_resample(interp, supersample):
+    src = Image(np.random.rand(20, 22, 18), xform=np.identity(4))
+    ref = _grid((8, 9, 6), (2.7, 2.5, 3.3))
+    op = resample.ResamplingOperator(_oblique(), src, ref, interp=interp, supersample=supersample, chunk_size=5000)
+    assert(op.matrix.shape == (8*9*6, 20*22*18))
+    ret = op.apply(src)
+    expected = resample.resample(src, _oblique(), ref, interp=interp, supersample=supersample)
+    np.testing.assert_allclose(ret.data, expected.data, rtol=1e-5, atol=1e-6)
+
+def test_operator_4d():
+    data = np.random.rand(20, 22, 18, 3)
+    ref = _grid((8, 9, 6), (2.7, 2.5, 3.3))
+    op = resample.ResamplingOperator(_oblique(), Image(data[..., 0]), ref)
+    ret = op.apply(Image(data))
+    assert(ret.shape == (8, 9, 6, 3))
+    for vol in range(3):
+        np.testing.assert_allclose(ret.data[..., vol], op.apply(Image(data[..., vol])).data)
+
+def test_operator_matches():
+    src = Image(np.random.rand(20, 22, 18), xform=np.identity(4))
+    ref = _grid((8, 9, 6), (2.7, 2.5, 3.3))
+    op = resample.ResamplingOperator(_oblique(), src, ref)
+    assert(op.matches(_oblique(), src, ref))
+    assert(not op.matches(np.identity(4), src, ref))
+    assert(not op.matches(_oblique(), Image(np.random.rand(20, 22, 19)), ref))
+    with pytest.raises(ValueError):
+        op.apply(Image(np.random.rand(20, 22, 19)))
+
+def test_operator_spline():
+    img = Image(np.random.rand(6, 7, 8))
+    with pytest.raises(ValueError):
+        resample.ResamplingOperator(np.identity(4), img, img, interp="spline")
@@ -0,0 +1,86 @@
+"""
+Tests for cache of derived standard space images
+"""
+import os
+import time
+import tempfile
+import shutil
+
+import numpy as np
+import pytest
+
+from fsl.data.image import Image
+
+from oxasl import stdcache
+
+@pytest.fixture
+def cachedir():
+    tempdir = tempfile.mkdtemp("_oxasl")
+    saved = dict((key, os.environ.get(key)) for key in ("FSLDIR", "OXASL_STD_CACHE"))
+    os.environ["FSLDIR"] = os.path.join(tempdir, "fsl")
+    os.environ["OXASL_STD_CACHE"] = os.path.join(tempdir, "cache")
+    os.makedirs(os.environ["FSLDIR"])
+    stdcache.clear()
+    try:
+        yield tempdir
+    finally:
+        stdcache.clear()
+        for key, value in saved.items():
+            if value is None:
+                del os.environ[key]
+            else:
+                os.environ[key] = value
+        shutil.rmtree(tempdir)
+
+def _creator(calls):
+    def _create():
+        calls.append(1)
+        return Image(np.arange(24, dtype=np.int32).reshape([2, 3, 4]))
+    return _create
+
+def test_memory_cache(cachedir):
+    calls = []
+    img1 = stdcache.cached_image("test", [], _creator(calls), disk=False)
+    img2 = stdcache.cached_image("test", [], _creator(calls), disk=False)
+    assert(len(calls) == 1)
+    assert(img1 is img2)
+    assert(not os.path.exists(os.environ["OXASL_STD_CACHE"]))
+
+def test_disk_cache(cachedir):
+    calls = []
+    img1 = stdcache.cached_image("test", [], _creator(calls))
+    assert(len(os.listdir(os.environ["OXASL_STD_CACHE"])) == 1)
+    stdcache.clear()
+    img2 = stdcache.cached_image("test", [], _creator(calls))
+    assert(len(calls) == 1)
+    assert(img1 is not img2)
+    assert(np.all(img1.data == img2.data))
+
+def test_source_changed(cachedir):
+    calls = []
+    source = os.path.join(os.environ["FSLDIR"], "atlas.nii.gz")
+    with open(source, "w") as outfile:
+        outfile.write("v1")
+    stdcache.cached_image("test", [source], _creator(calls))
+    stdcache.cached_image("test", [source], _creator(calls))
+    assert(len(calls) == 1)
+
+    with open(source, "w") as outfile:
+        outfile.write("version2")
+    stdcache.cached_image("test", [source], _creator(calls))
+    assert(len(calls) == 2)
+
+def test_fsldir_changed(cachedir):
+    calls = []
+    stdcache.cached_image("test", [], _creator(calls))
+    os.environ["FSLDIR"] = os.path.join(cachedir, "fsl2")
+    stdcache.cached_image("test", [], _creator(calls))
+    assert(len(calls) == 2)
+
+def test_cache_not_writable(cachedir):
+    calls = []
+    with open(os.environ["OXASL_STD_CACHE"], "w") as outfile:
+        outfile.write("not a directory")
+    img = stdcache.cached_image("test", [], _creator(calls))
+    assert(len(calls) == 1)
+    assert(img.shape == (2, 3, 4))
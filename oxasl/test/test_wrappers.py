@@ -0,0 +1,311 @@
+"""
+Tests for additional FSL wrappers
+"""
+import os
+import tempfile
+import shutil
+
+import pytest
+import numpy as np
+
+from fsl.data.image import Image
+
+from oxasl.wrappers.fabber import select_outputs, requested_items, _Results, _as_fabber_data, FabberWorker, mvn_update, model_fit, get_worker, _WORKERS
+from oxasl.wrappers.mvn import MVN
+
+OPTIONS = {
+    "model" : "aslrest",
+    "save-mean" : True,
+    "save-std" : True,
+    "save-mvn" : True,
+    "save-model-fit" : True,
+    "save-model-extras" : True,
+}
+
+def test_select_outputs_all():
+    """ All save options kept when outputs not specified """
+    assert(select_outputs(OPTIONS, None) == OPTIONS)
+
+def test_select_outputs_mvn():
+    """ Only MVN output """
+    options = select_outputs(OPTIONS, ["finalMVN"])
+    assert("save-mvn" in options)
+    assert("save-mean" not in options)
+    assert("save-std" not in options)
+    assert("save-model-fit" not in options)
+    assert("save-model-extras" in options)
+    assert(options["model"] == "aslrest")
+
+def test_select_outputs_param():
+    """ Individual parameter output keeps parameter save option """
+    options = select_outputs(OPTIONS, ["finalMVN", "mean_ftiss"])
+    assert("save-mvn" in options)
+    assert("save-mean" in options)
+    assert("save-std" not in options)
+
+def test_select_outputs_pattern():
+    """ Glob patterns in requested outputs """
+    options = select_outputs(OPTIONS, ["std_*"])
+    assert("save-std" in options)
+    assert("save-mean" not in options)
+    assert("save-mvn" not in options)
+
+def test_select_outputs_copy():
+    """ Original options are not modified """
+    select_outputs(OPTIONS, [])
+    assert("save-mean" in OPTIONS)
+
+def test_fabber_data_nocopy():
+    """ Float32 image data is passed without copying """
+    img = Image(np.random.rand(5, 5, 5).astype(np.float32))
+    data, copied = _as_fabber_data(img)
+    assert(data.dtype == np.float32)
+    assert(copied == 0)
+    assert(np.may_share_memory(data, img.data))
+
+def test_fabber_data_convert():
+    """ Non-float32 image data is converted """
+    img = Image(np.random.rand(5, 5, 5))
+    data, copied = _as_fabber_data(img)
+    assert(data.dtype == np.float32)
+    assert(copied == data.nbytes)
+    assert(np.allclose(data, img.data))
+
+def test_results_lazy():
+    """ Raw output data is only wrapped as an image when accessed """
+    ret = _Results([], wrap=Image)
+    ret.set_lazy("mean_ftiss", np.ones((5, 5, 5), dtype=np.float32))
+    ret["paramnames"] = ["ftiss"]
+    assert(ret.stats["output_bytes"] == 500)
+    assert(ret.stats["wrapped_bytes"] == 0)
+    assert(isinstance(ret["mean_ftiss"], Image))
+    assert(ret.stats["wrapped_bytes"] == 500)
+    assert(ret["mean_ftiss"] is ret.get("mean_ftiss"))
+    assert(ret.stats["wrapped_bytes"] == 500)
+    assert(dict(ret.items())["paramnames"] == ["ftiss"])
+
+def test_requested_items():
+    """ Output data which was not requested is not included or wrapped """
+    ret = _Results([], wrap=Image)
+    ret.set_lazy("mean_ftiss", np.ones((5, 5, 5), dtype=np.float32))
+    ret.set_lazy("freeEnergy", np.ones((5, 5, 5), dtype=np.float32))
+    ret.set_lazy("modelfit", np.ones((5, 5, 5, 3), dtype=np.float32))
+    ret["paramnames"] = ["ftiss"]
+    assert(sorted(requested_items(ret, ["freeEnergy"])) == ["freeEnergy", "paramnames"])
+    assert(sorted(requested_items(ret, ["mean_*"])) == ["mean_ftiss", "paramnames"])
+    assert(sorted(requested_items(ret, None)) == ["freeEnergy", "mean_ftiss", "modelfit", "paramnames"])
+    assert(ret.stats["wrapped_bytes"] == 0)
+
+def _input_value(value):
+    """ Data passed to Fabber as array or file name """
+    if isinstance(value, str):
+        return Image(value).data
+    return value
+
+def test_worker_api_reused():
+    """ Fabber API object is created once per worker """
+    worker = FabberWorker()
+    api, _ = worker.api()
+    api2, startup_time = worker.api()
+    assert(api is api2)
+    assert(startup_time == 0)
+
+def test_worker_cached():
+    """ Input images are converted once and re-used, except the initial MVN """
+    worker = FabberWorker()
+    data = Image(np.random.rand(5, 5, 5, 4))
+    mask = Image(np.ones((5, 5, 5)))
+    options = {"model" : "poly", "data" : data, "mask" : mask,
+               "continue-from-mvn" : Image(np.random.rand(5, 5, 5, 6))}
+    try:
+        converted, stats = worker.inputs(options)
+        assert(stats["cached_bytes"] == 0)
+        assert(stats["input_bytes"] == 4 * (500 + 125 + 750))
+        assert(np.allclose(_input_value(converted["data"]), data.data))
+        assert(converted["model"] == "poly")
+        assert(options["data"] is data)
+        worker.end_run()
+
+        converted2, stats = worker.inputs(options)
+        assert(stats["cached_bytes"] == 4 * (500 + 125))
+        assert(stats["input_copy_bytes"] == 4 * 750)
+        assert(converted2["data"] is converted["data"])
+        assert(converted2["mask"] is converted["mask"])
+        assert(worker.cached_bytes() == 4 * (500 + 125))
+        worker.end_run()
+    finally:
+        worker.clear()
+    assert(worker.cached_bytes() == 0)
+
+def test_worker_evict():
+    """ Least recently used images are released when the limit is reached """
+    worker = FabberWorker(max_items=1)
+    data = Image(np.random.rand(5, 5, 5, 4))
+    data2 = Image(np.random.rand(5, 5, 5, 4))
+    try:
+        worker.inputs({"data" : data})
+        worker.inputs({"data" : data2})
+        assert(worker.cached_bytes() == 2000)
+        _, stats = worker.inputs({"data" : data})
+        assert(stats["cached_bytes"] == 0)
+    finally:
+        worker.clear()
+
+def test_worker_cache_identity():
+    """ Cached images are identified by object so a new image is converted again """
+    worker = FabberWorker()
+    data = Image(np.random.rand(5, 5, 5, 4))
+    try:
+        worker.inputs({"data" : data})
+        worker.end_run()
+        data2 = Image(data.data + 1)
+        converted, stats = worker.inputs({"data" : data2})
+        assert(stats["cached_bytes"] == 0)
+        assert(np.allclose(_input_value(converted["data"]), data2.data))
+        assert(worker.cached_bytes() == 4000)
+        worker.end_run()
+    finally:
+        worker.clear()
+
+class _StubApi(object):
+    """ Fabber API evaluating a linear model offset by a voxelwise option """
+    def __init__(self):
+        self.evaluations = 0
+
+    def get_model_params(self, options):
+        return ["a", "b"]
+
+    def model_evaluate(self, options, param_values, nvols, indata=None, output_name=""):
+        self.evaluations += 1
+        offset = options["pv"].ravel()[0] if "pv" in options else 0
+        return param_values["a"] + param_values["b"] * np.arange(nvols) + offset
+
+def _mvn_data(a, b):
+    """ MVN image with given means for 2 parameters and unit covariance """
+    shape = a.shape
+    mvn = MVN(Image(np.zeros(list(shape) + [10], dtype=np.float32)), paramnames=["a", "b"])
+    mvn = MVN(mvn.update(0, mean=a, var=1), paramnames=["a", "b"])
+    return mvn.update(1, mean=b, var=1)
+
+def _stub_worker():
+    worker = get_worker(("stub",))
+    worker._local.api = _StubApi()
+    return worker._local.api
+
+def test_model_fit():
+    """ Model fit is evaluated in each voxel within the mask """
+    api = _stub_worker()
+    try:
+        a, b = np.random.rand(3, 3, 3), np.random.rand(3, 3, 3)
+        mask = np.ones((3, 3, 3), dtype=np.int32)
+        mask[0] = 0
+        options = {"model" : "stub", "data" : Image(np.zeros((3, 3, 3, 4))), "mask" : Image(mask)}
+        fit = model_fit(options, _mvn_data(a, b), fabber_dirs=("stub",))
+        assert(fit.shape == (3, 3, 3, 4))
+        expected = a[..., np.newaxis] + b[..., np.newaxis] * np.arange(4)
+        assert(np.allclose(fit.data[1:], expected[1:]))
+        assert(np.all(fit.data[0] == 0))
+        assert(api.evaluations == 18)
+    finally:
+        _WORKERS.pop(("stub",))
+
+def test_model_fit_voxelwise():
+    """ Voxelwise options are passed to the model for each voxel """
+    api = _stub_worker()
+    try:
+        a, b = np.random.rand(3, 3, 3), np.random.rand(3, 3, 3)
+        pv = np.zeros((3, 3, 3))
+        pv[1] = 0.5
+        pv[2] = 1
+        options = {"model" : "stub", "data" : Image(np.zeros((3, 3, 3, 4))), "pv" : Image(pv)}
+        fit = model_fit(options, _mvn_data(a, b), fabber_dirs=("stub",))
+        expected = a[..., np.newaxis] + b[..., np.newaxis] * np.arange(4) + pv[..., np.newaxis]
+        assert(np.allclose(fit.data, expected))
+    finally:
+        _WORKERS.pop(("stub",))
+
+def test_mvn_update():
+    """ Setting parameter mean and variance in an MVN in memory """
+    # Two parameters + noise: 6 covariance entries, 3 means and a final 1
+    mvn_data = np.random.rand(3, 3, 3, 10).astype(np.float32)
+    mvn = Image(mvn_data)
+    mask = np.zeros([3, 3, 3], dtype=np.int32)
+    mask[1, 1, 1] = 1
+    mean = np.full([3, 3, 3], 7.0)
+
+    updated = mvn_update(mvn, 1, mean=mean, var=0.1, mask=mask)
+    assert(updated.shape == mvn.shape)
+    assert(np.allclose(updated.data[1, 1, 1, 7], 7.0))
+    assert(np.allclose(updated.data[1, 1, 1, 2], 0.1))
+    assert(np.allclose(updated.data[0, 0, 0], mvn_data[0, 0, 0]))
+    unchanged = [vol for vol in range(10) if vol not in (2, 7)]
+    assert(np.allclose(updated.data[1, 1, 1, unchanged], mvn_data[1, 1, 1, unchanged]))
+    # Original is not modified
+    assert(np.allclose(mvn.data, mvn_data))
+
+def _test_mvn():
+    # Two parameters + noise: 6 covariance entries, 3 means and a final 1
+    mvn_data = np.random.rand(3, 3, 3, 10).astype(np.float32)
+    mvn_data[..., 9] = 1
+    return MVN(Image(mvn_data), paramnames=["ftiss", "delttiss"]), mvn_data
+
+def test_mvn_access():
+    """ Vectorised access to means and covariances """
+    mvn, mvn_data = _test_mvn()
+    assert(mvn.nparams == 3)
+    assert(np.all(mvn.mean("ftiss") == mvn_data[..., 6]))
+    assert(np.all(mvn.mean(2) == mvn_data[..., 8]))
+    assert(np.all(mvn.var("delttiss") == mvn_data[..., 2]))
+    assert(np.all(mvn.cov("ftiss", "delttiss") == mvn_data[..., 1]))
+    assert(np.all(mvn.cov(2, 1) == mvn_data[..., 4]))
+    assert(np.all(mvn.means() == mvn_data[..., 6:9]))
+    assert(np.all(mvn.variances() == mvn_data[..., [0, 2, 5]]))
+    cov = mvn.covariance()
+    assert(cov.shape == (3, 3, 3, 3, 3))
+    assert(np.all(cov[..., 0, 2] == mvn_data[..., 3]))
+    assert(np.all(cov[..., 2, 0] == mvn_data[..., 3]))
+
+def test_mvn_invalid():
+    with pytest.raises(ValueError):
+        MVN(Image(np.zeros([3, 3, 3, 9])))
+    mvn, _ = _test_mvn()
+    with pytest.raises(ValueError):
+        mvn.mean("fwm")
+
+def test_mvn_merge():
+    """ Merging MVNs from chunks of voxels """
+    mvn, mvn_data = _test_mvn()
+    mask1 = np.zeros([3, 3, 3], dtype=np.int32)
+    mask1[:2] = 1
+    mask2 = 1 - mask1
+    merged = MVN.merge([mvn.masked(mask1), mvn.masked(mask2)])
+    assert(np.allclose(merged.data, mvn_data))
+    assert(merged.paramnames == ["ftiss", "delttiss"])
+
+def test_mvn_crop():
+    mvn, mvn_data = _test_mvn()
+    cropped = mvn.cropped([[0, 2], [1, 3], [0, 3]])
+    assert(cropped.shape == (2, 2, 3))
+    assert(np.allclose(cropped.mean("ftiss"), mvn_data[:2, 1:3, :, 6]))
+
+def test_mvn_save():
+    mvn, mvn_data = _test_mvn()
+    tempdir = tempfile.mkdtemp("_oxasl")
+    try:
+        fname = os.path.join(tempdir, "mvn.nii")
+        mvn.save(fname)
+        loaded = MVN(fname)
+        assert(loaded.nparams == 3)
+        assert(np.allclose(loaded.data, mvn_data))
+        loaded.update(0, mean=2.0)
+        assert(np.allclose(loaded.mean(0), 2.0))
+    finally:
+        shutil.rmtree(tempdir)
+
+def test_mvn_update_nomask():
+    """ Update without a mask changes every voxel """
+    data = np.random.rand(2, 2, 2, 6).astype(np.float32)
+    mvn = MVN(Image(data))
+    mvn.update(0, mean=1.5, var=0.1)
+    assert(np.all(mvn.mean(0) == 1.5))
+    np.testing.assert_allclose(mvn.var(0), 0.1)
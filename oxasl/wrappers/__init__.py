@@ -2,8 +2,9 @@
 Additional FSL wrappers intended to be compatible with FSL python wrappers as far as possible
 """
 
-from .fabber import fabber, mvntool
+from .fabber import fabber, model_fit, mvntool, mvn_update
+from .mvn import MVN
 from .epi_reg import epi_reg
 from .fnirt_extra import fnirtfileutils
 
-__all__ = ["fabber", "mvntool", "epi_reg", "fnirtfileutils"]
+__all__ = ["fabber", "model_fit", "mvntool", "mvn_update", "MVN", "epi_reg", "fnirtfileutils"]
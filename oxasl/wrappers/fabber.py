@@ -5,6 +5,13 @@ from __future__ import absolute_import
 
 import sys
 import os
+import fnmatch
+import time
+import shutil
+import tempfile
+import threading
+import atexit
+from collections import OrderedDict
 
 import six
 import numpy as np
@@ -13,32 +20,387 @@ import nibabel as nib
 from fsl.data.image import Image
 from fsl.wrappers import LOAD, wrapperutils  as wutils
 import fsl.utils.assertions as asrt
-from fabber import Fabber, FabberException, percent_progress
+from fabber import Fabber, FabberCl, FabberException, percent_progress
 
 from oxasl.utils import Tee
+from .mvn import MVN
 
 def _matching_image(base_img, img):
     if isinstance(base_img, nib.Nifti1Image):
         return img.nibImage
     elif isinstance(base_img, np.ndarray):
-        return img.nibImage.get_data()
+        return img.data
     else:
         return img
 
+# Output data items generated by each of the Fabber save options. Names may
+# be glob patterns as some outputs are generated for each model parameter
+SAVE_OPTIONS = {
+    "save-mean" : ["mean_*"],
+    "save-std" : ["std_*"],
+    "save-var" : ["var_*"],
+    "save-zstat" : ["zstat_*"],
+    "save-noise-mean" : ["noise_means"],
+    "save-noise-std" : ["noise_stdevs"],
+    "save-free-energy" : ["freeEnergy"],
+    "save-model-fit" : ["modelfit"],
+    "save-residuals" : ["residuals"],
+    "save-mvn" : ["finalMVN"],
+}
+
+def _output_wanted(name, outputs):
+    """
+    :return: True if an output name (possibly a pattern) matches any of a sequence of patterns
+    """
+    if outputs is None:
+        return True
+    for pattern in outputs:
+        if fnmatch.fnmatch(name, pattern) or fnmatch.fnmatch(pattern, name):
+            return True
+    return False
+
+def select_outputs(options, outputs):
+    """
+    Remove Fabber save options which do not generate any of a set of required outputs
+
+    Note that the Fabber API treats the presence of a save option as enabling it
+    regardless of its value so unwanted options must be removed, not set to False.
+    Save options which are not recognized (e.g. ``save-model-extras``) are
+    left alone.
+
+    :param options: Fabber options dictionary
+    :param outputs: Sequence of output names to keep. Glob-style patterns are
+                    supported, e.g. ``mean_*``. If None, all outputs are kept
+    :return: Copy of options dictionary with unneeded save options removed
+    """
+    options = dict(options)
+    if outputs is not None:
+        for key, names in SAVE_OPTIONS.items():
+            if key in options and not any([_output_wanted(name, outputs) for name in names]):
+                del options[key]
+    return options
+
+def requested_items(results, outputs):
+    """
+    Get the names of the items in a Fabber result which are required
+
+    Output data items are only included if they match one of the required
+    outputs, so outputs which are not needed are never converted to images.
+    Other items (e.g. the log and parameter names) are always included.
+
+    :param results: ``_Results`` dictionary as returned by ``fabber``
+    :param outputs: Sequence of output names to keep. Glob-style patterns are
+                    supported, e.g. ``mean_*``. If None, all items are included
+    :return: List of item names
+    """
+    ret = []
+    for key in results.keys():
+        is_output = any([_output_wanted(key, names) for names in SAVE_OPTIONS.values()])
+        if not is_output or _output_wanted(key, outputs):
+            ret.append(key)
+    return ret
+
+def _as_fabber_data(value):
+    """
+    Get the data from an image-like option value in the form used by the Fabber API
+
+    The Fabber API requires float32 data so this is returned as a Numpy array of
+    this type. If the data is already float32 no copy is made.
+
+    :return: Tuple of float32 Numpy array, number of bytes copied in conversion
+    """
+    if isinstance(value, Image):
+        orig = value.data
+    else:
+        orig = np.asanyarray(value.dataobj)
+    data = np.asarray(orig, dtype=np.float32)
+    if np.may_share_memory(data, orig):
+        return data, 0
+    else:
+        return data, data.nbytes
+
+class FabberWorker(object):
+    """
+    Fabber API object and input conversion cache shared between runs
+
+    Creating a Fabber API object involves searching for the core and model
+    libraries and executables, and each run converts all input images to the
+    form required by the API. For the command line API this means writing
+    temporary Nifti files, which happens several times per run as the model
+    parameters and outputs are queried separately.
+
+    A worker creates the API object once per thread (an API object can only
+    perform one run at a time) and remembers the results of model queries.
+    Note that this only saves the library search and the queries - each run
+    still creates a new Fabber context which loads the model libraries and
+    receives all of the input data.
+
+    Converted input images (float32 arrays, or temporary Nifti files for the
+    command line API) are cached so the data, mask and other fixed inputs are
+    only converted once across multiple steps and runs. Images are identified
+    by object, so the same image object must be passed to each run. Image data
+    must not be modified in place after being passed to Fabber as this is not
+    detected - create a new image instead. The initial MVN is not cached as it
+    changes on every step.
+    """
+
+    # Input options which change for every run so are not cached
+    NOT_CACHED = ("continue-from-mvn",)
+
+    def __init__(self, search_dirs=(), max_items=16, max_bytes=1024*1024*1024):
+        """
+        :param search_dirs: Extra search directories for Fabber libraries and executables
+        :param max_items: Maximum number of converted images to cache
+        :param max_bytes: Maximum size of cached image data in bytes
+        """
+        self.search_dirs = tuple(search_dirs)
+        self.max_items = max_items
+        self.max_bytes = max_bytes
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._cache = OrderedDict()
+        self._data_keys = set()
+        self._tempdir = None
+
+    def api(self):
+        """
+        Get the Fabber API object for the current thread
+
+        :return: Tuple of API object, time taken to create it in seconds (zero
+                 if it had already been created)
+        """
+        api = getattr(self._local, "api", None)
+        if api is not None:
+            return api, 0.0
+
+        start = time.time()
+        api = Fabber(*self.search_dirs)
+        self._memoize(api, "get_options", lambda *args, **kwargs: (args, tuple(sorted(kwargs.items()))))
+        self._memoize(api, "get_model_params", self._options_key)
+        self._memoize(api, "get_model_outputs", self._options_key)
+        self._local.api = api
+        return api, time.time() - start
+
+    def _memoize(self, api, name, keyfn):
+        method = getattr(api, name)
+        results = {}
+        def _memoized(*args, **kwargs):
+            key = keyfn(*args, **kwargs)
+            if key not in results:
+                results[key] = method(*args, **kwargs)
+            return results[key]
+        setattr(api, name, _memoized)
+
+    def _options_key(self, options):
+        """
+        Key for model queries. Model parameters and outputs do not depend on
+        the content of data options
+        """
+        key = []
+        for name, value in sorted(options.items()):
+            if name in self._data_keys or isinstance(value, (np.ndarray, Image, nib.Nifti1Image)):
+                value = None
+            key.append((name, str(value)))
+        return tuple(key)
+
+    def inputs(self, options):
+        """
+        Convert image options to the form required by the Fabber API
+
+        :param options: Fabber options dictionary
+        :return: Tuple of converted options dictionary and dictionary of statistics:
+                 ``input_bytes``, ``input_copy_bytes``, ``cached_bytes`` (bytes re-used
+                 from previously converted images) and ``transfer_time`` (time spent converting images)
+        """
+        api, _ = self.api()
+        command_line = isinstance(api, FabberCl)
+        stats = {"input_bytes" : 0, "input_copy_bytes" : 0, "cached_bytes" : 0, "transfer_time" : 0.0}
+        start = time.time()
+        options = dict(options)
+        for key in list(options.keys()):
+            value = options[key]
+            if not isinstance(value, (Image, nib.Nifti1Image)):
+                continue
+            self._data_keys.add(key)
+            with self._lock:
+                entry = self._cache.get(id(value), None)
+                if entry is not None:
+                    self._cache.move_to_end(id(value))
+            if entry is not None:
+                options[key] = entry[1]
+                stats["input_bytes"] += entry[2]
+                stats["cached_bytes"] += entry[2]
+                continue
+
+            data, copied = _as_fabber_data(value)
+            nbytes = data.nbytes
+            stats["input_bytes"] += nbytes
+            stats["input_copy_bytes"] += copied
+            if command_line:
+                data = self._write_nifti(data, value)
+            options[key] = data
+            if key not in self.NOT_CACHED:
+                self._add_cached(value, data, nbytes)
+            elif command_line:
+                # Temporary file is only needed for this run
+                self._remove_later(data)
+        stats["transfer_time"] = time.time() - start
+        return options, stats
+
+    def _write_nifti(self, data, value):
+        with self._lock:
+            if self._tempdir is None:
+                self._tempdir = tempfile.mkdtemp("_oxasl_fabber")
+        fname = os.path.join(self._tempdir, "input_%i_%i.nii" % (id(value), int(time.time() * 1e6)))
+        nib.Nifti1Image(data, None, header=value.header).to_filename(fname)
+        return fname
+
+    def _remove_later(self, fname):
+        self._local.temp_files = getattr(self._local, "temp_files", []) + [fname]
+
+    def _remove_files(self, fnames):
+        for fname in fnames:
+            if isinstance(fname, six.string_types) and os.path.isfile(fname):
+                os.remove(fname)
+
+    def end_run(self):
+        """
+        Remove temporary files which were only needed for the last run in this thread
+        """
+        self._remove_files(getattr(self._local, "temp_files", []))
+        self._local.temp_files = []
+
+    def _add_cached(self, value, data, nbytes):
+        with self._lock:
+            # The image object is kept with the entry so its id cannot be re-used
+            self._cache[id(value)] = (value, data, nbytes)
+            total = sum([entry[2] for entry in self._cache.values()])
+            while len(self._cache) > 1 and (len(self._cache) > self.max_items or total > self.max_bytes):
+                _, (_, evicted, evicted_bytes) = self._cache.popitem(last=False)
+                self._remove_files([evicted])
+                total -= evicted_bytes
+
+    def cached_bytes(self):
+        """
+        :return: Total size in bytes of cached image data
+        """
+        with self._lock:
+            return sum([entry[2] for entry in self._cache.values()])
+
+    def clear(self):
+        """
+        Release all cached data
+        """
+        with self._lock:
+            self._remove_files([entry[1] for entry in self._cache.values()])
+            self._cache.clear()
+            if self._tempdir is not None:
+                shutil.rmtree(self._tempdir, ignore_errors=True)
+                self._tempdir = None
+
+_WORKERS = {}
+_WORKERS_LOCK = threading.Lock()
+
+def get_worker(search_dirs=()):
+    """
+    Get the Fabber worker for a set of search directories, shared within this process
+
+    :param search_dirs: Extra search directories for Fabber libraries and executables
+    :return: ``FabberWorker`` instance
+    """
+    search_dirs = tuple(search_dirs)
+    with _WORKERS_LOCK:
+        if search_dirs not in _WORKERS:
+            _WORKERS[search_dirs] = FabberWorker(search_dirs)
+        return _WORKERS[search_dirs]
+
+def clear_workers():
+    """
+    Release cached data held by all Fabber workers
+    """
+    with _WORKERS_LOCK:
+        for worker in _WORKERS.values():
+            worker.clear()
+        _WORKERS.clear()
+
+def reset_workers():
+    """
+    Discard all Fabber workers without releasing their cached data
+
+    This is for use in a child process which has inherited the workers of
+    its parent. The cached data (in particular temporary files) still belongs
+    to the parent, so the child must create its own workers.
+    """
+    with _WORKERS_LOCK:
+        _WORKERS.clear()
+
+atexit.register(clear_workers)
+
 class _Results(dict):
     """
-    Nicked from fsl.wrapperutils
+    Dictionary of results from a Fabber run
+
+    Based on the equivalent class in fsl.wrapperutils but supports output data
+    being stored as raw Numpy arrays which are only converted to images
+    when accessed. The ``stats`` attribute records the number of bytes of
+    data passed to and from Fabber, the number of bytes copied during
+    conversion, the time taken to start the Fabber API and transfer the
+    input data, and the time spent in the Fabber run itself.
     """
-    def __init__(self, output):
+    def __init__(self, output, wrap=None):
         dict.__init__(self)
         self.__output = output
+        self._wrap = wrap
+        self._lazy = set()
+        self.stats = {
+            "input_bytes" : 0,
+            "input_copy_bytes" : 0,
+            "cached_bytes" : 0,
+            "output_bytes" : 0,
+            "wrapped_bytes" : 0,
+            "startup_time" : 0.0,
+            "transfer_time" : 0.0,
+            "run_time" : 0.0,
+        }
 
     @property
     def output(self):
         """Access the return value of the decorated function. """
         return self.__output
 
-def fabber(options, output=LOAD, ref_nii=None, progress_log=None, **kwargs):
+    def set_lazy(self, key, data):
+        """
+        Store raw output data which will be converted to an image on first access
+        """
+        dict.__setitem__(self, key, data)
+        self._lazy.add(key)
+        self.stats["output_bytes"] += data.nbytes
+
+    def __setitem__(self, key, value):
+        self._lazy.discard(key)
+        dict.__setitem__(self, key, value)
+
+    def __getitem__(self, key):
+        value = dict.__getitem__(self, key)
+        if key in self._lazy:
+            self._lazy.discard(key)
+            self.stats["wrapped_bytes"] += value.nbytes
+            value = self._wrap(value)
+            dict.__setitem__(self, key, value)
+        return value
+
+    def get(self, key, default=None):
+        if key in self:
+            return self[key]
+        return default
+
+    def items(self):
+        return [(key, self[key]) for key in self.keys()]
+
+    def values(self):
+        return [self[key] for key in self.keys()]
+
+def fabber(options, output=LOAD, ref_nii=None, progress_log=None, progress_cb=None, outputs=None, **kwargs):
     """
     Wrapper for Fabber tool
 
@@ -65,14 +427,21 @@ def fabber(options, output=LOAD, ref_nii=None, progress_log=None, **kwargs):
     :param ref_nii: Optional reference Nibabel image to use when writing output
                     files. Not required if main data is FSL or Nibabel image.
     :param progress_log: File-like stream to logging progress percentage to
+    :param progress_cb: Optional callable taking the number of voxels processed and the
+                        total number of voxels, called as the run progresses
+    :param outputs: Optional sequence of output data names to return, e.g. ``["finalMVN", "mean_*"]``.
+                    Save options which do not generate any of these outputs are
+                    removed so they are not computed or retrieved. If None, all outputs
+                    enabled by the save options are returned
     :return: Dictionary of output data items name:image. The image matches the
              type of the main input data unless this was a file in which case
              an fsl.data.image.Image is returned.
     """
     extra_search_dirs = kwargs.pop("fabber_dirs", ())
-    fab = Fabber(*extra_search_dirs)
+    worker = get_worker(extra_search_dirs)
+    fab, startup_time = worker.api()
 
-    options = dict(options)
+    options = select_outputs(options, outputs)
     main_data = options.get("data", None)
     if main_data is None:
         raise ValueError("Main data not specified")
@@ -80,26 +449,30 @@ def fabber(options, output=LOAD, ref_nii=None, progress_log=None, **kwargs):
     if output != LOAD and not os.path.exists(output):
         os.makedirs(output)
 
-    # Get a reference Nibabel image to use when generating output
-    if not ref_nii:
-        if isinstance(main_data, Image):
-            ref_nii = main_data.nibImage
-        else:
-            ref_nii = Image(main_data).nibImage
-
-    if ref_nii:
+    # Get a reference header to use when generating output. Where the main
+    # data is a filename only the header is read here
+    if ref_nii is not None:
         header = ref_nii.header
-        affine = ref_nii.header.get_best_affine()
+    elif isinstance(main_data, (Image, nib.Nifti1Image)):
+        header = main_data.header
+    elif isinstance(main_data, six.string_types):
+        header = nib.load(main_data).header
     else:
         header = None
-        affine = np.identity(4)
 
-    # Replace fsl.Image objects with the underlying nibabel object. The Fabber
-    # Python API can already handle Numpy arrays, nibabel images and filenames
-    for key in list(options.keys()):
-        value = options[key]
-        if isinstance(value, Image):
-            options[key] = value.nibImage
+    # Pass image data to the Fabber API as float32 Numpy arrays. This avoids
+    # the API converting Nibabel images to float64 via get_fdata. Note that
+    # Fabber requires the full voxel grid (with a separate mask) so the data
+    # cannot be passed as masked voxel arrays. Images which were passed to
+    # a previous run are re-used from the worker without conversion
+    options, input_stats = worker.inputs(options)
+
+    def _wrap(data):
+        if header is not None:
+            img = Image(data, header=header)
+        else:
+            img = Image(data)
+        return _matching_image(main_data, img)
 
     # Streams to capture stdout and stderr and maybe send them elsewhere too
     stdout = Tee()
@@ -122,7 +495,9 @@ def fabber(options, output=LOAD, ref_nii=None, progress_log=None, **kwargs):
 
     exception = None
     cmd_output = []
-    ret = _Results(cmd_output)
+    ret = _Results(cmd_output, wrap=_wrap)
+    ret.stats.update(input_stats)
+    ret.stats["startup_time"] = startup_time
     try:
         ret["paramnames"] = fab.get_model_params(options)
         if log.get("cmd", None):
@@ -133,30 +508,47 @@ def fabber(options, output=LOAD, ref_nii=None, progress_log=None, **kwargs):
                     value = str(type(value))
                 log["cmd"].write("--%s=%s " % (key.replace("_", "-"), value))
             log["cmd"].write("\n")
-        progress_cb = None
+        callbacks = []
         if progress_log:
-            progress_cb = percent_progress(progress_log)
-        run = fab.run(options, progress_cb)
+            callbacks.append(percent_progress(progress_log))
+        if progress_cb is not None:
+            callbacks.append(progress_cb)
+
+        def _progress(done, total):
+            for callback in callbacks:
+                callback(done, total)
+
+        start = time.time()
+        run = fab.run(options, _progress if callbacks else None)
+        ret.stats["run_time"] = time.time() - start
         ret["logfile"] = run.log
 
         # Write output data or save it as required
         for data_name, data in run.data.items():
-            nii = nib.Nifti1Image(data, header=header, affine=affine)
-            nii.update_header()
-            nii.header.set_data_dtype(data.dtype)
-            img = Image(nii)
+            if not _output_wanted(data_name, outputs):
+                continue
             if output == LOAD:
-                # Return in-memory data items as the same type as image as the main data
-                ret[data_name] = _matching_image(main_data, img)
+                # Return in-memory data items as the same type as image as the main
+                # data. Conversion is deferred until the item is accessed
+                ret.set_lazy(data_name, data)
             else:
                 fname = os.path.join(output, data_name)
-                img.save(fname)
+                _wrap(data).save(fname)
+
+        if log.get("cmd", None):
+            log["cmd"].write("Fabber data: %.1f Mb input (%.1f Mb previously converted, %.1f Mb copied in conversion), %.1f Mb output\n" % (
+                float(ret.stats["input_bytes"]) / 1e6, float(ret.stats["cached_bytes"]) / 1e6,
+                float(ret.stats["input_copy_bytes"]) / 1e6, float(ret.stats["output_bytes"]) / 1e6))
+            log["cmd"].write("Fabber worker: %.2fs startup, %.2fs input transfer, %.2fs run\n" % (
+                startup_time, ret.stats["transfer_time"], ret.stats["run_time"]))
 
     except FabberException as exc:
         # Error while actually running Fabber - may raise later
         # or replace with exit code
         exception = exc
         stderr.write(str(exc) + "\n")
+    finally:
+        worker.end_run()
 
     if ret_stdout:
         cmd_output.append(str(stdout))
@@ -170,6 +562,97 @@ def fabber(options, output=LOAD, ref_nii=None, progress_log=None, **kwargs):
 
     return ret
 
+def model_fit(options, mvn, paramnames=None, mask=None, **kwargs):
+    """
+    Recompute the model prediction from the posterior of a previous Fabber run
+
+    This allows the ``modelfit`` output of a step which did not save it (e.g.
+    an intermediate BASIL step) to be generated on demand. The model is
+    evaluated in each voxel using the posterior parameter means stored in the MVN.
+
+    Voxelwise data options (e.g. PV maps or T1 maps) are passed to the model
+    for each voxel so the result is consistent with the original run. Note that
+    the Fabber API evaluates the model one voxel at a time so this is much slower
+    than saving the model fit during the run. It should only be used when the
+    model fit is needed for a step which was run without ``save-model-fit``.
+
+    :param options: Fabber options used for the original run, including main data
+    :param mvn: Final MVN output of the run as an Image
+    :param paramnames: Sequence of model parameter names. If not given, these are
+                       obtained from the model
+    :param mask: Optional mask Image. If not given, the ``mask`` option is used if
+                 present, otherwise all voxels are evaluated
+    :return: 4D Image containing the model prediction with the same shape as the
+             main data
+    """
+    extra_search_dirs = kwargs.pop("fabber_dirs", ())
+    fab, _ = get_worker(extra_search_dirs).api()
+
+    main_data = options.get("data", None)
+    if main_data is None:
+        raise ValueError("Main data not specified")
+    if not isinstance(main_data, Image):
+        main_data = Image(main_data)
+    shape = main_data.shape[:3]
+    nvols = main_data.shape[3] if main_data.ndim > 3 else 1
+
+    if paramnames is None:
+        paramnames = fab.get_model_params(options)
+
+    if mask is None:
+        mask = options.get("mask", None)
+    if mask is None:
+        mask = np.ones(shape, dtype=np.int32)
+    elif isinstance(mask, Image):
+        mask = mask.data
+    voxels = np.nonzero(mask)
+
+    means = MVN(mvn).means()[voxels]
+
+    # Voxelwise data options, these must be passed separately for each voxel
+    voxel_options, voxel_shapes = {}, {}
+    model_options = {}
+    for key, value in options.items():
+        if key in ("data", "mask", "continue-from-mvn") or key.startswith("save-"):
+            continue
+        if isinstance(value, (Image, nib.Nifti1Image)):
+            value = np.asarray(value.data if isinstance(value, Image) else value.dataobj)
+        if isinstance(value, np.ndarray) and value.ndim >= 3 and tuple(value.shape[:3]) == tuple(shape):
+            voxel_options[key] = value[voxels].reshape(len(voxels[0]), -1)
+            voxel_shapes[key] = [1, 1, 1] + list(value.shape[3:])
+        else:
+            model_options[key] = value
+    model_options["data"] = np.zeros([1, 1, 1, nvols], dtype=np.float32)
+
+    fit = np.zeros([len(voxels[0]), nvols], dtype=np.float32)
+    for vox in range(len(voxels[0])):
+        vox_options = dict(model_options)
+        for key, value in voxel_options.items():
+            vox_options[key] = value[vox].reshape(voxel_shapes[key])
+        param_values = dict([(param, means[vox, idx]) for idx, param in enumerate(paramnames)])
+        fit[vox] = fab.model_evaluate(vox_options, param_values, nvols)
+
+    ret = np.zeros(list(shape) + [nvols,], dtype=np.float32)
+    ret[voxels] = fit
+    return Image(ret, header=main_data.header)
+
+def mvn_update(mvn, param, mean=None, var=None, mask=None):
+    """
+    Set the mean and/or variance of a parameter in an MVN image
+
+    This is equivalent to ``mvntool --write`` but operates on the data in
+    memory rather than running the command line tool.
+
+    :param mvn: MVN Image, e.g. the ``finalMVN`` output of a Fabber run
+    :param param: Index of the parameter (zero based)
+    :param mean: Image, array or scalar containing new parameter mean
+    :param var: Image, array or scalar containing new parameter variance
+    :param mask: Optional mask Image or array. If specified only voxels within
+                 the mask are updated
+    :return: New MVN Image
+    """
+    return MVN(mvn).update(param, mean=mean, var=var, mask=mask).image()
+
 @wutils.fileOrImage('mvn', 'output', 'valim', 'varim', 'mask')
 @wutils.fslwrapper
 def mvntool(mvn, param, **kwargs):
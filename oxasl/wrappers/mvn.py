@@ -0,0 +1,236 @@
+"""
+Access to Fabber MVN images
+
+Fabber stores the posterior distribution of the model parameters in a 4D
+image (``finalMVN``). For N parameters (including noise parameters) each voxel
+contains the lower triangle of the N x N covariance matrix, stored row by row,
+followed by the N parameter means and a final volume which is always 1, giving
+(N+1)(N+2)/2 volumes in total.
+
+The ``MVN`` class gives vectorised access to the means and covariances of
+parameters without needing the ``mvntool`` command line program:
+
+    mvn = MVN(wsp.basil.finalstep.finalMVN, paramnames=["ftiss", "delttiss"])
+    ftiss = mvn.mean("ftiss")
+    mvn.update("ftiss", mean=ftiss_init, var=0.1, mask=mask)
+    mvn.save("finalMVN.nii.gz")
+
+``fabber.mvn.MVN`` provides similar access but is an ``Image`` subclass, so the
+whole MVN is loaded and held by fslpy and each update replaces a full volume.
+It also has no masked updates or bulk access to all means and variances. The
+masked update is used by ``PvcInitStep`` and ``mvn_update``, and the bulk means
+by ``model_fit``. An ``MVN`` can be created from a ``fabber.mvn.MVN`` since it
+is an ``Image``.
+
+Copyright (c) 2008-2018 University of Oxford
+"""
+from __future__ import absolute_import
+
+import math
+
+import six
+import numpy as np
+import nibabel as nib
+
+from fsl.data.image import Image
+
+def mvn_nparams(nvols):
+    """
+    :param nvols: Number of volumes in an MVN image
+    :return: Number of parameters (including noise parameters)
+    """
+    nparams = int(round((math.sqrt(1+8*float(nvols)) - 1) / 2 - 1))
+    if (nparams+1) * (nparams+2) != 2 * nvols:
+        raise ValueError("%i volumes is not a valid MVN image" % nvols)
+    return nparams
+
+class MVN(object):
+    """
+    Fabber MVN image
+
+    The data is not copied until it is modified, so an MVN loaded from an
+    uncompressed file is memory-mapped and the Image an MVN was created from
+    is never changed.
+    """
+
+    def __init__(self, img, paramnames=None):
+        """
+        :param img: MVN Image, or name of an MVN Nifti file
+        :param paramnames: Optional sequence of parameter names allowing
+                           parameters to be specified by name
+        """
+        if isinstance(img, six.string_types):
+            nii = nib.load(img, mmap=True)
+            self.header = nii.header
+            self.data = np.asanyarray(nii.dataobj)
+        else:
+            self.header = img.header
+            self.data = img.data
+        self._copied = False
+        if self.data.ndim != 4:
+            raise ValueError("MVN image must be 4D")
+        self.nparams = mvn_nparams(self.data.shape[3])
+        if paramnames is not None and len(paramnames) > self.nparams:
+            raise ValueError("%i parameter names given for MVN with %i parameters" % (len(paramnames), self.nparams))
+        self.paramnames = list(paramnames) if paramnames is not None else None
+
+    @property
+    def shape(self):
+        """
+        3D shape of the MVN voxel grid
+        """
+        return self.data.shape[:3]
+
+    def _param_idx(self, param):
+        if isinstance(param, six.string_types):
+            if self.paramnames is None or param not in self.paramnames:
+                raise ValueError("Unknown parameter: %s" % param)
+            return self.paramnames.index(param)
+        if param < 0 or param >= self.nparams:
+            raise ValueError("Parameter index %i out of range for MVN with %i parameters" % (param, self.nparams))
+        return param
+
+    def _cov_vol(self, idx1, idx2):
+        idx1, idx2 = max(idx1, idx2), min(idx1, idx2)
+        return int(idx1 * (idx1+1) / 2) + idx2
+
+    def _mean_vol(self, idx):
+        return int(self.nparams * (self.nparams+1) / 2) + idx
+
+    def mean(self, param):
+        """
+        :param param: Parameter name or index (zero based)
+        :return: 3D array of parameter means
+        """
+        return self.data[..., self._mean_vol(self._param_idx(param))]
+
+    def var(self, param):
+        """
+        :param param: Parameter name or index (zero based)
+        :return: 3D array of parameter variances
+        """
+        idx = self._param_idx(param)
+        return self.data[..., self._cov_vol(idx, idx)]
+
+    def cov(self, param1, param2):
+        """
+        :return: 3D array of the covariance between two parameters
+        """
+        return self.data[..., self._cov_vol(self._param_idx(param1), self._param_idx(param2))]
+
+    def means(self):
+        """
+        :return: 4D array of the means of all parameters
+        """
+        start = self._mean_vol(0)
+        return self.data[..., start:start+self.nparams]
+
+    def variances(self):
+        """
+        :return: 4D array of the variances of all parameters
+        """
+        return self.data[..., [self._cov_vol(idx, idx) for idx in range(self.nparams)]]
+
+    def covariance(self):
+        """
+        :return: 5D array containing the full covariance matrix in each voxel
+        """
+        rows, cols = np.meshgrid(range(self.nparams), range(self.nparams), indexing="ij")
+        vols = np.maximum(rows, cols) * (np.maximum(rows, cols) + 1) // 2 + np.minimum(rows, cols)
+        return self.data[..., vols]
+
+    def _writable(self):
+        if not self._copied:
+            self.data = np.array(self.data, dtype=np.float32)
+            self._copied = True
+
+    def update(self, param, mean=None, var=None, mask=None):
+        """
+        Set the mean and/or variance of a parameter
+
+        This is equivalent to ``mvntool --write``. Covariances with other
+        parameters are not changed.
+
+        :param param: Parameter name or index (zero based)
+        :param mean: Image, array or scalar containing new parameter mean
+        :param var: Image, array or scalar containing new parameter variance
+        :param mask: Optional mask Image or array. If specified only voxels within
+                     the mask are updated
+        :return: self, to allow chaining of updates
+        """
+        idx = self._param_idx(param)
+        self._writable()
+        if mask is None:
+            voxels = np.ones(self.shape, dtype=bool)
+        else:
+            voxels = np.asarray(mask.data if isinstance(mask, Image) else mask) > 0
+
+        for vol, value in ((self._mean_vol(idx), mean), (self._cov_vol(idx, idx), var)):
+            if value is not None:
+                if isinstance(value, Image):
+                    value = value.data
+                self.data[..., vol][voxels] = np.broadcast_to(value, self.shape)[voxels]
+        return self
+
+    def masked(self, mask):
+        """
+        :param mask: Mask Image or array
+        :return: New MVN with voxels outside the mask set to zero
+        """
+        voxels = np.asarray(mask.data if isinstance(mask, Image) else mask) > 0
+        data = np.zeros(self.data.shape, dtype=np.float32)
+        data[voxels] = self.data[voxels]
+        return MVN(Image(data, header=self.header), self.paramnames)
+
+    def cropped(self, bbox):
+        """
+        :param bbox: Bounding box as returned by ``oxasl.crop.get_bbox``
+        :return: New MVN cropped to the bounding box
+        """
+        from oxasl.crop import crop_image
+        return MVN(crop_image(self.image(), bbox), self.paramnames)
+
+    @classmethod
+    def merge(cls, mvns, masks=None):
+        """
+        Merge MVNs which each contain a subset of voxels on the same voxel grid
+
+        This is intended for combining the output of Fabber runs on separate
+        chunks of the data. Note that no chunked fitting currently uses it.
+
+        :param mvns: Sequence of MVN objects
+        :param masks: Optional sequence of mask Images or arrays identifying the voxels
+                      belonging to each MVN. If not given, voxels where any volume is
+                      nonzero are used. Where masks overlap the last MVN takes precedence
+        :return: Merged MVN
+        """
+        if not mvns:
+            raise ValueError("No MVNs to merge")
+        ref = mvns[0]
+        for mvn in mvns[1:]:
+            if mvn.data.shape != ref.data.shape:
+                raise ValueError("MVNs to merge must have the same shape")
+        if masks is not None and len(masks) != len(mvns):
+            raise ValueError("Number of masks must match number of MVNs")
+
+        data = np.zeros(ref.data.shape, dtype=np.float32)
+        for idx, mvn in enumerate(mvns):
+            if masks is None:
+                voxels = np.any(mvn.data != 0, axis=-1)
+            else:
+                mask = masks[idx]
+                voxels = np.asarray(mask.data if isinstance(mask, Image) else mask) > 0
+            data[voxels] = mvn.data[voxels]
+        return cls(Image(data, header=ref.header), ref.paramnames)
+
+    def image(self):
+        """
+        :return: MVN as a 4D float32 Image suitable for passing to Fabber
+        """
+        return Image(np.asarray(self.data, dtype=np.float32), header=self.header)
+
+    def save(self, fname):
+        """
+        Save the MVN to a Nifti file as float32 data
+        """
+        self.image().save(fname)
@@ -97,6 +97,8 @@ kwargs = {
             "oxasl_mask=oxasl.mask:main",
             "oxasl_reg=oxasl.reg:main",
             "oxasl=oxasl.oxford_asl:main",
+            "oxasl_fabber_cache=oxasl.cache:main",
+            "oxasl_recalib=oxasl.recalib:main",
         ],
         'gui_scripts' : [
             "oxasl_gui=oxasl.gui:main",